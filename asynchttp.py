@@ -0,0 +1,217 @@
+"""
+Shared asyncio HTTP engine for the Drive and Calendar backups.
+
+Each process has one event loop, running in a daemon thread, and one httpx connection pool with keep-alive
+(and HTTP/2 if the h2 module is installed). API requests and downloads of every job in the process go through it:
+
+- AsyncHttp replaces httplib2.Http for the API client, so credentials.authorize() and the discovery based
+  client work unchanged. Each call submits the request to the loop and waits for the response.
+- urlopen() replaces urllib.request.urlopen for streaming downloads.
+
+Job threads still block on their own requests, but they no longer own a connection each: at most
+ASYNC_HTTP_CONCURRENCY requests are in flight on at most ASYNC_HTTP_MAX_CONNECTIONS connections, however many
+jobs and download threads are running. Errors are translated to what the blocking transports raise (OSError
+subclasses and urllib.error.HTTPError), so retries and error classification in helpers.py do not change.
+
+Services not in ASYNC_HTTP_SERVICES, and all services when httpx is not installed, use httplib2 and urllib.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import httplib2
+
+from .settings import (
+    ASYNC_HTTP_CONCURRENCY, ASYNC_HTTP_MAX_CONNECTIONS, ASYNC_HTTP_SERVICES, ASYNC_HTTP_TIMEOUT
+)
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2  # pylint: disable=unused-import
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# Headers that describe the encoded body. httpx returns the decoded body, as httplib2 does.
+ENCODING_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+logger = logging.getLogger("asynchttp")
+
+
+def transport_error(err):
+    if isinstance(err, httpx.TimeoutException):
+        return TimeoutError("%s: %s" % (type(err).__name__, err))
+    return ConnectionError("%s: %s" % (type(err).__name__, err))
+
+
+class AsyncEngine:
+    """ Event loop thread with a shared connection pool. Coroutines are submitted with run(). """
+
+    def __init__(self, concurrency, max_connections, timeout):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="asynchttp", daemon=True)
+        self.thread.start()
+        self.semaphore = None
+        self.client = self.run(self.create_client(concurrency, max_connections, timeout))
+
+    async def create_client(self, concurrency, max_connections, timeout):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        return httpx.AsyncClient(
+            http2=HTTP2,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            # Waiting for a free connection is bounded by the semaphore, not by a timeout.
+            timeout=httpx.Timeout(timeout, pool=None),
+            follow_redirects=True,
+        )
+
+    def run(self, coroutine):
+        """ Runs coroutine on the loop and blocks the calling thread until it is done. """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def request(self, method, url, body, headers):
+        async with self.semaphore:
+            try:
+                return await self.client.request(method, url, content=body, headers=headers)
+            except httpx.TransportError as err:
+                raise transport_error(err) from err
+
+    async def open(self, url, headers, timeout):
+        """ Starts a streaming GET. The returned response holds a slot of the semaphore until close(). """
+        await self.semaphore.acquire()
+        # Stored data, Content-Length and ranges all refer to the unencoded file.
+        headers = dict(headers, **{"Accept-Encoding": "identity"})
+        try:
+            request = self.client.build_request("GET", url, headers=headers, timeout=httpx.Timeout(timeout, pool=None))
+            try:
+                response = await self.client.send(request, stream=True)
+            except httpx.TransportError as err:
+                raise transport_error(err) from err
+            if response.status_code >= 400:
+                body = await response.aread()
+                await response.aclose()
+                raise urllib.error.HTTPError(
+                    url, response.status_code, response.reason_phrase, response.headers, io.BytesIO(body)
+                )
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return response
+
+    async def close_stream(self, response):
+        try:
+            await response.aclose()
+        finally:
+            self.semaphore.release()
+
+
+class StreamingResponse:
+    """ File-like view of a streaming response for downloader.stream_to_file. """
+
+    def __init__(self, engine, response, url):
+        self.engine = engine
+        self.response = response
+        self.url = url
+        self.status = response.status_code
+        self.headers = response.headers
+        self.chunks = response.aiter_bytes()
+        self.buffer = b""
+
+    async def read_async(self, size):
+        while len(self.buffer) < size and self.chunks is not None:
+            try:
+                self.buffer += await self.chunks.__anext__()
+            except StopAsyncIteration:
+                # Release the connection in this round trip rather than in close().
+                self.chunks = None
+                response, self.response = self.response, None
+                await self.engine.close_stream(response)
+            except httpx.TransportError as err:
+                raise transport_error(err) from err
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read(self, size):
+        return self.engine.run(self.read_async(size))
+
+    def close(self):
+        if self.response is not None:
+            response, self.response = self.response, None
+            self.engine.run(self.engine.close_stream(response))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncHttp:
+    """ httplib2.Http compatible client that sends requests through the engine. """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def request(
+        self, uri, method="GET", body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+        connection_type=None
+    ):
+        response = self.engine.run(self.engine.request(method, uri, body, headers or {}))
+        info = {}
+        for name, value in response.headers.multi_items():
+            name = name.lower()
+            if name not in ENCODING_HEADERS:
+                info[name] = "%s, %s" % (info[name], value) if name in info else value
+        info["status"] = str(response.status_code)
+        resp = httplib2.Response(info)
+        resp.reason = response.reason_phrase
+        return (resp, response.content)
+
+    def close(self):
+        pass
+
+
+ENGINE = None
+ENGINE_PID = None
+ENGINE_LOCK = threading.Lock()
+
+
+def get_engine():
+    """ Returns the engine of this process, starting it on first use. Forked processes start their own. """
+    global ENGINE, ENGINE_PID  # pylint: disable=global-statement
+    with ENGINE_LOCK:
+        if ENGINE is None or ENGINE_PID != os.getpid():
+            ENGINE = AsyncEngine(ASYNC_HTTP_CONCURRENCY, ASYNC_HTTP_MAX_CONNECTIONS, ASYNC_HTTP_TIMEOUT)
+            ENGINE_PID = os.getpid()
+            logger.info(
+                "Started HTTP engine: %s requests on %s connections, HTTP/2 %s", ASYNC_HTTP_CONCURRENCY,
+                ASYNC_HTTP_MAX_CONNECTIONS, "enabled" if HTTP2 else "disabled (h2 is not installed)"
+            )
+        return ENGINE
+
+
+def is_enabled(service):
+    return httpx is not None and service in ASYNC_HTTP_SERVICES
+
+
+def get_http(service):
+    """ Returns the transport for API clients of service. """
+    if is_enabled(service):
+        return AsyncHttp(get_engine())
+    return httplib2.Http(".cache")
+
+
+def urlopen(service, url, headers, timeout):
+    """ Opens url for streaming. Raises urllib.error.HTTPError for non-2xx responses, like urllib.request.urlopen. """
+    if is_enabled(service):
+        engine = get_engine()
+        return StreamingResponse(engine, engine.run(engine.open(url, headers, timeout)), url)
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
@@ -2,26 +2,33 @@
 Google backup
 
 Usage:
-  backup.py gmail [--verbose] (all | <user>...)
-  backup.py calendar [--verbose] (all | <user>...)
-  backup.py drive [--verbose] (all | <user>...)
-  backup.py full [--verbose] (all | <user>...)
+  backup.py gmail [options] (all | <user>...)
+  backup.py calendar [options] (all | <user>...)
+  backup.py drive [options] (all | <user>...)
+  backup.py full [options] (all | <user>...)
   backup.py -h | --help
 
 Options:
-  -h --help     Show this screen.
-  --verbose     More verbose output.
+  -h --help               Show this screen.
+  --verbose               More verbose output.
+  --workers=<n>           Maximum number of concurrent backup jobs. Defaults to SCHEDULER_WORKERS.
+  --gmail-workers=<n>     Maximum number of concurrent Gmail jobs.
+  --drive-workers=<n>     Maximum number of concurrent Drive jobs.
+  --calendar-workers=<n>  Maximum number of concurrent Calendar jobs.
+  --force                 Run every job, even if a quick check finds nothing new since the last run.
+  --shard=<k/n>           Back up only the users in shard k of n, split by a hash of the email address.
+  --run=<id>              Run shared through COORDINATOR_DATABASE. Defaults to the current date.
 
 """
 import sys
+import time
 
 from docopt import docopt
 
-from .calendarbackup import CalendarBackup
-from .drivebackup import DriveBackup
-from .get_users import get_users
-from .gmailbackup import GmailBackup
-from .settings import DOMAIN
+from .coordinator import Coordinator, parse_shard, shard_of
+from .get_users import get_user_directory, get_users
+from .scheduler import BackupScheduler, format_summary
+from .settings import COORDINATOR_DATABASE, DOMAIN
 
 SERVICES = ["gmail", "calendar", "drive"]
 
@@ -42,21 +49,41 @@ def main():
         return 1
 
     users = arguments["<user>"]
+    directory = None
     if "all" in arguments["<user>"]:
         users = get_users(DOMAIN)
+        # Cached by get_users
+        directory = get_user_directory(DOMAIN)
 
-    for service in run_services:
-        for user in users:
-            backup = None
-            if service == 'gmail':
-                backup = GmailBackup(user)
-            elif service == 'drive':
-                backup = DriveBackup(user)
-            elif service == 'calendar':
-                backup = CalendarBackup(user)
-            if backup:
-                backup.initialize()
-                backup.run()
+    shard = (0, 1)
+    if arguments["--shard"]:
+        try:
+            shard = parse_shard(arguments["--shard"])
+        except ValueError as err:
+            print("Invalid --shard %s: %s" % (arguments["--shard"], err))
+            return 1
+        users = [user for user in users if shard_of(user, shard[1]) == shard[0]]
+    coordinator = None
+    if COORDINATOR_DATABASE:
+        coordinator = Coordinator(COORDINATOR_DATABASE, arguments["--run"] or time.strftime("%Y-%m-%d"), shard)
+
+    workers = None
+    if arguments["--workers"]:
+        workers = int(arguments["--workers"])
+    service_limits = {}
+    for service in SERVICES:
+        if arguments["--%s-workers" % service]:
+            service_limits[service] = int(arguments["--%s-workers" % service])
+
+    scheduler = BackupScheduler(
+        run_services, users, workers=workers, service_limits=service_limits, directory=directory,
+        force=arguments["--force"], coordinator=coordinator
+    )
+    summary = scheduler.run()
+    print(format_summary(summary))
+    for service in summary["services"].values():
+        if service["failed"]:
+            return 1
     return 0
 
 
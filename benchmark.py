@@ -0,0 +1,358 @@
+"""
+Offline benchmarks against a local fake Google (fakegoogle.py)
+
+Each scenario starts the fake HTTP and IMAP servers in a separate process, points the backup at them and runs the
+user listing and the scheduler in a fresh process, so that peak RSS is measured per run. With --incremental,
+the fake domain then gets a new generation of changes and the backup runs again on the same state.
+
+Usage:
+  benchmark.py [options] <scenario>...
+  benchmark.py --list
+  benchmark.py -h | --help
+
+Options:
+  -h --help              Show this screen.
+  --list                 List scenarios.
+  --incremental          Run again after new messages, files and events have appeared.
+  --workers=<n>          Maximum number of concurrent backup jobs. Defaults to SCHEDULER_WORKERS.
+  --latency=<seconds>    Delay of every API response, instead of the scenario's.
+  --throttle=<fraction>  Fraction of API requests answered with a rate limit error, instead of the scenario's.
+  --drops=<fraction>     Fraction of downloads cut off halfway, instead of the scenario's.
+  --rate-limits          Keep API_RATE_LIMITS. By default they are lifted, so that the backup itself is measured.
+  --output=<file>        Write results as JSON.
+  --baseline=<file>      Compare with results written by --output. Exits with 1 if a run regressed.
+  --tolerance=<percent>  Allowed regression against the baseline [default: 20].
+  --keep                 Keep the backup directory.
+
+"""
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import pwd
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import urllib.request
+
+from docopt import docopt
+
+from . import settings
+from .fakegoogle import FakeDomain, serve
+from .progress import format_bytes
+
+DOMAIN = "example.com"
+
+Scenario = collections.namedtuple("Scenario", ["description", "domain", "services"])
+
+SCENARIOS = {
+    "smoke": Scenario(
+        "5 users with a bit of everything", {
+            "users": 5,
+            "messages": 200,
+            "files": 20,
+            "documents": 2,
+            "calendars": 2,
+            "events": 300,
+        }, ("users", "gmail", "drive", "calendar")
+    ),
+    "users-5k": Scenario(
+        "5000 users with one small calendar each", {
+            "users": 5000,
+            "messages": 0,
+            "files": 0,
+            "calendars": 1,
+            "events": 10,
+        }, ("users", "calendar")
+    ),
+    "gmail-1m": Scenario(
+        "1M messages of 4KiB, 100 users", {
+            "users": 100,
+            "messages": 10000,
+            "message_size": 4096,
+            "files": 0,
+            "events": 0,
+        }, ("gmail", )
+    ),
+    "drive-10g": Scenario(
+        "10GiB of Drive files, 40 users with 256 files of 1MiB and 16 documents", {
+            "users": 40,
+            "messages": 0,
+            "files": 256,
+            "file_size": 1024**2,
+            "documents": 16,
+            "events": 0,
+        }, ("drive", )
+    ),
+    "throttled": Scenario(
+        "smoke with 20ms API latency and 5% of requests rate limited", {
+            "users": 5,
+            "messages": 200,
+            "files": 20,
+            "documents": 2,
+            "calendars": 2,
+            "events": 300,
+            "latency": 0.02,
+            "throttle": 0.05,
+        }, ("gmail", "drive", "calendar")
+    ),
+    "flaky": Scenario(
+        "5 users with 8 files of 16MiB each, 30% of downloads cut off halfway", {
+            "users": 5,
+            "messages": 0,
+            "files": 8,
+            "file_size": 16 * 1024**2,
+            "events": 0,
+            "interruptions": 0.3,
+        }, ("drive", )
+    ),
+}
+
+# API_RATE_LIMITS without --rate-limits
+UNLIMITED = (100000, 100000)
+# Server statistics that are not API calls.
+NOT_CALLS = ("bytes", "throttled", "interrupted")
+
+
+class FakeCredentials:
+    """ Access tokens the fake servers accept, in place of service account credentials. """
+
+    token_expiry = datetime.datetime(2100, 1, 1)
+    access_token_expired = False
+
+    def __init__(self, user_email):
+        self.access_token = "fake:%s" % user_email
+
+    def apply(self, headers):
+        headers["Authorization"] = "Bearer %s" % self.access_token
+
+    def refresh(self, http):
+        pass
+
+    def authorize(self, http):
+        request = http.request
+
+        def authorized_request(uri, method="GET", body=None, headers=None, *args, **kwargs):
+            headers = dict(headers or {})
+            self.apply(headers)
+            return request(uri, method, body, headers, *args, **kwargs)
+
+        authorized_request.credentials = self
+        http.request = authorized_request
+        return http
+
+
+def configure(root, base_url, imap_port, rate_limits):
+    """ Points settings to the fake servers and root. Must run before the backup modules are imported, as they
+        copy settings on import. """
+    if not rate_limits:
+        settings.API_RATE_LIMITS = {api: UNLIMITED for api in settings.API_RATE_LIMITS}
+    settings.DOMAIN = DOMAIN
+    settings.ZPOOL_ROOT_PATH = root.lstrip("/")
+    settings.STATE_DATABASE = "%s/state.sqlite" % root
+    settings.STORAGE_BACKEND = "directory"
+    settings.STORAGE_SNAPSHOTS = False
+    settings.BACKUP_OWNER = pwd.getpwuid(os.getuid()).pw_name
+    settings.USERS_ADMIN_EMAIL = "admin@%s" % DOMAIN
+    settings.CALENDAR_IGNORE_USERS = []
+    settings.GOOGLE_DISCOVERY_URI = base_url + "/discovery/v1/apis/%s/%s/rest"
+    settings.GOOGLE_BATCH_URI = base_url + "/batch"
+    settings.GMAIL_IMAP_HOST = "127.0.0.1"
+    settings.GMAIL_IMAP_PORT = imap_port
+    settings.GMAIL_IMAP_SSL = False
+    settings.METRICS_TEXTFILE = None
+    settings.METRICS_HTTP_PORT = None
+    settings.METRICS_REPORT_DIRECTORY = None
+
+
+def run_pass(scenario, users, root, base_url, imap_port, options, refresh, results):
+    """ Runs in a child process. Puts a result dict to results. """
+    configure(root, base_url, imap_port, options["rate_limits"])
+    os.chdir(root)
+    # pylint: disable=import-outside-toplevel
+    from .get_users import get_user_directory, get_users
+    from .helpers import CREDENTIALS
+    from .metrics import API_REQUEST_SECONDS
+    from .scheduler import BackupScheduler
+
+    CREDENTIALS.get_credentials = lambda user_email, scope: FakeCredentials(user_email)
+    start = time.time()
+    directory = None
+    users_elapsed = None
+    if "users" in scenario.services:
+        users = get_users(DOMAIN, refresh)
+        directory = get_user_directory(DOMAIN)
+        users_elapsed = time.time() - start
+    services = [service for service in scenario.services if service != "users"]
+    scheduler = BackupScheduler(services, users, workers=options["workers"], directory=directory)
+    summary = scheduler.run()
+    elapsed = time.time() - start
+    jobs = scheduler.report["jobs"] if scheduler.report else []
+    items = sum(job.get("processed", 0) for job in jobs)
+    size = sum(job.get("bytes", 0) for job in jobs)
+    results.put({
+        "elapsed": elapsed,
+        "users": len(users),
+        "users_elapsed": users_elapsed,
+        "items": items,
+        "bytes": size,
+        "items_per_second": items / elapsed if elapsed > 0 else 0.0,
+        "bytes_per_second": size / elapsed if elapsed > 0 else 0.0,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "client_requests": sum(value[-1] for _, value in API_REQUEST_SECONDS.collect()),
+        "failed": sorted(
+            "%s %s" % (service, user) for service, result in summary["services"].items()
+            for user in result["failed_users"]
+        ),
+    })
+
+
+def server_request(base_url, path, method="GET"):
+    request = urllib.request.Request(base_url + path, data=b"" if method == "POST" else None, method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def wait_result(process, results):
+    while True:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError("Benchmark run failed with exit code %s" % process.exitcode)
+            continue
+        process.join()
+        return result
+
+
+def run_scenario(name, scenario, passes, options):
+    """ Returns a result dict for every pass. """
+    fake = FakeDomain(DOMAIN, **scenario.domain)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=serve, args=(fake, sender), name="fakegoogle", daemon=True)
+    server.start()
+    base_url, imap_port = receiver.recv()
+    users = [fake.email(index) for index in range(fake.users)]
+    root = tempfile.mkdtemp(prefix="google-backup-benchmark-")
+    results = []
+    try:
+        for index, pass_name in enumerate(passes):
+            if index:
+                server_request(base_url, "/_bench/advance", "POST")
+            before = server_request(base_url, "/_bench/stats")
+            results_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_pass, args=(scenario, users, root, base_url, imap_port, options, index == 0, results_queue)
+            )
+            process.start()
+            result = wait_result(process, results_queue)
+            after = server_request(base_url, "/_bench/stats")
+            calls = {key: value - before.get(key, 0) for key, value in after.items() if value != before.get(key, 0)}
+            result.update({
+                "scenario": name,
+                "pass": pass_name,
+                "api_calls": {key: value for key, value in calls.items() if key not in NOT_CALLS},
+                "api_calls_total": sum(value for key, value in calls.items() if key not in NOT_CALLS),
+                "throttled": calls.get("throttled", 0),
+                "served_bytes": calls.get("bytes", 0),
+                "interrupted": calls.get("interrupted", 0),
+            })
+            results.append(result)
+            print(format_result(result))
+            sys.stdout.flush()
+    finally:
+        server.terminate()
+        server.join()
+        if options["keep"]:
+            print("Backups of %s are in %s" % (name, root))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def format_result(result):
+    lines = [
+        "%s %s: %s items, %s in %.2f s (%.1f items/s, %s/s), peak RSS %s, %s API calls (%s throttled)" % (
+            result["scenario"], result["pass"], result["items"], format_bytes(result["bytes"]), result["elapsed"],
+            result["items_per_second"], format_bytes(result["bytes_per_second"]), format_bytes(result["peak_rss"]),
+            result["api_calls_total"], result["throttled"]
+        )
+    ]
+    if result["interrupted"]:
+        lines.append("  served %s, %s downloads interrupted" % (format_bytes(result["served_bytes"]), result["interrupted"]))
+    if result["users_elapsed"] is not None:
+        lines.append("  listed %s users in %.2f s" % (result["users"], result["users_elapsed"]))
+    for key, value in sorted(result["api_calls"].items(), key=lambda call: -call[1]):
+        lines.append("  %8d %s" % (value, key))
+    if result["failed"]:
+        lines.append("  failed: %s" % ", ".join(result["failed"]))
+    return "\n".join(lines)
+
+
+def compare(results, baseline, tolerance):
+    """ Returns descriptions of regressions against baseline, a list of earlier results. """
+    previous = {(result["scenario"], result["pass"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result["scenario"], result["pass"]))
+        if old is None:
+            continue
+        for field in ("items_per_second", "bytes_per_second"):
+            if old[field] and result[field] < old[field] * (1 - tolerance):
+                regressions.append("%s %s: %s dropped from %.1f to %.1f" % (
+                    result["scenario"], result["pass"], field, old[field], result[field]))
+        for field in ("peak_rss", "api_calls_total", "served_bytes"):
+            if old[field] and result[field] > old[field] * (1 + tolerance):
+                regressions.append("%s %s: %s grew from %s to %s" % (
+                    result["scenario"], result["pass"], field, old[field], result[field]))
+    return regressions
+
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments["--list"]:
+        for name, scenario in sorted(SCENARIOS.items()):
+            print("%-10s %s (%s)" % (name, scenario.description, ", ".join(scenario.services)))
+        return 0
+    unknown = [name for name in arguments["<scenario>"] if name not in SCENARIOS]
+    if unknown:
+        print("Unknown scenario: %s" % ", ".join(unknown))
+        return 1
+
+    passes = ["initial", "incremental"] if arguments["--incremental"] else ["initial"]
+    options = {
+        "workers": int(arguments["--workers"]) if arguments["--workers"] else None,
+        "rate_limits": arguments["--rate-limits"],
+        "keep": arguments["--keep"],
+    }
+    results = []
+    for name in arguments["<scenario>"]:
+        scenario = SCENARIOS[name]
+        domain = dict(scenario.domain)
+        if arguments["--latency"] is not None:
+            domain["latency"] = float(arguments["--latency"])
+        if arguments["--throttle"] is not None:
+            domain["throttle"] = float(arguments["--throttle"])
+        if arguments["--drops"] is not None:
+            domain["interruptions"] = float(arguments["--drops"])
+        results.extend(run_scenario(name, scenario._replace(domain=domain), passes, options))
+
+    if arguments["--output"]:
+        with open(arguments["--output"], "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    failed = any(result["failed"] for result in results)
+    if arguments["--baseline"]:
+        with open(arguments["--baseline"]) as baseline:
+            regressions = compare(results, json.load(baseline), float(arguments["--tolerance"]) / 100)
+        for regression in regressions:
+            print("Regression: %s" % regression)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
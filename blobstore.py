@@ -0,0 +1,45 @@
+"""
+Content-addressed store for Drive file data shared between users.
+
+Blobs are keyed by the md5Checksum and fileSize reported in Drive metadata and stored as
+<root>/<first two hex digits>/<md5>-<size>. Per-user content/<id>.data entries are symlinks into the store,
+so a file held by many users is downloaded and stored only once.
+"""
+
+import os
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def key_for(item):
+        """ Returns (md5, size) for Drive metadata, or None if the item can't be content-addressed.
+            Native Google documents have no checksum and are always exported per user. """
+        md5 = item.get("md5Checksum")
+        size = item.get("fileSize")
+        if not md5 or size is None:
+            return None
+        return (md5.lower(), int(size))
+
+    def path(self, key):
+        md5, size = key
+        return "%s/%s/%s-%s" % (self.root, md5[:2], md5, size)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def prepare(self, key):
+        """ Creates the directory for a blob and returns the path it should be downloaded to. """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def link(self, key, target):
+        """ Atomically points target to the blob, replacing whatever was there before. """
+        temp_target = "%s.link-%s" % (target, os.getpid())
+        if os.path.lexists(temp_target):
+            os.unlink(temp_target)
+        os.symlink(self.path(key), temp_target)
+        os.replace(temp_target, target)
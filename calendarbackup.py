@@ -3,71 +3,236 @@ Downloads all Google Calendar entries using Calendar API.
 
 Only downloads calendars where user have owner access (read-write-manage). This potentially leads to duplicate downloads with shared calendars. However, typical calendars are very small,
 so the only issue comes with 10k daily API quota.
+
+The first run of each calendar is a full sync. Its nextSyncToken is saved to the run state as soon as the calendar is
+done, and later runs (including a rerun after an interruption) only fetch events changed since then. An expired
+token (410 Gone) falls back to a full sync of that calendar.
+
+Events are stored in a compressed, append-only log per calendar under <rootpath>/events (see eventlog.py).
 """
 
-import datetime
+import glob
 import json
+import os
+import re
 import time
 
+from apiclient.errors import HttpError
+
+from .eventlog import EventLog
 from .get_users import get_users
-from .helpers import BackupBase, get_logger, timeit
-from .settings import CALENDAR_IGNORE_USERS, DOMAIN
+from .helpers import BackupBase, execute_batch, execute_with_retry, get_logger, timeit
+from .settings import CALENDAR_COMPACTION_MIN_SIZE, CALENDAR_COMPACTION_RATIO, CALENDAR_IGNORE_USERS, DOMAIN
 
 SYSTEM = "calendar"
+SYNC_TOKEN_PREFIX = "sync_token:"
+
+# <calendar id>-<timestamp>-<page>[-deleted], as written by earlier versions
+LEGACY_PAGE_RE = re.compile(
+    r"^(?P<calendar_id>.+)-(?P<timestamp>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ)-(?P<page>\d+)(?P<deleted>-deleted)?$"
+)
 
 logger = get_logger(SYSTEM)
 
 
+class SyncTokenExpired(Exception):
+    pass
+
+
+def is_gone(err):
+    return isinstance(err, HttpError) and err.resp.status == 410
+
+
 class CalendarBackup(BackupBase):
     def __init__(self, user_email):
         super(CalendarBackup, self).__init__(SYSTEM, user_email)
+        self.service = None
+        self.event_logs = {}
+        self.total_entries = self.total_deleted = 0
+
+    def initialize_service(self):
+        if not os.path.exists(self.rootpath + "/events"):
+            os.mkdir(self.rootpath + "/events")
+            self.migrate_legacy_pages()
+
+    def event_log(self, calendar_id):
+        if calendar_id not in self.event_logs:
+            self.event_logs[calendar_id] = EventLog(self.rootpath + "/events", calendar_id)
+        return self.event_logs[calendar_id]
+
+    def migrate_legacy_pages(self):
+        """ Imports JSON page files written by earlier versions into the event logs, oldest first,
+            and moves them to <rootpath>/legacy. """
+        pages = []
+        for path in glob.glob(self.rootpath + "/*-*-*"):
+            matches = LEGACY_PAGE_RE.match(os.path.basename(path))
+            if matches:
+                pages.append((matches.group("timestamp"), int(matches.group("page")), matches, path))
+        if not pages:
+            return
+        self.logger.info("Importing %s legacy page files", len(pages))
+        os.makedirs(self.rootpath + "/legacy", exist_ok=True)
+        for _, _, matches, path in sorted(pages, key=lambda page: page[:2]):
+            with open(path) as page_file:
+                items = json.load(page_file)
+            event_log = self.event_log(matches.group("calendar_id"))
+            if matches.group("deleted"):
+                event_log.delete(items)
+            else:
+                event_log.append(items)
+            os.replace(path, "%s/legacy/%s" % (self.rootpath, os.path.basename(path)))
+        for event_log in self.event_logs.values():
+            event_log.save_index()
+
+    def load_sync_tokens(self):
+        sync_tokens = {
+            name[len(SYNC_TOKEN_PREFIX):]: value
+            for name, value in self.run_state.cursors().items() if name.startswith(SYNC_TOKEN_PREFIX)
+        }
+        if not sync_tokens and os.path.exists(self.rootpath + "/sync_tokens.json"):
+            # Written by earlier versions.
+            with open(self.rootpath + "/sync_tokens.json") as tokens_file:
+                sync_tokens = json.load(tokens_file)
+            for calendar_id, sync_token in sync_tokens.items():
+                self.save_sync_token(calendar_id, sync_token)
+            os.replace(self.rootpath + "/sync_tokens.json", self.rootpath + "/sync_tokens.json.migrated")
+        return sync_tokens
+
+    def save_sync_token(self, calendar_id, sync_token):
+        """ Saves a calendar's sync token; None removes it. """
+        self.run_state.set(SYNC_TOKEN_PREFIX + calendar_id, sync_token)
+        self.run_state.commit()
+
+    @timeit
+    def precheck(self):
+        """ Nothing has changed if the calendar list is the same and no calendar has events changed since
+            its sync token. Reads at most one event per calendar and saves nothing. """
+        sync_tokens = {
+            name[len(SYNC_TOKEN_PREFIX):]: value
+            for name, value in self.run_state.cursors().items() if name.startswith(SYNC_TOKEN_PREFIX)
+        }
+        if not sync_tokens:
+            return True
+        self.service = self.impersonate_user('https://www.googleapis.com/auth/calendar', 'calendar', 'v3')
+        calendars = execute_with_retry(
+            self.service.calendarList().list(minAccessRole='owner', maxResults=1000, showHidden=True, fields="items(id)"),
+            SYSTEM, "the calendar list", logger=self.logger
+        )
+        if {calendar.get("id") for calendar in calendars.get("items", [])} != set(sync_tokens):
+            return True
+        first_pages, errors = execute_batch(
+            {
+                calendar_id: self.service.events().list(
+                    calendarId=calendar_id, syncToken=sync_token, maxResults=1, fields="items(id)"
+                )
+                for calendar_id, sync_token in sync_tokens.items()
+            }, SYSTEM, "changed events", logger=self.logger
+        )
+        return bool(errors) or any(events.get("items") for events in first_pages.values())
+
+    def list_events(self, calendar_id, sync_token=None, page_token=None):
+        if sync_token:
+            return self.service.events().list(
+                calendarId=calendar_id, syncToken=sync_token, maxAttendees=500, pageToken=page_token
+            )
+        return self.service.events().list(calendarId=calendar_id, maxAttendees=500, pageToken=page_token)
+
+    def save_page(self, calendar_id, events):
+        items = events.get("items", [])
+        self.event_log(calendar_id).append(items)
+        deleted = sum(1 for item in items if item.get("status") == "cancelled")
+        self.total_entries += len(items) - deleted
+        self.total_deleted += deleted
+        self.progress.processed(len(items))
+
+    def sync_calendar(self, calendar_id, events, sync_token=None):
+        """ Saves the first page and fetches the rest. Returns nextSyncToken from the last page.
+
+            A full sync (no sync_token) also records deletions for events that are no longer in the calendar. """
+        event_log = self.event_log(calendar_id)
+        seen = set()
+        while True:
+            self.save_page(calendar_id, events)
+            seen.update(item.get("id") for item in events.get("items", []))
+            page_token = events.get('nextPageToken')
+            if not page_token:
+                if not sync_token:
+                    missing = event_log.live_ids() - seen
+                    event_log.delete(sorted(missing))
+                    self.total_deleted += len(missing)
+                if event_log.needs_compaction(CALENDAR_COMPACTION_RATIO, CALENDAR_COMPACTION_MIN_SIZE):
+                    event_log.compact()
+                event_log.save_index()
+                return events.get("nextSyncToken")
+            try:
+                events = execute_with_retry(
+                    self.list_events(calendar_id, sync_token, page_token), SYSTEM, "events of %s" % calendar_id,
+                    logger=self.logger
+                )
+            except HttpError as err:
+                if is_gone(err):
+                    raise SyncTokenExpired(calendar_id) from err
+                raise
 
     @timeit
     def run(self):
         self.logger.info("Starting")
         start = time.time()
+        sync_tokens = self.load_sync_tokens()
+
+        self.service = self.impersonate_user('https://www.googleapis.com/auth/calendar', 'calendar', 'v3')
+
+        calendars = execute_with_retry(
+            self.service.calendarList().list(minAccessRole='owner', maxResults=1000, showHidden=True), SYSTEM,
+            "the calendar list", logger=self.logger
+        )
+        calendar_ids = [calendar.get("id") for calendar in calendars.get("items", [])]
+        for calendar_id in set(sync_tokens) - set(calendar_ids):
+            self.save_sync_token(calendar_id, None)
+        failed = []
+        full_syncs = [calendar_id for calendar_id in calendar_ids if calendar_id not in sync_tokens]
+
+        # First page of every calendar in as few round trips as possible; with sync tokens that is usually everything.
+        first_pages, errors = execute_batch(
+            {calendar_id: self.list_events(calendar_id, sync_tokens.get(calendar_id))
+             for calendar_id in calendar_ids}, SYSTEM, "events", logger=self.logger
+        )
+        expired = [calendar_id for calendar_id, err in errors.items() if is_gone(err)]
+        for calendar_id, err in errors.items():
+            if not is_gone(err):
+                self.logger.error("Downloading events of %s failed: %r", calendar_id, err)
+                failed.append(calendar_id)
+
+        for calendar_id, events in first_pages.items():
+            try:
+                self.save_sync_token(calendar_id, self.sync_calendar(calendar_id, events, sync_tokens.get(calendar_id)))
+            except SyncTokenExpired:
+                expired.append(calendar_id)
+            except HttpError as err:
+                self.logger.error("Downloading events of %s failed: %r", calendar_id, err)
+                failed.append(calendar_id)
+
+        for calendar_id in expired:
+            self.logger.info("Sync token of %s has expired, running full sync", calendar_id)
+            full_syncs.append(calendar_id)
+            try:
+                events = execute_with_retry(
+                    self.list_events(calendar_id), SYSTEM, "events of %s" % calendar_id, logger=self.logger
+                )
+                self.save_sync_token(calendar_id, self.sync_calendar(calendar_id, events))
+            except (HttpError, SyncTokenExpired) as err:
+                self.logger.error("Downloading events of %s failed: %r", calendar_id, err)
+                failed.append(calendar_id)
+
+        # Failed calendars keep their old token, so that they are retried from the same point next time.
 
-        try:
-            last_update = open(self.rootpath + "/last_update").read()
-        except IOError:
-            last_update = None
-
-        current_timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-
-        service = self.impersonate_user('https://www.googleapis.com/auth/calendar', 'calendar', 'v3')
-
-        calendars = service.calendarList().list(minAccessRole='owner', maxResults=1000, showHidden=True).execute()
-        total_entries = 0
-        for calendar in calendars.get("items", []):
-            page_token = None
-            page_id = 0
-            while True:
-                events = service.events().list(
-                    calendarId=calendar.get("id"),
-                    timeMin='2000-01-01T00:00:01Z',
-                    updatedMin=last_update,
-                    maxAttendees=500,
-                    pageToken=page_token
-                ).execute()
-                if len(events.get("items", [])) > 0:
-                    json.dump(
-                        events.get("items"),
-                        open("%s/%s-%s-%s" % (self.rootpath, calendar.get("id"), current_timestamp, page_id), "w")
-                    )
-                    total_entries += len(events.get("items"))
-                page_token = events.get('nextPageToken')
-                if not page_token:
-                    break
-                page_id += 1
-
-        open(self.rootpath + "/last_update", "w").write(current_timestamp)
         end = time.time()
         elapsed = end - start
         self.logger.info(
-            "Finished in %.2f seconds. updateMin=%s, saved %s. Downloaded %s entries", elapsed, last_update,
-            current_timestamp, total_entries
+            "Finished in %.2f seconds. %s calendars (%s full syncs, %s failed). Downloaded %s entries, %s deleted", elapsed,
+            len(calendar_ids), len(full_syncs), len(failed), self.total_entries, self.total_deleted
         )
-        return total_entries
+        return self.total_entries
 
 
 def main():
@@ -81,6 +246,9 @@ def main():
             continue
         logger.info("Status: %s/%s", index + 1, len(users))
         calendarbackup = CalendarBackup(user)
+        if not calendarbackup.has_changes():
+            calendarbackup.logger.info("No changes since the last run")
+            continue
         calendarbackup.initialize()
         total_entries += calendarbackup.run()
     logger.info("Finished downloading %s entries for %s users", total_entries, len(users))
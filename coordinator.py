@@ -0,0 +1,209 @@
+"""
+Shares a backup run between several backup.py processes, on one host or many.
+
+Users are split into shards by a hash of their email address (shard_of), so that every host backs up the same
+users, and their datasets stay local to it, run after run. backup.py --shard=<k/n> runs the jobs of shard k.
+
+With COORDINATOR_DATABASE set, jobs are claimed as leases in a sqlite database instead of being taken from a local
+queue, so that any number of processes can work on the same shard and run (--run, by default the date):
+
+- Each process claims the largest pending job of its shard, and renews the leases it holds every
+  COORDINATOR_HEARTBEAT_INTERVAL seconds from a heartbeat thread.
+- A lease without a heartbeat for COORDINATOR_LEASE_SECONDS belongs to a process that died or hung. Another
+  process of the shard takes the job over. After COORDINATOR_MAX_ATTEMPTS attempts, the job is given up and
+  marked failed.
+- Finished jobs keep their status, so a process started again later in the same run only does what is left.
+
+The database must be on a filesystem with working sqlite locking, for example a local disk of the host that runs
+all processes, or one every host reaches over a filesystem that supports POSIX locks.
+"""
+
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .helpers import get_logger
+from .settings import COORDINATOR_HEARTBEAT_INTERVAL, COORDINATOR_LEASE_SECONDS, COORDINATOR_MAX_ATTEMPTS
+
+logger = get_logger("coordinator")
+
+
+def shard_of(user, shards):
+    """ Shard index of user, the same in every process and on every host (unlike hash()). """
+    digest = hashlib.sha1(user.lower().encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def parse_shard(value):
+    """ Parses "k/n" into (k, n). Raises ValueError unless 0 <= k < n. """
+    index, _, shards = value.partition("/")
+    index, shards = int(index), int(shards)
+    if not 0 <= index < shards:
+        raise ValueError("Shard %s is not between 0 and %s" % (index, shards - 1))
+    return (index, shards)
+
+
+def worker_name():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+class Coordinator:
+    """ Leases of one run and shard in the coordinator database. The connection is opened lazily in each process. """
+
+    def __init__(self, path, run, shard=(0, 1), worker=None):
+        self.path = path
+        self.run = run
+        self.shard = "%s/%s" % shard
+        self.worker = worker or worker_name()
+        self.lock = threading.RLock()
+        self.db = None
+        self.pid = None
+        self.stopped = threading.Event()
+        self.heartbeats = None
+
+    def connection(self):
+        if self.db is None or self.pid != os.getpid():
+            # Transactions are explicit: claims must read and update in a single BEGIN IMMEDIATE.
+            self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self.pid = os.getpid()
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS leases (
+                    run TEXT, service TEXT, user TEXT, shard TEXT, size INTEGER, status TEXT, worker TEXT,
+                    expires REAL, attempts INTEGER, error TEXT, updated REAL, PRIMARY KEY (run, service, user)
+                )
+                """
+            )
+        return self.db
+
+    def transaction(self, func):
+        """ Runs func(db) in an immediate transaction, which holds the write lock from the start. """
+        with self.lock:
+            db = self.connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(db)
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        return result
+
+    def add_jobs(self, jobs):
+        """ Adds (service, user, size) jobs to the run. Jobs added by an earlier process keep their status. """
+        now = time.time()
+        rows = [(self.run, service, user, self.shard, size, now) for service, user, size in jobs]
+        self.transaction(
+            lambda db: db.executemany(
+                "INSERT OR IGNORE INTO leases (run, service, user, shard, size, status, attempts, updated) "
+                "VALUES (?, ?, ?, ?, ?, 'pending', 0, ?)", rows
+            )
+        )
+
+    def claim(self, services):
+        """ Leases the largest claimable job of services: a pending one, or one whose lease expired. Returns
+            (service, user, size), or None if there is nothing to claim. """
+        now = time.time()
+        marks = ",".join("?" * len(services))
+
+        def claim_job(db):
+            abandoned = db.execute(
+                "SELECT service, user, worker FROM leases WHERE run = ? AND shard = ? AND status = 'running' "
+                "AND expires < ? AND attempts >= ?", (self.run, self.shard, now, COORDINATOR_MAX_ATTEMPTS)
+            ).fetchall()
+            db.executemany(
+                "UPDATE leases SET status = 'failed', error = ?, worker = NULL, updated = ? "
+                "WHERE run = ? AND service = ? AND user = ?",
+                [("lease expired %s times" % COORDINATOR_MAX_ATTEMPTS, now, self.run, service, user)
+                 for service, user, _ in abandoned]
+            )
+            row = db.execute(
+                "SELECT service, user, size, worker FROM leases WHERE run = ? AND shard = ? AND service IN (%s) "
+                "AND (status = 'pending' OR (status = 'running' AND expires < ?)) ORDER BY size DESC LIMIT 1" % marks,
+                (self.run, self.shard) + tuple(services) + (now, )
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "UPDATE leases SET status = 'running', worker = ?, expires = ?, attempts = attempts + 1, "
+                    "updated = ? WHERE run = ? AND service = ? AND user = ?",
+                    (self.worker, now + COORDINATOR_LEASE_SECONDS, now, self.run, row[0], row[1])
+                )
+            return (abandoned, row)
+
+        abandoned, row = self.transaction(claim_job)
+        for service, user, worker in abandoned:
+            logger.error(
+                "Giving up %s %s: the lease of %s expired after %s attempts", service, user, worker,
+                COORDINATOR_MAX_ATTEMPTS
+            )
+        if row is None:
+            return None
+        service, user, size, previous = row
+        if previous:
+            logger.warning("Taking over %s %s from %s, whose lease expired", service, user, previous)
+        return (service, user, size)
+
+    def finish(self, service, user, status, error=None):
+        """ Records the status of a finished job, unless another worker took it over in the meantime. """
+        now = time.time()
+        updated = self.transaction(
+            lambda db: db.execute(
+                "UPDATE leases SET status = ?, error = ?, expires = NULL, updated = ? "
+                "WHERE run = ? AND service = ? AND user = ? AND worker = ? AND status = 'running'",
+                (status, error, now, self.run, service, user, self.worker)
+            ).rowcount
+        )
+        if not updated:
+            logger.warning("Lease of %s %s was taken over by another worker; %s is not recorded", service, user, status)
+
+    def heartbeat(self):
+        """ Renews every lease this worker holds. """
+        now = time.time()
+        self.transaction(
+            lambda db: db.execute(
+                "UPDATE leases SET expires = ?, updated = ? WHERE run = ? AND worker = ? AND status = 'running'",
+                (now + COORDINATOR_LEASE_SECONDS, now, self.run, self.worker)
+            )
+        )
+
+    def leased_elsewhere(self):
+        """ Number of jobs of the shard that other workers hold leases for. They may still expire and become
+            claimable. """
+        with self.lock:
+            return self.connection().execute(
+                "SELECT COUNT(*) FROM leases WHERE run = ? AND shard = ? AND status = 'running' AND worker != ?",
+                (self.run, self.shard, self.worker)
+            ).fetchone()[0]
+
+    def statuses(self):
+        """ Returns {status: number of jobs} of the shard in this run, including other workers' jobs. """
+        with self.lock:
+            rows = self.connection().execute(
+                "SELECT status, COUNT(*) FROM leases WHERE run = ? AND shard = ? GROUP BY status",
+                (self.run, self.shard)
+            ).fetchall()
+        return dict(rows)
+
+    def send_heartbeats(self):
+        while not self.stopped.wait(COORDINATOR_HEARTBEAT_INTERVAL):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as err:
+                # The leases expire if this keeps failing, and other workers take the jobs over.
+                logger.error("Heartbeat failed: %s", err)
+
+    def start(self):
+        logger.info("Worker %s joining run %s, shard %s", self.worker, self.run, self.shard)
+        self.stopped.clear()
+        self.heartbeats = threading.Thread(target=self.send_heartbeats, name="coordinator-heartbeat", daemon=True)
+        self.heartbeats.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.heartbeats is not None:
+            self.heartbeats.join()
+            self.heartbeats = None
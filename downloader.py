@@ -0,0 +1,171 @@
+"""
+Streams downloads straight to disk in fixed size chunks.
+
+Memory use per download is bounded by the chunk size, and the total amount of data read from the network
+but not yet written to disk is capped process-wide by BYTES_IN_FLIGHT. Downloads of services in
+ASYNC_HTTP_SERVICES go through the shared connection pool of asynchttp.py.
+
+Downloads with a known md5 are resumable: the data is kept in <path>.part when a download fails, and the next
+attempt asks only for the rest with a Range request. The whole file is checked against the md5 at the end.
+"""
+
+import fcntl
+import hashlib
+import http.client
+import os
+import re
+import tempfile
+import threading
+import urllib.error
+
+from .asynchttp import urlopen
+from .settings import DRIVE_DOWNLOAD_CHUNK_SIZE, DRIVE_DOWNLOAD_TIMEOUT, DRIVE_MAX_BYTES_IN_FLIGHT
+
+
+class ByteBudget:
+    """ Counting semaphore measured in bytes. """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        amount = min(amount, self.limit)
+        with self.condition:
+            while self.used + amount > self.limit:
+                self.condition.wait()
+            self.used += amount
+        return amount
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+
+BYTES_IN_FLIGHT = ByteBudget(DRIVE_MAX_BYTES_IN_FLIGHT)
+
+
+PART_SUFFIX = ".part"
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-\d+/(\d+|\*)$")
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def copy_response(response, target, digest, chunk_size, budget):
+    """ Appends the response body to target. Returns the number of bytes written.
+
+        Raises http.client.IncompleteRead if the connection closed before Content-Length bytes were read;
+        http.client returns a short body without an error then. """
+    written = 0
+    while True:
+        reserved = budget.acquire(chunk_size)
+        try:
+            chunk = response.read(reserved)
+            if not chunk:
+                break
+            target.write(chunk)
+            digest.update(chunk)
+            written += len(chunk)
+        finally:
+            budget.release(reserved)
+    expected = response.headers.get("Content-Length")
+    if expected is not None and written < int(expected):
+        raise http.client.IncompleteRead(b"", int(expected) - written)
+    return written
+
+
+def open_part(path):
+    """ Opens <path>.part for reading and appending, locked against other downloads of the same path.
+        Returns None if another download holds the lock. """
+    fd = os.open(path + PART_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return os.fdopen(fd, "r+b")
+
+
+def hash_part(part, chunk_size):
+    """ Returns the md5 of the data already in part and leaves part positioned at its end. """
+    digest = hashlib.md5()
+    part.seek(0)
+    while True:
+        chunk = part.read(chunk_size)
+        if not chunk:
+            return digest
+        digest.update(chunk)
+
+
+def is_resumed(response, offset):
+    """ True if response continues the download from offset, False if it is the whole file. """
+    if response.status != 206:
+        return False
+    match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range") or "")
+    if not match or int(match.group(1)) != offset:
+        raise ChecksumMismatch("Unexpected Content-Range %r for offset %s" % (response.headers.get("Content-Range"), offset))
+    return True
+
+
+def stream_to_file(
+    url, path, headers=None, chunk_size=DRIVE_DOWNLOAD_CHUNK_SIZE, budget=BYTES_IN_FLIGHT, md5=None, service=None
+):
+    """ Downloads url to path, which is written only after the download completed. Returns the size of the file.
+
+        If md5 is given, data is written to <path>.part, which is kept if the download fails, and the next call
+        continues from where it stopped with a Range request. The file is renamed into place only if the data
+        matches md5; otherwise the partial download is discarded.
+
+        Raises urllib.error.HTTPError for non-2xx responses and ChecksumMismatch for corrupted data. """
+    headers = headers or {}
+    part = open_part(path) if md5 else None
+    if part is None:
+        return download_to_temp(url, path, headers, chunk_size, budget, md5, service)
+    with part:
+        try:
+            offset = os.fstat(part.fileno()).st_size
+            digest = hash_part(part, chunk_size) if offset else hashlib.md5()
+            request_headers = dict(headers, Range="bytes=%s-" % offset) if offset else headers
+            with urlopen(service, url, request_headers, DRIVE_DOWNLOAD_TIMEOUT) as response:
+                if offset and not is_resumed(response, offset):
+                    part.seek(0)
+                    part.truncate()
+                    digest = hashlib.md5()
+                copy_response(response, part, digest, chunk_size, budget)
+            part.flush()
+        except urllib.error.HTTPError as err:
+            if err.code != 416 or not offset:
+                raise
+            # Nothing left to download: the part is either complete or longer than the file.
+            if digest.hexdigest() != md5.lower():
+                os.unlink(path + PART_SUFFIX)
+                raise ChecksumMismatch("%s: partial download of %s bytes does not match" % (url, offset)) from err
+        except ChecksumMismatch:
+            os.unlink(path + PART_SUFFIX)
+            raise
+        if digest.hexdigest() != md5.lower():
+            os.unlink(path + PART_SUFFIX)
+            raise ChecksumMismatch("%s: expected md5 %s, got %s" % (url, md5, digest.hexdigest()))
+        os.replace(path + PART_SUFFIX, path)
+        return os.fstat(part.fileno()).st_size
+
+
+def download_to_temp(url, path, headers, chunk_size, budget, md5, service):
+    """ Non-resumable download through a temporary file in the same directory. """
+    directory, filename = os.path.split(path)
+    digest = hashlib.md5()
+    fd, temp_path = tempfile.mkstemp(prefix=".%s." % filename, suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as target, urlopen(service, url, headers, DRIVE_DOWNLOAD_TIMEOUT) as response:
+            written = copy_response(response, target, digest, chunk_size, budget)
+        if md5 and digest.hexdigest() != md5.lower():
+            raise ChecksumMismatch("%s: expected md5 %s, got %s" % (url, md5, digest.hexdigest()))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return written
@@ -1,35 +1,86 @@
 """
 Downloads files from Google Drive
+
+The first run lists all files owned by the user. Later runs read the Drive Changes feed from the saved
+change id onwards. A per-user state index (file id -> md5Checksum, version, modifiedDate, local path) is kept
+in the run state database, so files with unchanged content are never downloaded again. Files that are deleted,
+trashed or no longer owned by the user are moved to content/deleted.
+
+Native Google documents are exported in every format configured in DRIVE_EXPORT_FORMATS, on a separate pool of
+DRIVE_EXPORT_WORKERS threads per user and at most DRIVE_EXPORT_CONCURRENCY exports per process. Exports are
+cached by (file id, revision, format): a document is exported again only when its content changed, not when
+sharing or comments bump its version.
+
+Listing runs in its own thread, in pages of PAGE_SIZE files with only FILE_FIELDS, and feeds a bounded queue of
+files, so that the next pages are fetched while earlier files download. State and the metadata of finished files
+(content/<id>.json) are written after every page together with the page token, once every file listed before it
+is done, so an interrupted run continues from the page it stopped at.
 """
 
-import datetime
+import collections
+import glob
+import http.client
 import json
-import logging
-import logging.handlers
 import os
+import queue
+import threading
 import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 
-import httplib
-
+from .blobstore import BlobStore
+from .downloader import PART_SUFFIX, ChecksumMismatch, stream_to_file
 from .get_users import get_users
-from .helpers import BackupBase, get_logger
-from .settings import DOMAIN
+from .helpers import BackupBase, call_with_retry, execute_with_retry, get_logger, timeit
+from .metrics import DOWNLOAD_BYTES
+from .settings import (
+    DOMAIN, DRIVE_BLOBSTORE_PATH, DRIVE_DOWNLOAD_WORKERS, DRIVE_EXPORT_CONCURRENCY, DRIVE_EXPORT_FORMATS,
+    DRIVE_EXPORT_WORKERS, DRIVE_LISTING_QUEUE_SIZE
+)
 
 SYSTEM = "drive"
+# Largest page size files.list and changes.list accept
+PAGE_SIZE = 1000
+# File resource fields used here and kept in content/<id>.json
+FILE_FIELDS = (
+    "id,title,description,originalFilename,fileExtension,mimeType,fileSize,md5Checksum,version,headRevisionId,"
+    "createdDate,modifiedDate,owners(emailAddress,displayName),parents(id,isRoot),labels(trashed,starred),shared,"
+    "downloadUrl,exportLinks"
+)
+# Downloads and exports queued on top of the running ones; the listing waits in the work queue beyond that
+MAX_QUEUED_DOWNLOADS = (DRIVE_DOWNLOAD_WORKERS + DRIVE_EXPORT_WORKERS) * 2
+METADATA_ENCODER = json.JSONEncoder()
+# Suffixes of additional export formats, content/<id>.<extension>
+EXPORT_EXTENSIONS = sorted({
+    extension for formats in DRIVE_EXPORT_FORMATS.values() if formats for _, extension in formats[1:]
+})
+EXPORT_SLOTS = threading.BoundedSemaphore(DRIVE_EXPORT_CONCURRENCY)
+
 logger = get_logger(SYSTEM)
 
 
+def export_revision(item):
+    """ Revision of a document's content. Docs have no headRevisionId, and unlike version, modifiedDate does not
+        change when a document is only shared or commented. """
+    return item.get("headRevisionId") or item.get("modifiedDate") or item.get("version")
+
+
+def export_key(file_id, mimetype):
+    return "%s|%s" % (file_id, mimetype)
+
+
 class DriveBackup(BackupBase):
     def __init__(self, user_email):
         super().__init__(SYSTEM, user_email)
-
-    FORMAT_MAPPINGS = {
-        "application/vnd.google-apps.document": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        "application/vnd.google-apps.spreadsheet": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        "application/vnd.google-apps.presentation": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-        "application/vnd.google-apps.form": None,
-        "application/vnd.google-apps.folder": None,
-    }
+        self.blobstore = None
+        if DRIVE_BLOBSTORE_PATH:
+            self.blobstore = BlobStore(DRIVE_BLOBSTORE_PATH)
+        self.state = None
+        self.changed_files = {}
+        self.exports = {}
+        self.changed_exports = {}
+        self.metadata = {}
+        self.next_change_id = None
 
     def initialize_service(self):
         if not os.path.exists(f"{self.rootpath}/content"):
@@ -37,89 +88,440 @@ class DriveBackup(BackupBase):
         if not os.path.exists(f"{self.rootpath}/content/deleted"):
             os.mkdir(f"{self.rootpath}/content/deleted")
 
-    def run(self):
-        self.logger.info("Starting")
-
-        service = self.impersonate_user('https://www.googleapis.com/auth/drive.readonly', 'drive', 'v2')
-        start = time.time()
-        total_processed = total_messages = total_skipped = 0
+    def load_state(self):
+        self.exports = self.run_state.items("export")
+        files = self.run_state.items("file")
+        largest_change_id = self.run_state.get("largest_change_id")
+        if not files and largest_change_id is None:
+            return self.migrate_state()
+        return {"largest_change_id": largest_change_id, "files": files}
 
+    def migrate_state(self):
+        """ Imports <rootpath>/state.json written by earlier versions, or builds the index from content/. """
         try:
-            with open(f"{self.rootpath}/last_fetch_time") as last_fetch_file:
-                last_fetch_time = last_fetch_file.read()
+            with open(f"{self.rootpath}/state.json") as state_file:
+                state = json.load(state_file)
+            os.replace(f"{self.rootpath}/state.json", f"{self.rootpath}/state.json.migrated")
         except FileNotFoundError:
-            last_fetch_time = "2012-01-01T00:00:00"
-        highest_modification_time = datetime.datetime.utcnow().isoformat().split(".")[0]
+            state = {"largest_change_id": None, "files": self.seed_state_from_content()}
+        self.run_state.set_items("file", state["files"])
+        self.run_state.set("largest_change_id", state["largest_change_id"])
+        self.run_state.commit()
+        return state
 
-        query = "modifiedDate > '%s' and '%s' in owners" % (last_fetch_time, self.user_email)
-        nextpagetoken = None
+    @timeit
+    def precheck(self):
+        """ Nothing has changed if the largest change id is the one the last complete run reached. """
+        largest_change_id = self.run_state.get("largest_change_id")
+        if largest_change_id is None or self.run_state.get("changes_page_token"):
+            return True
+        service = self.impersonate_user('https://www.googleapis.com/auth/drive.readonly', 'drive', 'v2')
+        about = self.execute(service.about().get(fields="largestChangeId"), "the change id")
+        return int(about["largestChangeId"]) != largest_change_id
 
-        while True:
-            files = {}
-            for retrycount in range(0, 4):
-                try:
-                    files = service.files().list(q=query, pageToken=nextpagetoken).execute()
-                    break
-                except httplib.BadStatusLine:
-                    time.sleep(retrycount)
-                    continue
-                except Exception as err:  # pylint: disable=broad-except
-                    self.logger.warning("Unhandled exception %r while downloading the file list", err)
-                    time.sleep(retrycount)
-                    continue
-                self.logger.warning("Fetching file list failed. Dropping last fetch time back to %s", last_fetch_time)
+    def set_file_state(self, file_id, entry):
+        """ Updates the state of a file; None removes it. Written by the next save_state(). """
+        if entry is None:
+            self.state["files"].pop(file_id, None)
+        else:
+            self.state["files"][file_id] = entry
+        self.changed_files[file_id] = entry
+
+    def set_export(self, key, revision):
+        """ Records the revision an export_key() was exported at; None removes it. """
+        if revision is None:
+            self.exports.pop(key, None)
+        else:
+            self.exports[key] = revision
+        self.changed_exports[key] = revision
+
+    def save_state(self, **cursors):
+        self.write_metadata()
+        self.run_state.set_items("file", self.changed_files)
+        self.run_state.set_items("export", self.changed_exports)
+        self.changed_files = {}
+        self.changed_exports = {}
+        for name, value in cursors.items():
+            self.run_state.set(name, value)
+        self.run_state.commit()
+
+    def seed_state_from_content(self):
+        """ Builds the state index from metadata saved by earlier versions, so upgrading doesn't re-download everything. """
+        files = {}
+        for metadata_path in glob.glob(f"{self.rootpath}/content/*.json"):
+            data_path = metadata_path[:-len(".json")] + ".data"
+            if not os.path.exists(data_path):
+                continue
+            try:
+                with open(metadata_path) as metadata_file:
+                    item = json.load(metadata_file)
+            except ValueError:
+                continue
+            files[item["id"]] = self.state_entry(item, data_path)
+        return files
+
+    @staticmethod
+    def state_entry(item, path):
+        return {
+            "md5Checksum": item.get("md5Checksum"),
+            "version": item.get("version"),
+            "modifiedDate": item.get("modifiedDate"),
+            "path": path,
+        }
 
+    def is_unchanged(self, item):
+        entry = self.state["files"].get(item["id"])
+        if not entry or not entry.get("path") or not os.path.exists(entry["path"]):
+            return False
+        if item.get("md5Checksum"):
+            return entry.get("md5Checksum") == item["md5Checksum"]
+        return entry.get("version") == item.get("version")
+
+    def is_owned(self, item):
+        return any(owner.get("emailAddress") == self.user_email for owner in item.get("owners", []))
+
+    def execute(self, request, description):
+        return execute_with_retry(request, SYSTEM, description, logger=self.logger)
+
+    def list_files(self, service, nextpagetoken=None):
+        """ Full listing, starting from nextpagetoken when resuming. Yields (page, token of the next page) with pages
+            of (file id, item). The token is "" after the last page.
+
+            Listed ids are kept in the run state, so that a resumed listing still finds the files that disappeared. """
+        query = "'%s' in owners and trashed = false" % self.user_email
+        fields = "nextPageToken,items(%s)" % FILE_FIELDS
+        while nextpagetoken != "":
+            files = self.execute(
+                service.files().list(q=query, pageToken=nextpagetoken, maxResults=PAGE_SIZE, fields=fields),
+                "the file list"
+            )
+            page = []
             for item in files.get("items", []):
-                mimetype = item.get("mimeType")
-                format_mapping = DriveBackup.FORMAT_MAPPINGS.get(mimetype, False)
-                total_messages += 1
-                if format_mapping is None:
-                    self.logger.debug("Skipping %s: mime %s is marked as non-downloadable" % (item.get("id"), mimetype))
-                    json.dump(item, open("%s/content/%s.json" % (self.rootpath, item.get("id")), "w"))
-                    total_skipped += 1
-                    continue
-                if format_mapping:
-                    download_url = item.get("exportLinks", {}).get(DriveBackup.FORMAT_MAPPINGS.get(mimetype))
-                else:
-                    download_url = item.get("downloadUrl")
-                if not download_url:
-                    self.logger.debug("Skipping %s: no valid download url found. MIME: %s", item.get("id"), mimetype)
-                    json.dump(item, open("%s/content/%s.json" % (self.rootpath, item.get("id")), "w"))
-                    total_skipped += 1
-                    continue
-                for retrycount in range(0, 4):
-                    try:
-                        resp, content = service._http.request(download_url)
-                        if resp.status == 200:
-                            open("%s/content/%s.data" % (self.rootpath, item.get("id")), "w").write(content)
-                            json.dump(item, open("%s/content/%s.json" % (self.rootpath, item.get("id")), "w"))
-                            total_processed += 1
-                            # For some reason, this helps with random memory leak:
-                            del content
-                            del resp
-                            break
-                        else:
-                            logging.warning("Downloading %s for user %s failed", item.get("id"), self.user_email)
-                            time.sleep(retrycount)
-                            continue
-                    except httplib.BadStatusLine:
-                        time.sleep(retrycount)
+                page.append((item["id"], item))
+            self.run_state.set_items("seen", {file_id: True for file_id, _ in page})
+            nextpagetoken = files.get("nextPageToken") or ""
+            yield (page, nextpagetoken)
 
-            nextpagetoken = files.get("nextPageToken")
+    def list_changes(self, service, nextpagetoken=None):
+        """ Incremental listing from the Changes feed, starting from nextpagetoken when resuming.
+            Yields (page, token of the next page) with pages of (file id, item), with None for files that are
+            deleted, trashed or no longer owned. Runs in the listing thread, so whether the file is in the state
+            is left to the consumer. """
+        fields = "nextPageToken,largestChangeId,items(fileId,deleted,file(%s))" % FILE_FIELDS
+        while True:
+            changes = self.execute(
+                service.changes().list(
+                    startChangeId=self.state["largest_change_id"] + 1, includeDeleted=True, pageToken=nextpagetoken,
+                    maxResults=PAGE_SIZE, fields=fields
+                ), "the change list"
+            )
+            page = []
+            for change in changes.get("items", []):
+                item = change.get("file")
+                if change.get("deleted") or not item or item.get("labels", {}).get("trashed") or not self.is_owned(item):
+                    item = None
+                page.append((change["fileId"], item))
+            nextpagetoken = changes.get("nextPageToken")
+            if not nextpagetoken:
+                self.next_change_id = int(changes["largestChangeId"])
+            yield (page, nextpagetoken)
             if not nextpagetoken:
                 break
 
-        with open(f"{self.rootpath}/last_fetch_time", "w") as last_fetch_file:
-            last_fetch_file.write(highest_modification_time)
+    def move_to_deleted(self, file_id):
+        self.metadata.pop(file_id, None)
+        for suffix in ["data", "json"] + EXPORT_EXTENSIONS:
+            path = "%s/content/%s.%s" % (self.rootpath, file_id, suffix)
+            if os.path.lexists(path):
+                os.replace(path, "%s/content/deleted/%s.%s" % (self.rootpath, file_id, suffix))
+        part_path = "%s/content/%s.data%s" % (self.rootpath, file_id, PART_SUFFIX)
+        if os.path.exists(part_path):
+            os.unlink(part_path)
+        for key in [key for key in self.exports if key.startswith(file_id + "|")]:
+            self.set_export(key, None)
+        self.set_file_state(file_id, None)
+
+    def produce(self, pages, work, stop):
+        """ Listing thread. Puts ("file", (file id, item)) for every file and ("page", token of the next page) after
+            each page to work, then ("done", None), or ("failed", exception) if listing fails. """
+        try:
+            for page, nextpagetoken in pages:
+                for entry in page:
+                    if not self.put_work(work, ("file", entry), stop):
+                        return
+                if not self.put_work(work, ("page", nextpagetoken), stop):
+                    return
+            entry = ("done", None)
+        except Exception as err:  # pylint: disable=broad-except
+            entry = ("failed", err)
+        self.put_work(work, entry, stop)
+
+    @staticmethod
+    def put_work(work, entry, stop):
+        """ Blocks while the queue is full. Returns False if the consumer has stopped. """
+        while not stop.is_set():
+            try:
+                work.put(entry, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def process_file(self, file_id, item, totals):
+        """ Handles a listed file that needs no download. Returns ("file", download url) or ("export", pending exports
+            from pending_exports()) for files that do, None if the file is done. """
+        if item is None:
+            self.move_to_deleted(file_id)
+            totals["deleted"] += 1
+            return None
+        mimetype = item.get("mimeType")
+        formats = DRIVE_EXPORT_FORMATS.get(mimetype, False)
+        totals["listed"] += 1
+        if formats is None:
+            self.logger.debug("Skipping %s: mime %s is marked as non-downloadable" % (file_id, mimetype))
+            self.save_metadata(item)
+            totals["skipped"] += 1
+            return None
+        if formats:
+            exports = self.pending_exports(item, formats)
+            if exports:
+                return ("export", exports)
+            unchanged = any(export_key(file_id, export_mimetype) in self.exports for export_mimetype, _ in formats)
+        else:
+            unchanged = self.is_unchanged(item)
+        if unchanged:
+            self.save_metadata(item)
+            self.set_file_state(file_id, self.state_entry(item, "%s/content/%s.data" % (self.rootpath, file_id)))
+            totals["unchanged"] += 1
+            return None
+        download_url = item.get("downloadUrl")
+        if formats or not download_url:
+            self.logger.debug("Skipping %s: no valid download url found. MIME: %s", file_id, mimetype)
+            self.save_metadata(item)
+            totals["skipped"] += 1
+            return None
+        return ("file", download_url)
+
+    def export_path(self, file_id, index, extension):
+        """ The first format is stored as content/<id>.data, like downloaded files. """
+        return "%s/content/%s.%s" % (self.rootpath, file_id, "data" if index == 0 else extension)
+
+    def pending_exports(self, item, formats):
+        """ Returns [(export mime type, url, path)] for formats that are not exported at the current revision. """
+        revision = export_revision(item)
+        exports = []
+        for index, (mimetype, extension) in enumerate(formats):
+            key = export_key(item["id"], mimetype)
+            path = self.export_path(item["id"], index, extension)
+            url = item.get("exportLinks", {}).get(mimetype)
+            if not url or (self.exports.get(key) == revision and os.path.exists(path)):
+                continue
+            if index == 0 and key not in self.exports and self.is_unchanged(item):
+                # Exported by an earlier version at the same version; only the cache entry is missing.
+                self.set_export(key, revision)
+                continue
+            exports.append((mimetype, url, path))
+        return exports
+
+    def harvest(self, inflight, cursor, totals, limit=0):
+        """ Records finished downloads and exports in listing order, and saves a page token once every file listed
+            before it is done. Waits for the oldest download while more than limit are in flight. """
+        while inflight:
+            kind, value, download = inflight[0]
+            if kind == "page":
+                inflight.popleft()
+                self.save_state(**{cursor: value})
+                continue
+            if kind == "removed":
+                inflight.popleft()
+                if value in self.state["files"]:
+                    self.process_file(value, None, totals)
+                continue
+            if not download.done() and sum(1 for entry in inflight if entry[0] in ("file", "export")) <= limit:
+                return
+            inflight.popleft()
+            self.record_download(kind, value, download.result(), totals)
+
+    def record_download(self, kind, item, result, totals):
+        if kind == "export":
+            status, exported = result
+            for mimetype in exported:
+                self.set_export(export_key(item["id"], mimetype), export_revision(item))
+        else:
+            status = result
+        if status is None:
+            totals["failed"] += 1
+            self.progress.missed(1)
+            return
+        totals["processed"] += 1
+        if status in ("deduplicated", "exported"):
+            totals[status] += 1
+        self.save_metadata(item)
+        self.set_file_state(item["id"], self.state_entry(item, "%s/content/%s.data" % (self.rootpath, item["id"])))
+
+    @timeit
+    def run(self):
+        self.logger.info("Starting")
+
+        service = self.impersonate_user('https://www.googleapis.com/auth/drive.readonly', 'drive', 'v2')
+        start = time.time()
+        totals = collections.Counter()
+        executor = ThreadPoolExecutor(max_workers=DRIVE_DOWNLOAD_WORKERS)
+        exporter = ThreadPoolExecutor(max_workers=DRIVE_EXPORT_WORKERS)
+
+        self.state = self.load_state()
+        if self.state["largest_change_id"] is None:
+            cursor = "listing_page_token"
+            self.next_change_id = self.run_state.get("listing_change_id")
+            if self.next_change_id is None:
+                # Read the change id before listing, so that changes made during the listing are picked up next time.
+                about = self.execute(service.about().get(fields="largestChangeId"), "the change id")
+                self.next_change_id = int(about["largestChangeId"])
+                self.run_state.clear_items("seen")
+                self.save_state(listing_change_id=self.next_change_id, listing_page_token=None)
+            else:
+                self.logger.info("Resuming an interrupted listing")
+            pages = self.list_files(service, self.run_state.get(cursor))
+        else:
+            cursor = "changes_page_token"
+            pages = self.list_changes(service, self.run_state.get(cursor))
+
+        # Listing runs ahead of the downloads, up to DRIVE_LISTING_QUEUE_SIZE files.
+        work = queue.Queue(DRIVE_LISTING_QUEUE_SIZE)
+        stop = threading.Event()
+        producer = threading.Thread(target=self.produce, args=(pages, work, stop), name="drive-listing", daemon=True)
+        # ("file", item, future), ("export", item, future), ("removed", file id, None) and ("page", token, None)
+        # in listing order
+        inflight = collections.deque()
+        try:
+            producer.start()
+            while True:
+                kind, value = work.get()
+                if kind == "failed":
+                    raise value
+                if kind == "done":
+                    break
+                if kind == "page":
+                    inflight.append(("page", value, None))
+                else:
+                    file_id, item = value
+                    if item is None:
+                        # Applied in listing order, after a download of the same file listed earlier is recorded.
+                        inflight.append(("removed", file_id, None))
+                        continue
+                    download = self.process_file(file_id, item, totals)
+                    if download:
+                        download_kind, target = download
+                        if download_kind == "export":
+                            future = exporter.submit(self.export_item, item, target)
+                        else:
+                            future = executor.submit(self.download_item, item, target)
+                        self.progress.add_total(1)
+                        inflight.append((download_kind, item, future))
+                self.harvest(inflight, cursor, totals, limit=MAX_QUEUED_DOWNLOADS)
+            self.harvest(inflight, cursor, totals)
+            if cursor == "listing_page_token":
+                # Files that are in the state but were not listed have disappeared.
+                for file_id in set(self.state["files"]) - set(self.run_state.items("seen")):
+                    self.process_file(file_id, None, totals)
+            self.state["largest_change_id"] = self.next_change_id
+            self.run_state.clear_items("seen")
+            self.save_state(largest_change_id=self.next_change_id, listing_change_id=None, listing_page_token=None)
+        finally:
+            stop.set()
+            executor.shutdown()
+            exporter.shutdown()
+            # Completed downloads are recorded even if listing failed; the change id only advances after a full pass.
+            for kind, item, download in inflight:
+                if kind in ("file", "export") and download.exception() is None:
+                    self.record_download(kind, item, download.result(), totals)
+            self.save_state()
+
+        if totals["failed"]:
+            self.logger.error("%s files could not be downloaded", totals["failed"])
 
         end = time.time()
         elapsed = end - start
-        msgs = total_processed / elapsed
+        msgs = totals["processed"] / elapsed
         self.logger.info(
-            "Finished in %.2f seconds. Downloaded %s/%s files. %s was skipped. %.2f msg/s", elapsed, total_processed,
-            total_messages, total_skipped, msgs
+            "Finished in %.2f seconds. Downloaded %s/%s files (%s exported, %s already in blob store, %s unchanged). "
+            "%s was skipped, %s deleted. %.2f msg/s", elapsed, totals["processed"], totals["listed"], totals["exported"],
+            totals["deduplicated"], totals["unchanged"], totals["skipped"], totals["deleted"], msgs
         )
 
+    def save_metadata(self, item):
+        """ Queues content/<id>.json to be written by the next save_state(). """
+        self.metadata[item["id"]] = item
+
+    def write_metadata(self):
+        for file_id, item in self.metadata.items():
+            with open("%s/content/%s.json" % (self.rootpath, file_id), "w") as metadata_file:
+                metadata_file.write(METADATA_ENCODER.encode(item))
+        self.metadata = {}
+
+    def download_item(self, item, download_url):
+        """ Streams a single file to content/<id>.data.
+
+            With a blob store, content/<id>.data is a symlink to the shared blob and the download is skipped
+            if some user already stored the same data. Returns "downloaded", "deduplicated" or None on failure. """
+        path = "%s/content/%s.data" % (self.rootpath, item.get("id"))
+        key = None
+        if self.blobstore:
+            key = BlobStore.key_for(item)
+        if key and self.blobstore.exists(key):
+            self.blobstore.link(key, path)
+            self.progress.processed(1)
+            return "deduplicated"
+        if key:
+            size = self.fetch("file %s" % item["id"], download_url, self.blobstore.prepare(key), md5=key[0])
+            if size is not None:
+                self.blobstore.link(key, path)
+        else:
+            size = self.fetch("file %s" % item["id"], download_url, path, md5=item.get("md5Checksum"))
+        if size is None:
+            return None
+        self.progress.processed(1, size)
+        return "downloaded"
+
+    def export_item(self, item, exports):
+        """ Exports a native document in every format of exports, [(mime type, url, path)]. Returns ("exported", mime
+            types) or (None, the mime types that did succeed) if some format failed. """
+        exported = []
+        size = 0
+        for mimetype, url, path in exports:
+            with EXPORT_SLOTS:
+                written = self.fetch("export of %s as %s" % (item["id"], mimetype), url, path)
+            if written is not None:
+                exported.append(mimetype)
+                size += written
+        if len(exported) < len(exports):
+            return (None, exported)
+        self.progress.processed(1, size)
+        return ("exported", exported)
+
+    def fetch(self, description, url, path, md5=None):
+        """ Streams url to path with retries. Returns the size, or None if the download failed for good. """
+        try:
+            size = call_with_retry(
+                lambda: stream_to_file(url, path, self.authorization_headers(), md5=md5, service=SYSTEM), SYSTEM,
+                description, logger=self.logger, retry_on=(ChecksumMismatch, )
+            )
+        except urllib.error.HTTPError as err:
+            self.logger.error("Downloading %s failed with status %s", description, err.code)
+            return None
+        except (ChecksumMismatch, http.client.HTTPException, OSError) as err:
+            kept = os.path.getsize(path + PART_SUFFIX) if os.path.exists(path + PART_SUFFIX) else 0
+            if kept:
+                self.logger.error(
+                    "Giving up on %s: %r. %s bytes are kept in %s for the next attempt", description, err, kept,
+                    path + PART_SUFFIX
+                )
+            else:
+                self.logger.error("Giving up on %s: %r", description, err)
+            return None
+        DOWNLOAD_BYTES.observe(size, service=SYSTEM)
+        return size
+
 
 def main():
     users = get_users(DOMAIN)
@@ -127,6 +529,9 @@ def main():
 
     for user in users:
         drivebackup = DriveBackup(user)
+        if not drivebackup.has_changes():
+            drivebackup.logger.info("No changes since the last run")
+            continue
         drivebackup.initialize()
         drivebackup.run()
 
@@ -0,0 +1,186 @@
+"""
+Append-only, compressed event log for a single calendar.
+
+<name>.log is a sequence of blocks: 4-byte big-endian length followed by a zlib-compressed JSON list of events.
+Every sync appends one block per page. <name>.idx maps event id -> offset of the block holding its latest version,
+so a point lookup reads a single block. Deleted events are stored as tombstones ({"id": ..., "status": "cancelled"}).
+
+compact() rewrites the log with only the latest version of each live event.
+
+Usage:
+  eventlog.py <directory> <calendar id> [<event id>]
+"""
+
+import json
+import os
+import struct
+import sys
+import zlib
+
+HEADER = struct.Struct(">I")
+COMPACT_BLOCK_SIZE = 256
+
+
+class EventLog:
+    def __init__(self, directory, name):
+        self.log_path = "%s/%s.log" % (directory, name)
+        self.index_path = "%s/%s.idx" % (directory, name)
+        self.offsets = {}
+        self.records = 0
+        self.size = 0
+        self.inode = None
+        self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+            self.offsets, self.records, self.size = index["offsets"], index["records"], index["size"]
+            self.inode = index["inode"]
+        except (FileNotFoundError, ValueError, KeyError):
+            self.offsets, self.records, self.size = {}, 0, 0
+        log_size = inode = 0
+        if os.path.exists(self.log_path):
+            log_stat = os.stat(self.log_path)
+            log_size, inode = log_stat.st_size, log_stat.st_ino
+        if log_size < self.size or (self.size and inode != self.inode):
+            # Index belongs to another version of the log, for example one replaced by an interrupted compaction.
+            self.offsets, self.records, self.size = {}, 0, 0
+        if log_size > self.size:
+            # Blocks appended after the index was last saved, for example by an interrupted run.
+            self.recover(log_size)
+
+    def recover(self, log_size):
+        with open(self.log_path, "rb") as log_file:
+            log_file.seek(self.size)
+            for offset, events in self.read_blocks(log_file):
+                self.add_to_index(offset, events)
+                self.size = log_file.tell()
+        if self.size < log_size:
+            # Partially written block at the end of the log.
+            with open(self.log_path, "r+b") as log_file:
+                log_file.truncate(self.size)
+        self.save_index()
+
+    @staticmethod
+    def read_blocks(log_file):
+        while True:
+            offset = log_file.tell()
+            header = log_file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            (length, ) = HEADER.unpack(header)
+            data = log_file.read(length)
+            if len(data) < length:
+                return
+            try:
+                events = json.loads(zlib.decompress(data).decode("utf-8"))
+            except (zlib.error, ValueError):
+                return
+            yield offset, events
+
+    def add_to_index(self, offset, events):
+        for event in events:
+            self.offsets[event["id"]] = offset
+        self.records += len(events)
+
+    def save_index(self):
+        self.inode = os.stat(self.log_path).st_ino if os.path.exists(self.log_path) else None
+        with open(self.index_path + ".tmp", "w") as index_file:
+            json.dump({
+                "offsets": self.offsets,
+                "records": self.records,
+                "size": self.size,
+                "inode": self.inode
+            }, index_file)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def append(self, events):
+        """ Appends events (including tombstones) as one block. Call save_index() when done appending. """
+        if not events:
+            return
+        data = zlib.compress(json.dumps(events).encode("utf-8"))
+        with open(self.log_path, "ab") as log_file:
+            offset = log_file.tell()
+            log_file.write(HEADER.pack(len(data)) + data)
+            self.size = log_file.tell()
+        self.add_to_index(offset, events)
+
+    def delete(self, event_ids):
+        self.append([{"id": event_id, "status": "cancelled"} for event_id in event_ids])
+
+    def read_block(self, offset):
+        with open(self.log_path, "rb") as log_file:
+            log_file.seek(offset)
+            for _, events in self.read_blocks(log_file):
+                return events
+        return []
+
+    def get(self, event_id):
+        """ Returns the latest version of an event, a tombstone if it was deleted, or None if it was never seen. """
+        if event_id not in self.offsets:
+            return None
+        for event in reversed(self.read_block(self.offsets[event_id])):
+            if event["id"] == event_id:
+                return event
+        return None
+
+    def live_ids(self):
+        """ Ids of events that are not deleted. Reads every block that holds a latest version. """
+        live = set()
+        by_block = {}
+        for event_id, offset in self.offsets.items():
+            by_block.setdefault(offset, set()).add(event_id)
+        for offset, event_ids in by_block.items():
+            for event in self.read_block(offset):
+                if event["id"] in event_ids and event.get("status") != "cancelled":
+                    live.add(event["id"])
+        return live
+
+    def needs_compaction(self, ratio, min_size):
+        return self.size >= min_size and self.records > ratio * max(len(self.offsets), 1)
+
+    def compact(self):
+        """ Rewrites the log with only the latest version of each live event. """
+        latest = []
+        by_block = {}
+        for event_id, offset in self.offsets.items():
+            by_block.setdefault(offset, set()).add(event_id)
+        for offset in sorted(by_block):
+            seen = set()
+            for event in reversed(self.read_block(offset)):
+                if event["id"] in by_block[offset] and event["id"] not in seen:
+                    seen.add(event["id"])
+                    if event.get("status") != "cancelled":
+                        latest.append(event)
+        temp_path = self.log_path + ".compact"
+        offsets = {}
+        with open(temp_path, "wb") as log_file:
+            for start in range(0, len(latest), COMPACT_BLOCK_SIZE):
+                block = latest[start:start + COMPACT_BLOCK_SIZE]
+                data = zlib.compress(json.dumps(block).encode("utf-8"))
+                offset = log_file.tell()
+                log_file.write(HEADER.pack(len(data)) + data)
+                for event in block:
+                    offsets[event["id"]] = offset
+            size = log_file.tell()
+        os.replace(temp_path, self.log_path)
+        self.offsets, self.records, self.size = offsets, len(latest), size
+        self.save_index()
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print(__doc__)
+        return 1
+    event_log = EventLog(sys.argv[1], sys.argv[2])
+    if len(sys.argv) == 4:
+        print(json.dumps(event_log.get(sys.argv[3]), indent=2))
+    else:
+        for event_id in sorted(event_log.live_ids()):
+            print(event_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,847 @@
+"""
+Local stand-in for the Google services used by the backup, for benchmarks.
+
+FakeDomain generates a synthetic domain on demand: users user00000@<domain>..., their mail, Drive files and calendar
+events. Nothing is stored, so scenarios with millions of messages or terabytes of files cost no memory. Every
+response is a function of the user, the item index and the generation; advance() starts a new generation in which
+every user has `changes` new messages, modified files and modified events, for measuring incremental runs.
+
+FakeGoogleServer serves the Drive v2, Calendar v3, Gmail v1, Directory and Reports APIs, their discovery documents
+(GOOGLE_DISCOVERY_URI) and batch requests (GOOGLE_BATCH_URI) over HTTP. FakeImapServer serves the same mailboxes
+over IMAP with XOAUTH2 and X-GM-MSGID. The user is taken from the access token, "fake:<email>".
+
+A fraction of API requests (`throttle`) is answered with userRateLimitExceeded, and every API request waits
+`latency` seconds, to approximate the real services. Call counts per API method are available from /_bench/stats.
+"""
+
+import base64
+import datetime
+import email.parser
+import hashlib
+import http.client
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+CHUNK_SIZE = 64 * 1024
+# Content of every generated file or message is this block repeated, followed by a unique trailer. The MD5 of the
+# repeated part is computed once per size, so listing millions of files does not mean hashing their content.
+FILLER = random.Random(0).getrandbits(CHUNK_SIZE * 8).to_bytes(CHUNK_SIZE, "big")
+# Message bodies are printable.
+TEXT_FILLER = base64.encodebytes(FILLER)
+TRAILER_SIZE = 64
+HISTORY_BASE = 1000000
+CHANGE_BASE = 1000000
+MSGID_BASE = 10**9
+DOCUMENT_SIZE = 16 * 1024
+DOCUMENT_MIMETYPE = "application/vnd.google-apps.document"
+DOCUMENT_EXPORT_MIMETYPES = (
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document", "application/pdf", "text/plain"
+)
+IMAP_FOLDERS = ("INBOX", "[Gmail]/All Mail", "Work")
+MODIFIED_DATE = datetime.datetime(2015, 1, 1)
+
+PARAMETER_TYPES = {
+    "maxResults": "integer",
+    "maxAttendees": "integer",
+    "includeDeleted": "boolean",
+    "showHidden": "boolean",
+    "showDeleted": "boolean",
+    "singleEvents": "boolean",
+}
+ROOT_PARAMETERS = ("fields", "alt", "prettyPrint", "quotaUser", "userIp")
+
+# (service, version): (servicePath, {method id: (path, query parameters)}). Used both for the discovery documents
+# and for routing requests.
+APIS = {
+    ("drive", "v2"): (
+        "drive/v2/", {
+            "about.get": ("about", ()),
+            "changes.list": ("changes", ("startChangeId", "includeDeleted", "pageToken", "maxResults")),
+            "files.get": ("files/{fileId}", ()),
+            "files.list": ("files", ("q", "pageToken", "maxResults", "corpus", "orderBy")),
+        }
+    ),
+    ("calendar", "v3"): (
+        "calendar/v3/", {
+            "calendarList.list": ("users/me/calendarList", ("minAccessRole", "maxResults", "showHidden", "pageToken")),
+            "events.list": (
+                "calendars/{calendarId}/events",
+                ("syncToken", "maxAttendees", "pageToken", "maxResults", "showDeleted", "singleEvents")
+            ),
+        }
+    ),
+    ("gmail", "v1"): (
+        "gmail/v1/users/", {
+            "users.getProfile": ("{userId}/profile", ()),
+            "users.history.list": ("{userId}/history", ("startHistoryId", "pageToken", "maxResults", "labelId")),
+            "users.labels.list": ("{userId}/labels", ()),
+            "users.messages.get": ("{userId}/messages/{id}", ("format", )),
+        }
+    ),
+    ("admin", "directory_v1"): (
+        "admin/directory/v1/", {
+            "users.list": ("users", ("domain", "customer", "pageToken", "maxResults", "orderBy")),
+        }
+    ),
+    ("admin", "reports_v1"): (
+        "admin/reports/v1/", {
+            "activities.list": (
+                "activity/users/{userKey}/applications/{applicationName}",
+                ("startTime", "endTime", "eventName", "pageToken", "maxResults")
+            ),
+            "userUsageReport.get": ("usage/users/{userKey}/dates/{date}", ("parameters", "pageToken", "maxResults")),
+        }
+    ),
+}
+
+
+class FakeError(Exception):
+    def __init__(self, status, reason, message=""):
+        super().__init__(status, reason)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def body(self):
+        return {
+            "error": {
+                "errors": [{"domain": "global", "reason": self.reason, "message": self.message}],
+                "code": self.status,
+                "message": self.message,
+            }
+        }
+
+
+def discovery_document(base_url, service, version):
+    service_path, methods = APIS[(service, version)]
+    resources = {}
+    for method_id, (path, query) in methods.items():
+        parameters = {name: {"type": PARAMETER_TYPES.get(name, "string"), "location": "query"} for name in query}
+        for name in re.findall(r"{(\w+)}", path):
+            parameters[name] = {"type": "string", "location": "path", "required": True}
+        names = method_id.split(".")
+        resource = resources
+        for name in names[:-2]:
+            resource = resource.setdefault(name, {}).setdefault("resources", {})
+        resource.setdefault(names[-2], {}).setdefault("methods", {})[names[-1]] = {
+            "id": "%s.%s" % (service, method_id),
+            "path": path,
+            "httpMethod": "GET",
+            "parameters": parameters,
+            "parameterOrder": re.findall(r"{(\w+)}", path),
+            "response": {"$ref": "Object"},
+        }
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "name": service,
+        "version": version,
+        "protocol": "rest",
+        "rootUrl": base_url + "/",
+        "servicePath": service_path,
+        "basePath": "/" + service_path,
+        "baseUrl": "%s/%s" % (base_url, service_path),
+        "batchPath": "batch",
+        "parameters": {name: {"type": "string", "location": "query"} for name in ROOT_PARAMETERS},
+        "schemas": {"Object": {"id": "Object", "type": "object", "additionalProperties": {"type": "any"}}},
+        "resources": resources,
+    }
+
+
+def path_pattern(path):
+    """ "files/{fileId}" -> regex with a named group for fileId """
+    parts = re.split(r"{(\w+)}", path)
+    return re.compile("".join(
+        re.escape(part) if index % 2 == 0 else "(?P<%s>[^/]+)" % part for index, part in enumerate(parts)
+    ) + "$")
+
+
+def routes():
+    """ Returns [(regex, method id)] for every API method. """
+    result = []
+    for (service, _), (service_path, methods) in APIS.items():
+        for method_id, (path, _) in methods.items():
+            result.append((path_pattern("/" + service_path + path), "%s.%s" % (service, method_id)))
+    return result
+
+
+class FakeDomain:
+    def __init__(
+        self, domain="example.com", users=10, messages=100, message_size=4096, files=10, file_size=65536,
+        documents=0, calendars=1, events=100, changes=10, throttle=0.0, latency=0.0, interruptions=0.0, seed=0
+    ):
+        self.domain = domain
+        self.users = users
+        self.messages = messages
+        self.message_size = message_size
+        self.files = files
+        self.file_size = file_size
+        self.documents = documents
+        self.calendars = calendars
+        self.events = events
+        self.changes = changes
+        self.throttle = throttle
+        self.latency = latency
+        self.interruptions = interruptions
+        self.generation = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.filler_digests = {}
+        self.stats = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def throttled(self):
+        if not self.throttle:
+            return False
+        with self.lock:
+            return self.random.random() < self.throttle
+
+    def interrupted(self):
+        if not self.interruptions:
+            return False
+        with self.lock:
+            return self.random.random() < self.interruptions
+
+    def advance(self):
+        with self.lock:
+            self.generation += 1
+            return self.generation
+
+    def email(self, index):
+        return "user%05d@%s" % (index, self.domain)
+
+    def user_index(self, email):
+        match = re.match(r"^user(\d+)@", email or "")
+        if not match or int(match.group(1)) >= self.users:
+            raise FakeError(404, "notFound", "Unknown user %s" % email)
+        return int(match.group(1))
+
+    def user(self, index):
+        return {
+            "primaryEmail": self.email(index),
+            "suspended": False,
+            "creationTime": "2014-01-01T00:00:00.000Z",
+            "lastLoginTime": "2015-01-01T00:00:00.000Z",
+        }
+
+    def filler_digest(self, size):
+        """ MD5 state after the first size bytes of the repeated FILLER. """
+        with self.lock:
+            digest = self.filler_digests.get(size)
+        if digest is None:
+            digest = hashlib.md5()
+            remaining = size
+            while remaining > 0:
+                digest.update(FILLER[:min(remaining, CHUNK_SIZE)])
+                remaining -= CHUNK_SIZE
+            with self.lock:
+                self.filler_digests[size] = digest
+        return digest.copy()
+
+    @staticmethod
+    def trailer(key):
+        return ("\n%s" % key).encode("ascii").rjust(TRAILER_SIZE, b"-")[:TRAILER_SIZE]
+
+    def content_md5(self, size, key):
+        digest = self.filler_digest(max(size - TRAILER_SIZE, 0))
+        digest.update(self.trailer(key)[-size:] if size < TRAILER_SIZE else self.trailer(key))
+        return digest.hexdigest()
+
+    def content(self, size, key, offset=0):
+        """ Yields the content for key from offset on, in chunks of at most CHUNK_SIZE bytes. """
+        filler_size = max(size - TRAILER_SIZE, 0)
+        position = offset
+        while position < filler_size:
+            start = position % CHUNK_SIZE
+            chunk = FILLER[start:min(CHUNK_SIZE, start + filler_size - position)]
+            yield chunk
+            position += len(chunk)
+        trailer = self.trailer(key)[-size:] if size < TRAILER_SIZE else self.trailer(key)
+        yield trailer[position - filler_size:]
+
+    def message_count(self, generation=None):
+        return self.messages + self.changes * (self.generation if generation is None else generation)
+
+    def msgid(self, user, index):
+        return (user + 1) * MSGID_BASE + index + 1
+
+    def message_index(self, user, msgid):
+        index = msgid - (user + 1) * MSGID_BASE - 1
+        if not 0 <= index < self.message_count():
+            raise FakeError(404, "notFound", "Unknown message")
+        return index
+
+    @staticmethod
+    def message_folders(index):
+        folders = ["[Gmail]/All Mail"]
+        if index % 2 == 0:
+            folders.append("INBOX")
+        if index % 5 == 0:
+            folders.append("Work")
+        return folders
+
+    @staticmethod
+    def message_labels(index):
+        labels = []
+        if index % 2 == 0:
+            labels.append("INBOX")
+        if index % 5 == 0:
+            labels.append("Label_1")
+        if index % 3 == 0:
+            labels.append("UNREAD")
+        return labels
+
+    def raw_message(self, user, index):
+        headers = (
+            "Message-ID: <%s@%s>\r\nFrom: %s\r\nTo: %s\r\nSubject: Message %s\r\n"
+            "Date: Thu, 01 Jan 2015 00:00:00 +0000\r\n\r\n" %
+            (self.msgid(user, index), self.domain, self.email(user), self.email(user), index)
+        ).encode("ascii")
+        size = max(self.message_size - len(headers), 0)
+        return headers + (TEXT_FILLER * (size // len(TEXT_FILLER) + 1))[:size]
+
+    def content_revision(self, index):
+        return 1 + (self.generation if index < self.changes else 0)
+
+    def file_version(self, index):
+        """ Documents get a new version every generation without changes to their content, as comments and sharing
+            changes bump the version too. """
+        if index >= self.files:
+            return 1 + self.generation
+        return self.content_revision(index)
+
+    def changed_files(self):
+        """ Indexes of files in the changes feed of the current generation. """
+        total = self.files + self.documents
+        return sorted(set(range(min(self.changes, total))) | set(range(self.files, total)))
+
+    def file_id(self, user, index):
+        return "u%05d-f%06d" % (user, index)
+
+    def parse_file_id(self, file_id):
+        match = re.match(r"^u(\d+)-f(\d+)$", file_id)
+        if not match or int(match.group(1)) >= self.users or int(match.group(2)) >= self.files + self.documents:
+            raise FakeError(404, "notFound", "File not found: %s" % file_id)
+        return (int(match.group(1)), int(match.group(2)))
+
+    def file_key(self, user, index):
+        return "%s.%s" % (self.file_id(user, index), self.content_revision(index))
+
+    def file_resource(self, base_url, user, index):
+        file_id = self.file_id(user, index)
+        version = self.file_version(index)
+        item = {
+            "kind": "drive#file",
+            "id": file_id,
+            "title": "File %s" % index,
+            "version": str(version),
+            "modifiedDate": (MODIFIED_DATE + datetime.timedelta(days=self.content_revision(index) - 1)).strftime(
+                "%Y-%m-%dT%H:%M:%S.000Z"
+            ),
+            "owners": [{"emailAddress": self.email(user)}],
+            "labels": {"trashed": False},
+        }
+        if index < self.files:
+            item.update({
+                "mimeType": "application/octet-stream",
+                "fileSize": str(self.file_size),
+                "md5Checksum": self.content_md5(self.file_size, self.file_key(user, index)),
+                "downloadUrl": "%s/download/%s" % (base_url, file_id),
+            })
+        else:
+            item.update({
+                "mimeType": DOCUMENT_MIMETYPE,
+                "exportLinks": {
+                    mimetype: "%s/export/%s?mimeType=%s" % (base_url, file_id, urllib.parse.quote(mimetype))
+                    for mimetype in DOCUMENT_EXPORT_MIMETYPES
+                },
+            })
+        return item
+
+    def calendar_ids(self, user):
+        return [self.email(user)] + [
+            "u%05d-c%d@group.calendar.google.com" % (user, index) for index in range(1, self.calendars)
+        ]
+
+    def calendar_user(self, calendar_id):
+        match = re.match(r"^u(\d+)-c\d+@", calendar_id)
+        if match:
+            return int(match.group(1))
+        return self.user_index(calendar_id)
+
+    def event(self, index):
+        updated = self.generation if index < self.changes else 0
+        return {
+            "kind": "calendar#event",
+            "id": "e%06d" % index,
+            "status": "confirmed",
+            "summary": "Event %s" % index,
+            "updated": "2015-01-01T00:00:%02d.000Z" % (updated % 60),
+            "sequence": updated,
+            "start": {"dateTime": "2015-01-01T10:00:00Z"},
+            "end": {"dateTime": "2015-01-01T11:00:00Z"},
+        }
+
+
+def page(items, page_token, max_results, default, limit):
+    """ Returns (items of the page, next page token or None) for offset based page tokens. """
+    start = int(page_token or 0)
+    size = min(int(max_results or default), limit)
+    return (items[start:start + size], str(start + size) if start + size < len(items) else None)
+
+
+class FakeApi:
+    """ Implements the API methods. Each method gets (user index, path arguments, query) and returns a dict. """
+
+    def __init__(self, fake, base_url):
+        self.fake = fake
+        self.base_url = base_url
+
+    def call(self, method_id, email, arguments, query):
+        handler = getattr(self, method_id.replace(".", "_"))
+        # The administrator listing users is not one of them.
+        user = None if method_id.startswith("admin.") else self.fake.user_index(email)
+        return handler(user, arguments, query)
+
+    def drive_about_get(self, user, arguments, query):
+        return {"kind": "drive#about", "largestChangeId": str(CHANGE_BASE + self.fake.generation)}
+
+    def drive_files_list(self, user, arguments, query):
+        indexes, next_token = page(
+            range(self.fake.files + self.fake.documents), query.get("pageToken"), query.get("maxResults"), 100, 1000
+        )
+        result = {
+            "kind": "drive#fileList",
+            "items": [self.fake.file_resource(self.base_url, user, index) for index in indexes],
+        }
+        if next_token:
+            result["nextPageToken"] = next_token
+        return result
+
+    def drive_files_get(self, user, arguments, query):
+        owner, index = self.fake.parse_file_id(arguments["fileId"])
+        return self.fake.file_resource(self.base_url, owner, index)
+
+    def drive_changes_list(self, user, arguments, query):
+        largest = CHANGE_BASE + self.fake.generation
+        changed = []
+        start = int(query.get("startChangeId") or CHANGE_BASE + 1)
+        if self.fake.generation and start <= largest:
+            changed = self.fake.changed_files()
+        indexes, next_token = page(changed, query.get("pageToken"), query.get("maxResults"), 100, 1000)
+        result = {
+            "kind": "drive#changeList",
+            "largestChangeId": str(largest),
+            "items": [
+                {
+                    "kind": "drive#change",
+                    "id": str(largest),
+                    "fileId": self.fake.file_id(user, index),
+                    "deleted": False,
+                    "file": self.fake.file_resource(self.base_url, user, index),
+                } for index in indexes
+            ],
+        }
+        if next_token:
+            result["nextPageToken"] = next_token
+        return result
+
+    def calendar_calendarList_list(self, user, arguments, query):  # pylint: disable=invalid-name
+        return {
+            "kind": "calendar#calendarList",
+            "items": [{"id": calendar_id, "accessRole": "owner"} for calendar_id in self.fake.calendar_ids(user)],
+        }
+
+    def calendar_events_list(self, user, arguments, query):
+        calendar_id = urllib.parse.unquote(arguments["calendarId"])
+        if self.fake.calendar_user(calendar_id) != user:
+            raise FakeError(404, "notFound", "Not Found")
+        sync_token = query.get("syncToken")
+        current = "s%d" % self.fake.generation
+        if sync_token:
+            match = re.match(r"^s(\d+)$", sync_token)
+            if not match or int(match.group(1)) > self.fake.generation:
+                raise FakeError(410, "fullSyncRequired", "Sync token is no longer valid")
+            changed = range(min(self.fake.changes, self.fake.events)) if sync_token != current else range(0)
+        else:
+            changed = range(self.fake.events)
+        indexes, next_token = page(changed, query.get("pageToken"), query.get("maxResults"), 250, 2500)
+        result = {"kind": "calendar#events", "items": [self.fake.event(index) for index in indexes]}
+        if next_token:
+            result["nextPageToken"] = next_token
+        else:
+            result["nextSyncToken"] = current
+        return result
+
+    def gmail_users_getProfile(self, user, arguments, query):  # pylint: disable=invalid-name
+        return {
+            "emailAddress": self.fake.email(user),
+            "messagesTotal": self.fake.message_count(),
+            "historyId": str(HISTORY_BASE + self.fake.generation),
+        }
+
+    def gmail_users_labels_list(self, user, arguments, query):
+        labels = [{"id": label, "name": label, "type": "system"} for label in ("INBOX", "SENT", "UNREAD", "TRASH")]
+        labels.append({"id": "Label_1", "name": "Work", "type": "user"})
+        return {"labels": labels}
+
+    def gmail_users_history_list(self, user, arguments, query):
+        current = HISTORY_BASE + self.fake.generation
+        start = int(query.get("startHistoryId") or 0)
+        if not HISTORY_BASE <= start <= current:
+            raise FakeError(404, "notFound", "Requested entity was not found.")
+        added = range(self.fake.message_count(start - HISTORY_BASE), self.fake.message_count())
+        indexes, next_token = page(added, query.get("pageToken"), query.get("maxResults"), 100, 500)
+        result = {"historyId": str(current)}
+        if indexes:
+            result["history"] = [
+                {
+                    "id": str(current),
+                    "messagesAdded": [{
+                        "message": {
+                            "id": "%x" % self.fake.msgid(user, index),
+                            "labelIds": self.fake.message_labels(index),
+                        }
+                    }],
+                } for index in indexes
+            ]
+        if next_token:
+            result["nextPageToken"] = next_token
+        return result
+
+    def gmail_users_messages_get(self, user, arguments, query):
+        index = self.fake.message_index(user, int(arguments["id"], 16))
+        message = {
+            "id": arguments["id"],
+            "threadId": arguments["id"],
+            "labelIds": self.fake.message_labels(index),
+            "historyId": str(HISTORY_BASE + self.fake.generation),
+        }
+        if query.get("format") == "raw":
+            raw = self.fake.raw_message(user, index)
+            message["raw"] = base64.urlsafe_b64encode(raw).decode("ascii")
+            message["sizeEstimate"] = len(raw)
+            self.fake.count("bytes", len(raw))
+        return message
+
+    def admin_users_list(self, user, arguments, query):
+        indexes, next_token = page(range(self.fake.users), query.get("pageToken"), query.get("maxResults"), 100, 500)
+        result = {"kind": "admin#directory#users", "users": [self.fake.user(index) for index in indexes]}
+        if next_token:
+            result["nextPageToken"] = next_token
+        return result
+
+    def admin_activities_list(self, user, arguments, query):
+        return {"kind": "admin#reports#activities", "items": []}
+
+    def admin_userUsageReport_get(self, user, arguments, query):  # pylint: disable=invalid-name
+        indexes, next_token = page(range(self.fake.users), query.get("pageToken"), query.get("maxResults"), 1000, 1000)
+        gmail_mb = self.fake.message_count() * self.fake.message_size // 1024**2
+        drive_mb = (self.fake.files * self.fake.file_size + self.fake.documents * DOCUMENT_SIZE) // 1024**2
+        result = {
+            "kind": "admin#reports#usageReports",
+            "usageReports": [
+                {
+                    "entity": {"userEmail": self.fake.email(index)},
+                    "parameters": [
+                        {"name": "accounts:gmail_used_quota_in_mb", "intValue": str(gmail_mb)},
+                        {"name": "accounts:drive_used_quota_in_mb", "intValue": str(drive_mb)},
+                    ],
+                } for index in indexes
+            ],
+        }
+        if next_token:
+            result["nextPageToken"] = next_token
+        return result
+
+
+class FakeGoogleHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately. With Nagle's algorithm, keep-alive clients would wait for a
+    # delayed ACK after every response.
+    disable_nagle_algorithm = True
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def access_token_user(self, headers):
+        authorization = headers.get("Authorization") or headers.get("authorization") or ""
+        if not authorization.startswith("Bearer fake:"):
+            raise FakeError(401, "authError", "Invalid Credentials")
+        return authorization[len("Bearer fake:"):]
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def api_response(self, path, headers):
+        """ Returns (status, body) for a single API request. """
+        url = urllib.parse.urlsplit(path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        for pattern, method_id in self.server.routes:
+            match = pattern.match(url.path)
+            if match:
+                break
+        else:
+            return (404, FakeError(404, "notFound", "Unknown path %s" % url.path).body())
+        self.fake.count(method_id)
+        try:
+            email = self.access_token_user(headers)
+            if self.fake.throttled():
+                self.fake.count("throttled")
+                raise FakeError(403, "userRateLimitExceeded", "User Rate Limit Exceeded")
+            return (200, self.server.api.call(method_id, email, match.groupdict(), query))
+        except FakeError as err:
+            return (err.status, err.body())
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/_bench/stats":
+            with self.fake.lock:
+                stats = dict(self.fake.stats)
+            self.send_body(200, stats)
+            return
+        match = re.match(r"^/discovery/v1/apis/([^/]+)/([^/]+)/rest$", path)
+        if match:
+            if (match.group(1), match.group(2)) not in APIS:
+                self.send_body(404, FakeError(404, "notFound").body())
+                return
+            self.send_body(200, discovery_document(self.server.base_url, match.group(1), match.group(2)))
+            return
+        if path.startswith(("/download/", "/export/")):
+            self.download(path)
+            return
+        time.sleep(self.fake.latency)
+        self.send_body(*self.api_response(self.path, self.headers))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/_bench/advance":
+            self.send_body(200, {"generation": self.fake.advance()})
+        elif path == "/batch":
+            time.sleep(self.fake.latency)
+            self.batch(body)
+        else:
+            self.send_body(404, FakeError(404, "notFound").body())
+
+    def download(self, path):
+        self.fake.count("download" if path.startswith("/download/") else "export")
+        try:
+            self.access_token_user(self.headers)
+            user, index = self.fake.parse_file_id(path.rsplit("/", 1)[1])
+        except FakeError as err:
+            self.send_body(err.status, err.body())
+            return
+        size = self.fake.file_size if index < self.fake.files else DOCUMENT_SIZE
+        # Like Drive, ranges are served for file downloads but not for exports.
+        match = re.match(r"^bytes=(\d+)-$", self.headers.get("Range") or "")
+        offset = int(match.group(1)) if match and path.startswith("/download/") else 0
+        if offset >= size > 0:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%s" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if match and offset:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (offset, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - offset))
+        self.end_headers()
+        # An interrupted download stops halfway and drops the connection.
+        interrupted = self.fake.interrupted()
+        remaining = (size - offset) // 2 if interrupted else size - offset
+        for chunk in self.fake.content(size, self.fake.file_key(user, index), offset):
+            chunk = chunk[:remaining]
+            self.wfile.write(chunk)
+            self.fake.count("bytes", len(chunk))
+            remaining -= len(chunk)
+            if not remaining:
+                break
+        if interrupted:
+            self.fake.count("interrupted")
+            self.close_connection = True
+
+    def batch(self, body):
+        """ Answers a multipart/mixed batch request with a multipart/mixed response, in the format
+            apiclient.http.BatchHttpRequest sends and expects. """
+        self.fake.count("batch")
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: %s\r\n\r\n" % self.headers["Content-Type"].encode("ascii") + body
+        )
+        boundary = "batch_fake_%s" % random.getrandbits(64)
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            if isinstance(request, list):
+                request = request[0].as_string()
+            request_line, _, rest = request.partition("\n")
+            headers = email.parser.Parser().parsestr(rest, headersonly=True)
+            status, response = self.api_response(request_line.split()[1], headers)
+            content_id = (part["Content-ID"] or "<>")[1:-1]
+            parts.append(
+                "--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n"
+                "HTTP/1.1 %s %s\r\nContent-Type: application/json\r\n\r\n%s\r\n" %
+                (boundary, content_id, status, http.client.responses.get(status, ""), json.dumps(response))
+            )
+        parts.append("--%s--\r\n" % boundary)
+        self.send_body(200, "".join(parts).encode("utf-8"), "multipart/mixed; boundary=%s" % boundary)
+
+
+class FakeGoogleServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fake, address=("127.0.0.1", 0)):
+        super().__init__(address, FakeGoogleHandler)
+        self.fake = fake
+        self.base_url = "http://%s:%s" % self.server_address[:2]
+        self.api = FakeApi(fake, self.base_url)
+        self.routes = routes()
+
+
+def parse_sequence_set(value):
+    uids = []
+    for part in value.split(","):
+        first, _, last = part.partition(":")
+        uids.extend(range(int(first), int(last or first) + 1))
+    return uids
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    """ Enough of IMAP4rev1 for imapsync: CAPABILITY, AUTHENTICATE XOAUTH2, LIST, EXAMINE/SELECT, UID SEARCH ALL,
+        UID FETCH and LOGOUT. Commands are answered in order, so pipelined commands work. """
+
+    wbufsize = CHUNK_SIZE
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def send(self, data):
+        self.wfile.write(data if isinstance(data, bytes) else data.encode("utf-8"))
+
+    def handle(self):
+        self.user = None
+        self.folder = None
+        self.send("* OK [CAPABILITY IMAP4rev1 AUTH=XOAUTH2] Fake Gimap ready\r\n")
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, command = line.decode("utf-8", "replace").rstrip("\r\n").partition(" ")
+            name, _, arguments = command.partition(" ")
+            self.fake.count("imap.%s" % name.upper())
+            try:
+                if not self.dispatch(tag, name.upper(), arguments):
+                    self.wfile.flush()
+                    return
+            except (FakeError, ValueError, KeyError) as err:
+                self.send("%s NO %s\r\n" % (tag, err))
+            self.wfile.flush()
+
+    def dispatch(self, tag, name, arguments):
+        if name == "CAPABILITY":
+            self.send("* CAPABILITY IMAP4rev1 AUTH=XOAUTH2 X-GM-EXT-1\r\n%s OK Success\r\n" % tag)
+        elif name == "AUTHENTICATE":
+            self.send("+ \r\n")
+            self.wfile.flush()
+            response = base64.b64decode(self.rfile.readline().strip()).decode("utf-8", "replace")
+            fields = dict(field.split("=", 1) for field in response.split("\1") if "=" in field)
+            self.user = self.fake.user_index(fields.get("user"))
+            self.send("%s OK %s authenticated (Success)\r\n" % (tag, fields.get("user")))
+        elif name == "LIST":
+            self.send('* LIST (\\HasChildren \\Noselect) "/" "[Gmail]"\r\n')
+            for folder in IMAP_FOLDERS:
+                self.send('* LIST (\\HasNoChildren) "/" "%s"\r\n' % folder)
+            self.send("%s OK Success\r\n" % tag)
+        elif name in ("EXAMINE", "SELECT"):
+            folder = arguments.strip('"')
+            if folder not in IMAP_FOLDERS:
+                raise FakeError(404, "Unknown folder")
+            self.folder = folder
+            self.send(
+                "* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)\r\n* OK [UIDVALIDITY %s] UIDs valid.\r\n"
+                "* %s EXISTS\r\n%s OK [READ-ONLY] %s selected. (Success)\r\n" %
+                (IMAP_FOLDERS.index(folder) + 1, len(self.folder_indexes()), tag, folder)
+            )
+        elif name == "UID":
+            self.uid(tag, arguments)
+        elif name == "NOOP":
+            self.send("%s OK Success\r\n" % tag)
+        elif name == "LOGOUT":
+            self.send("* BYE LOGOUT Requested\r\n%s OK 73 good day (Success)\r\n" % tag)
+            return False
+        else:
+            self.send("%s BAD Unknown command\r\n" % tag)
+        return True
+
+    def folder_indexes(self):
+        return [index for index in range(self.fake.message_count()) if self.folder in self.fake.message_folders(index)]
+
+    def uid(self, tag, arguments):
+        name, _, arguments = arguments.partition(" ")
+        if name.upper() == "SEARCH":
+            self.send("* SEARCH %s\r\n%s OK SEARCH completed (Success)\r\n" % (
+                " ".join(str(index + 1) for index in self.folder_indexes()), tag))
+            return
+        sequence_set, _, items = arguments.partition(" ")
+        count = self.fake.message_count()
+        body = "BODY.PEEK[]" in items.upper()
+        for number, uid in enumerate(parse_sequence_set(sequence_set), 1):
+            index = uid - 1
+            if not 0 <= index < count or self.folder not in self.fake.message_folders(index):
+                continue
+            flags = "" if index % 3 == 0 else "\\Seen"
+            header = "* %s FETCH (UID %s X-GM-MSGID %s FLAGS (%s)" % (number, uid, self.fake.msgid(self.user, index), flags)
+            if body:
+                raw = self.fake.raw_message(self.user, index)
+                self.send(("%s BODY[] {%s}\r\n" % (header, len(raw))).encode("ascii") + raw + b")\r\n")
+                self.fake.count("bytes", len(raw))
+            else:
+                self.send("%s)\r\n" % header)
+        self.send("%s OK Success\r\n" % tag)
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fake, address=("127.0.0.1", 0)):
+        super().__init__(address, FakeImapHandler)
+        self.fake = fake
+
+
+def serve(fake, ready=None):
+    """ Runs both servers until the process is terminated. Sends (http base url, imap port) to the ready pipe. """
+    http_server = FakeGoogleServer(fake)
+    imap_server = FakeImapServer(fake)
+    threading.Thread(target=imap_server.serve_forever, name="fake-imap", daemon=True).start()
+    if ready is not None:
+        ready.send((http_server.base_url, imap_server.server_address[1]))
+    http_server.serve_forever()
@@ -1,8 +1,18 @@
 """
 Gets list of users from Google Apps.
 
+The directory is cached in the run state database (see helpers.StateStore) together with lastLoginTime and, when
+the Reports API is available, storage used per service. The cache is used as is for USERS_REFRESH_INTERVAL seconds.
+After that it is brought up to date from the admin audit log (users created, deleted, renamed, suspended or
+unsuspended since the last refresh) and the login audit log (lastLoginTime), which is usually two requests. Both logs
+are read from USERS_AUDIT_LOG_OVERLAP seconds before the last refresh, as events can show up in them late. A cache
+older than USERS_CACHE_TTL seconds is replaced by a full listing.
+
+With USERS_ADMIN_EMAIL, the service account impersonates that administrator and no interactive authorization is
+needed. The Reports API (audit log and usage) is only used this way; otherwise every refresh is a full listing.
 """
 
+import datetime
 import logging
 import logging.handlers
 import random
@@ -12,9 +22,13 @@ import time
 import apiclient
 import apiclient.discovery
 import httplib2
+from apiclient.errors import HttpError
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 
+from .helpers import CREDENTIALS, STATE, execute_with_retry
+from .settings import USERS_ADMIN_EMAIL, USERS_AUDIT_LOG_OVERLAP, USERS_CACHE_TTL, USERS_REFRESH_INTERVAL
+
 logger = logging.getLogger('google-user-list')
 logger.setLevel("INFO")
 handler = logging.handlers.SysLogHandler(address='/dev/log')
@@ -22,53 +36,212 @@ formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+DIRECTORY_SCOPE = 'https://www.googleapis.com/auth/admin.directory.user.readonly'
+REPORTS_SCOPES = (
+    'https://www.googleapis.com/auth/admin.reports.audit.readonly',
+    'https://www.googleapis.com/auth/admin.reports.usage.readonly',
+)
+STATE_SERVICE = "directory"
+USER_FIELDS = "nextPageToken,users(primaryEmail,suspended,suspensionReason,lastLoginTime,creationTime)"
+# Bytes used per service, from the accounts usage report.
+USAGE_PARAMETERS = {
+    "accounts:gmail_used_quota_in_mb": "gmail",
+    "accounts:drive_used_quota_in_mb": "drive",
+}
+# Usage reports become available a few days after the date they describe.
+USAGE_REPORT_DELAY = 3
+
+
+def rfc3339(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.000Z")
 
-def get_users(domain):
+
+def parse_rfc3339(value):
+    return datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def get_interactive_credentials():
     storage = Storage('get_users_credentials')
-    scopes = ('https://www.googleapis.com/auth/admin.directory.user.readonly')
     credentials = storage.get()
     if not credentials:
-        flow = flow_from_clientsecrets('client_secrets.json', scope=scopes, redirect_uri='urn:ietf:wg:oauth:2.0:oob')
+        flow = flow_from_clientsecrets(
+            'client_secrets.json', scope=DIRECTORY_SCOPE, redirect_uri='urn:ietf:wg:oauth:2.0:oob'
+        )
         auth_uri = flow.step1_get_authorize_url()
         print(auth_uri)
         code = input("Auth token: ")
         credentials = flow.step2_exchange(code)
         storage.put(credentials)
+    return credentials
+
+
+def get_services():
+    """ Returns (directory service, reports service or None). """
+    if USERS_ADMIN_EMAIL:
+        scope = " ".join((DIRECTORY_SCOPE, ) + REPORTS_SCOPES)
+        http = CREDENTIALS.get_credentials(USERS_ADMIN_EMAIL, scope).authorize(httplib2.Http())
+        return (CREDENTIALS.build("admin", "directory_v1", http), CREDENTIALS.build("admin", "reports_v1", http))
+    http = get_interactive_credentials().authorize(httplib2.Http())
+    return (apiclient.discovery.build("admin", 'directory_v1', http=http), None)
+
+
+def list_users(service, domain):
+    users = {}
+    next_page_token = None
+    while True:
+        users_page = execute_with_retry(
+            service.users().list(fields=USER_FIELDS, domain=domain, pageToken=next_page_token, maxResults=500),
+            "directory", "list of users", logger=logger
+        )
+        next_page_token = users_page.get("nextPageToken")
+        for user in users_page.get("users", []):
+            users[user["primaryEmail"]] = user
+        if not next_page_token:
+            return users
+
+
+def add_usage(reports, users):
+    """ Adds {"usage": {service: bytes}} from the latest available usage report. """
+    date = (datetime.date.today() - datetime.timedelta(days=USAGE_REPORT_DELAY)).isoformat()
+    next_page_token = None
+    while True:
+        report = execute_with_retry(
+            reports.userUsageReport().get(
+                userKey="all", date=date, parameters=",".join(USAGE_PARAMETERS), pageToken=next_page_token
+            ), "directory", "usage report", logger=logger
+        )
+        for usage in report.get("usageReports", []):
+            user = users.get(usage.get("entity", {}).get("userEmail"))
+            if user is None:
+                continue
+            user["usage"] = {
+                USAGE_PARAMETERS[parameter["name"]]: int(parameter.get("intValue", 0)) * 1024 * 1024
+                for parameter in usage.get("parameters", []) if parameter.get("name") in USAGE_PARAMETERS
+            }
+        next_page_token = report.get("nextPageToken")
+        if not next_page_token:
+            return
+
 
-    http = httplib2.Http()
-    http = credentials.authorize(http)
+def event_parameters(event):
+    return {parameter.get("name"): parameter.get("value") for parameter in event.get("parameters", [])}
 
-    service = apiclient.discovery.build("admin", 'directory_v1', http=http)
 
-    users = []
+def list_activities(reports, application, since, event_name=None):
+    """ Returns audit log activities of an application since the given time, newest first. """
+    activities = []
     next_page_token = None
     while True:
-        for retrycount in range(1, 4):
-            try:
-                users_page = service.users().list(
-                    fields='nextPageToken,users(primaryEmail,suspended,suspensionReason)',
-                    domain=domain,
-                    pageToken=next_page_token,
-                    maxResults=500
-                ).execute()
-                next_page_token = users_page.get("nextPageToken")
-                users_page = users_page.get("users")
-                users.extend(users_page)
-                break
-            except IOError:
-                logger.warning("Downloading list of users failed")
-                time.sleep(retrycount)
+        page = execute_with_retry(
+            reports.activities().list(
+                userKey="all", applicationName=application, eventName=event_name, startTime=rfc3339(since),
+                pageToken=next_page_token
+            ), "directory", "%s audit log" % application, logger=logger
+        )
+        activities.extend(page.get("items", []))
+        next_page_token = page.get("nextPageToken")
         if not next_page_token:
-            break
-    users_filtered = []
-    for user in users:
-        if not user.get("suspended", True):
-            users_filtered.append(user["primaryEmail"])
+            return activities
+
+
+def apply_admin_events(reports, users, since):
+    """ Applies user changes from the admin audit log since the given time. Returns the number of changes.
+        Events that were already applied change nothing. """
+    changes = 0
+    activities = list_activities(reports, "admin", since)
+    for activity in sorted(activities, key=lambda activity: activity.get("id", {}).get("time", "")):
+        for event in activity.get("events", []):
+            parameters = event_parameters(event)
+            email = parameters.get("USER_EMAIL")
+            if not email:
+                continue
+            name = event.get("name")
+            if name == "CREATE_USER":
+                if email in users:
+                    continue
+                users[email] = {"primaryEmail": email, "suspended": False, "creationTime": activity["id"]["time"]}
+            elif name == "DELETE_USER":
+                users.pop(email, None)
+            elif name == "RENAME_USER" and email in users and parameters.get("NEW_VALUE"):
+                user = users.pop(email)
+                user["primaryEmail"] = parameters["NEW_VALUE"]
+                users[user["primaryEmail"]] = user
+            elif name in ("SUSPEND_USER", "UNSUSPEND_USER") and email in users:
+                users[email]["suspended"] = name == "SUSPEND_USER"
+            else:
+                continue
+            changes += 1
+    return changes
+
+
+def apply_login_events(reports, users, since):
+    """ Updates lastLoginTime from the login audit log since the given time. """
+    for activity in list_activities(reports, "login", since, event_name="login_success"):
+        user = users.get(activity.get("actor", {}).get("email"))
+        login_time = activity.get("id", {}).get("time")
+        if user is not None and login_time and login_time > (user.get("lastLoginTime") or ""):
+            user["lastLoginTime"] = login_time
+
+
+def get_user_directory(domain, refresh=False):
+    """ Returns {email: user} for all users in the domain, including suspended ones. User entries are Directory API
+        user resources (primaryEmail, suspended, lastLoginTime, ...), plus "usage": {service: bytes} if known. """
+    users = STATE.get_items(STATE_SERVICE, domain, "user")
+    fetched = STATE.get_cursor(STATE_SERVICE, domain, "fetched", 0)
+    refreshed = STATE.get_cursor(STATE_SERVICE, domain, "refreshed", 0)
+    now = time.time()
+    if users and not refresh and now - refreshed < USERS_REFRESH_INTERVAL:
+        return users
+
+    directory, reports = get_services()
+    if users and not refresh and reports is not None and now - fetched < USERS_CACHE_TTL:
+        try:
+            changes = apply_admin_events(reports, users, refreshed - USERS_AUDIT_LOG_OVERLAP)
+            apply_login_events(reports, users, refreshed - USERS_AUDIT_LOG_OVERLAP)
+        except HttpError as err:
+            logger.warning("Reading the admin audit log failed, listing all users: %r", err)
+        else:
+            logger.info("Updated cached user list with %s changes", changes)
+            STATE.clear_items(STATE_SERVICE, domain, "user")
+            STATE.set_items(STATE_SERVICE, domain, "user", users)
+            STATE.set_cursor(STATE_SERVICE, domain, "refreshed", now)
+            STATE.commit(STATE_SERVICE, domain)
+            return users
+
+    users = list_users(directory, domain)
+    if reports is not None:
+        try:
+            add_usage(reports, users)
+        except HttpError as err:
+            logger.warning("Reading the usage report failed: %r", err)
+    logger.info("Fetched %s users", len(users))
+    STATE.clear_items(STATE_SERVICE, domain, "user")
+    STATE.set_items(STATE_SERVICE, domain, "user", users)
+    STATE.set_cursor(STATE_SERVICE, domain, "fetched", now)
+    STATE.set_cursor(STATE_SERVICE, domain, "refreshed", now)
+    STATE.commit(STATE_SERVICE, domain)
+    return users
+
+
+def get_users(domain, refresh=False):
+    """ Returns non-suspended users in random order. """
+    users_filtered = [
+        email for email, user in get_user_directory(domain, refresh).items() if not user.get("suspended", True)
+    ]
     random.shuffle(users_filtered)
 
     return users_filtered
 
 
+def is_dormant(user, days):
+    """ True if the user has not logged in for the given number of days. Users created in that time and users whose
+        login time is unknown (created since the last full listing) are not dormant. """
+    if not user.get("lastLoginTime"):
+        return False
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    return all(parse_rfc3339(user[field]) < since for field in ("lastLoginTime", "creationTime") if user.get(field))
+
+
 def usage():
     print("""
 Usage: %s <domain>
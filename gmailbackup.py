@@ -1,25 +1,31 @@
+import imaplib
 import multiprocessing
 import os
-import re
-import subprocess
 import sys
 import time
 
-import httplib2
-import progressbar
-from oauth2client.client import SignedJwtAssertionCredentials
+from apiclient.errors import HttpError
 from .settings import *
 
 from .get_users import get_users
-from .helpers import BackupBase, get_logger, timeit
+from .helpers import CREDENTIALS, BackupBase, execute_with_retry, get_logger, timeit
+from .gmailhistory import HistoryExpired, HistorySync
+from .imapsync import ImapError, ImapSync
+from .mailarchive import ArchiveStore
+from .mailstore import MaildirStore
+from .metrics import DOWNLOAD_BYTES, JOB_SECONDS, METRICS, finish_run, start_http_server
+from .progress import ProgressReporter, ProgressTracker, QueueSink
+from .storage import StorageError, provision, take_snapshot
+from .workerpool import WorkerPool
 
 PROCNAME = True
 try:
     import procname
 except ImportError:
-    NOPROCNAME = False
+    PROCNAME = False
 
 SYSTEM = "gmail"
+SCOPE = 'https://mail.google.com/'
 logger = get_logger(SYSTEM)
 
 
@@ -27,172 +33,127 @@ class GmailBackup(BackupBase):
     def __init__(self, user_email):
         super().__init__(SYSTEM, user_email)
 
-    def impersonate_user(self, scope='https://mail.google.com/'):
-        self.logger.debug("Impersonating user")
-        with open(SERVICE_ACCOUNT_PKCS12_FILE_PATH, 'rb') as keyfile:
-            key = keyfile.read()
-
-        credentials = SignedJwtAssertionCredentials(SERVICE_ACCOUNT_EMAIL, key, scope=scope, sub=self.user_email)
-        http = httplib2.Http(".cache")
-        http = credentials.authorize(http)
-        credentials.refresh(http)
-        return credentials
-
-    def get_offlineimap_config(self, access_token):
-        self.logger.debug("Fetching config file with path %s", self.rootpath)
-        #folderfilter = lambda folder: folder in ['INBOX']re.search('Gmail', folder)
-        return """
-[general]
-accounts = Gmail-%(email)s
-fsync = False
-
-
-[Account Gmail-%(email)s]
-localrepository = Local-%(email)s
-remoterepository = Remote-%(email)s
-status_backend = sqlite
-
-[Repository Local-%(email)s]
-type = Maildir
-localfolders = %(rootpath)s/maildir
-
-[Repository Remote-%(email)s]
-type = IMAP
-cert_fingerprint = b0ba392bba326e6feb1add4d04fa0fb86cd173fa
-xoauth_access_token = %(access_token)s
-remotehost = imap.gmail.com
-remoteuser = %(email)s
-ssl = yes
-remoteport = 993
-type = Gmail
-readonly = True
-maxconnections = 3
-
-""" % {
-            "email": self.user_email,
-            "rootpath": self.rootpath,
-            "access_token": access_token
-        }
+    def get_access_token(self):
+        return CREDENTIALS.get_credentials(self.user_email, SCOPE).access_token
+
+    def load_history_id(self):
+        history_id = self.run_state.get("history_id")
+        if history_id is None and os.path.exists("%s/history_id" % self.rootpath):
+            # Written by earlier versions.
+            with open("%s/history_id" % self.rootpath) as history_file:
+                history_id = history_file.read().strip() or None
+            self.save_history_id(history_id)
+            os.replace("%s/history_id" % self.rootpath, "%s/history_id.migrated" % self.rootpath)
+        return history_id
+
+    def save_history_id(self, history_id):
+        self.run_state.set("history_id", str(history_id) if history_id else None)
+        self.run_state.commit()
+
+    @timeit
+    def precheck(self):
+        """ Nothing has changed if the mailbox historyId is the one saved by the last successful sync. """
+        history_id = self.run_state.get("history_id")
+        if not history_id:
+            return True
+        service = self.impersonate_user(SCOPE, 'gmail', 'v1')
+        profile = execute_with_retry(service.users().getProfile(userId="me"), SYSTEM, "the profile", logger=self.logger)
+        return str(profile["historyId"]) != history_id
 
     def initialize_service(self):
-        if not os.path.exists("%s/maildir" % self.rootpath):
-            os.mkdir("%s/maildir" % self.rootpath)
-
+        if not os.path.exists("%s/%s" % (self.rootpath, GMAIL_STORAGE)):
+            os.mkdir("%s/%s" % (self.rootpath, GMAIL_STORAGE))
+
+    def open_store(self):
+        if GMAIL_STORAGE == "archive":
+            return ArchiveStore("%s/archive" % self.rootpath)
+        return MaildirStore("%s/maildir" % self.rootpath)
+
+    def report_progress(self, folder, event, count, size=0):
+        if event == "add_total":
+            self.logger.info("%s new messages in %s", count, folder)
+            self.progress.add_total(count)
+        elif event == "processed":
+            DOWNLOAD_BYTES.observe(size, service=SYSTEM)
+            self.progress.processed(count, size)
+
+    @timeit
     def run(self):
         if PROCNAME:
             procname.setprocname("Gmail:%s" % self.user_email)
         self.logger.info("Starting")
-
-        usercredentials = self.impersonate_user()
-        offlineimap_config = self.get_offlineimap_config(usercredentials.access_token)
-        config_filename = "config_files/offlineimap_config_%s" % self.user_email
-        open(config_filename, "w").write(offlineimap_config)
-
-        command = [
-            "/home/gmailbackup/gmailbackup/offlineimap/build/lib.linux-x86_64-2.7/offlineimaprun", "-c", config_filename,
-            "-q"
-        ]
-
-        p = subprocess.Popen(command, stderr=subprocess.PIPE)
-
         start = time.time()
-        stats = {}
-        total_processed = 0
-        total_messages = 0
-
-        while True:
-            line = p.stderr.readline()
-            if line is None or line == '':
-                break
-            matches = re.search(r' Copy message ([0-9]+) \(([0-9]+) of ([0-9]+)\) (.*)', line)
-            if not matches:
-                continue
-            folder_messages = matches.group(3)
-            folder = matches.group(4)
-            total_processed += 1
-            if folder not in stats:
-                stats[folder] = int(folder_messages)
-                if self.queue:
-                    self.queue.put(["add_total", int(folder_messages)])
-                total_messages = sum(stats.values())
-                self.logger.info("%s messages (%s processed)", total_messages, total_processed)
-            if self.queue:
-                self.queue.put(["processed"])
-
-        ret = p.wait()
+
+        store = self.open_store()
+        service = self.impersonate_user(SCOPE, 'gmail', 'v1')
+        history_id = self.load_history_id()
+        sync = None
+        ret = 1
+        try:
+            if history_id:
+                sync = HistorySync(service, store, self.logger, progress=self.report_progress)
+                try:
+                    self.save_history_id(sync.run(history_id))
+                    ret = 0
+                except HistoryExpired:
+                    self.logger.info("History since %s is no longer available, running full sync", history_id)
+                    sync = None
+            if sync is None:
+                # Read before the IMAP sync, so that changes made during the sync are picked up next time.
+                profile = execute_with_retry(
+                    service.users().getProfile(userId="me"), SYSTEM, "the profile", logger=self.logger
+                )
+                sync = ImapSync(self.user_email, self.get_access_token, store, self.logger, progress=self.report_progress)
+                if sync.run():
+                    self.save_history_id(profile["historyId"])
+                    ret = 0
+        except (imaplib.IMAP4.error, ImapError, HttpError, OSError) as err:
+            self.logger.error("Synchronizing failed: %r", err)
+        finally:
+            store.close()
+
+        total_processed = total_messages = total_removed = total_deduplicated = 0
+        if sync is not None:
+            total_processed, total_messages = sync.total_processed, sync.total_messages
+            total_removed, total_deduplicated = sync.total_removed, sync.total_deduplicated
         end = time.time()
         elapsed = end - start
         msgs = total_processed / elapsed
         self.logger.info(
-            "Finished with return code %s in %.2f seconds. Downloaded %s/%s messages. %.2f msg/s", ret, elapsed,
-            total_processed, total_messages, msgs
+            "Finished with return code %s in %.2f seconds. Downloaded %s/%s messages, %s already stored, removed %s. "
+            "%.2f msg/s", ret, elapsed, total_processed, total_messages, total_deduplicated, total_removed, msgs
         )
-        # Subtract messages not processed from progress bar.
-        if self.queue:
-            self.queue.put(["missed", total_messages - total_processed])
-            self.queue.put(["finished_user"])
+        # Messages not downloaded are subtracted from the remaining work.
+        self.progress.missed(total_messages - total_processed)
         if PROCNAME:
             procname.setprocname("Gmail:null")
         return ret
 
 
-MAX_THREADS = 5
+def runuser(user_email):
+    """ Runs in a worker process. Returns (exit code, metrics recorded in this process since the previous user). """
+    return (backup_user(user_email), METRICS.collect(reset=True))
 
 
-def main_progressbar(users, q, logger):
-    finished = max_val = missed = 0
-    is_a_tty = sys.stdout.isatty()
-
-    if is_a_tty:
-        main_progress = progressbar.ProgressBar(
-            widgets=[
-                progressbar.SimpleProgress(), " ",
-                progressbar.Percentage(), " ",
-                progressbar.ETA(), " ",
-                progressbar.FileTransferSpeed("msg")
-            ]
-        )
-        main_progress.start()
-
-    while True:
-        item = q.get()
-        if item[0] == "finished_user":
-            users -= 1
-            if users == 0:
-                break
-        if item[0] == "finished":
-            finished += item[1]
-            if is_a_tty:
-                main_progress.update(finished)
-        if item[0] == "add_total":
-            max_val += item[1]
-            if is_a_tty:
-                main_progress.maxval = max_val
-        if item[0] == "missed":
-            max_val -= item[1]
-            if is_a_tty:
-                main_progress.maxval = max_val
-            missed += item[1]
-        if item[0] == "processed":
-            finished += 1
-            if is_a_tty:
-                main_progress.update(finished)
-        if item[0] == "quit":
-            break
-    logger.info("Finished. Downloaded %s/%s messages. Missing %s", finished, max_val, missed)
-    if is_a_tty:
-        main_progress.finish()
-
-
-def runuser(user_email, queue):
+def backup_user(user_email):
     backup = GmailBackup(user_email)
-    backup.queue = queue
-    backup.initialize()
-    return backup.run()
+    backup.progress = ProgressReporter((SYSTEM, user_email), runuser.sink)
+    # Progress is finished here, like scheduler.run_job does, not by the backup itself.
+    try:
+        if not backup.has_changes():
+            backup.logger.info("No changes since the last run")
+            return 0
+        if not backup.initialize():
+            return 1
+        return backup.run()
+    finally:
+        backup.progress.finish()
 
 
-def runuser_init(queue):
-    runuser.queue = queue
+def runuser_init(progress_queue):
+    runuser.sink = QueueSink(progress_queue)
+    # Forked workers start with a copy of the main process' metrics.
+    METRICS.reset()
 
 
 def main():
@@ -201,28 +162,65 @@ def main():
 
     users = get_users(DOMAIN)
 
-    logger.info("Running with %s users and %s threads", len(users), MAX_THREADS)
-
-    manager = multiprocessing.Manager()
-    queue = manager.Queue()
-    pool = multiprocessing.Pool(MAX_THREADS, runuser_init, [queue])
-
-    results = []
-
-    parameters = []
-    for item in users:
-        parameters.append((item, queue))
-        runuser_init(queue)
-        print(runuser(item, queue))
-
+    logger.info("Running with %s users and %s processes", len(users), GMAIL_WORKERS)
+
+    # Workers send batched progress deltas; a plain queue avoids a Manager round trip per message.
+    progress_queue = multiprocessing.Queue()
+    tracker = ProgressTracker(logger, progress_queue)
+    pool = WorkerPool(
+        runuser, GMAIL_WORKERS, max_tasks_per_child=GMAIL_MAX_TASKS_PER_CHILD, timeout=GMAIL_USER_TIMEOUT,
+        max_attempts=GMAIL_MAX_ATTEMPTS, initializer=runuser_init, initargs=(progress_queue, ), logger=logger
+    )
+    start = time.time()
+    start_http_server()
+    try:
+        provision([GmailBackup(user).zfsrootpath for user in users], logger)
+    except (OSError, StorageError) as err:
+        logger.warning("Unable to provision datasets: %s", err)
+    tracker.start()
     try:
-        r = pool.map_async(runuser, parameters, callback=results.append)
-        main_progressbar(len(users), queue, logger)
-        r.wait()
-    except KeyboardInterrupt:
-        r.terminate()
-        r.wait()
+        results = pool.run(users)
+    finally:
+        tracker.stop()
+    if not pool.interrupted:
+        take_snapshot(logger)
+
+    totals = tracker.job_totals()
+    jobs = []
+    for user, result in results.items():
+        status, exit_code = result.status, None
+        if status == "ok":
+            exit_code, metrics = result.result
+            METRICS.merge(metrics)
+            if exit_code:
+                status = "failed"
+        JOB_SECONDS.observe(result.elapsed, service=SYSTEM, status=status)
+        job = {
+            "service": SYSTEM,
+            "user": user,
+            "status": status,
+            "elapsed": result.elapsed,
+            "attempts": result.attempts,
+            "exit_code": exit_code,
+            "error": result.error,
+        }
+        job.update(totals.get((SYSTEM, user), {}))
+        jobs.append(job)
+    finish_run(SYSTEM, start, jobs, logger)
+
+    failed = sorted(job["user"] for job in jobs if job["status"] != "ok")
+    logger.info(
+        "Finished %s/%s users%s, %s failed", len(results), len(users), " (interrupted)" if pool.interrupted else "",
+        len(failed)
+    )
+    for user in failed:
+        result = results[user]
+        logger.error(
+            "%s: %s after %s attempts: %s", user, result.status, result.attempts,
+            result.error or "exit code %s" % result.result[0]
+        )
+    return 1 if failed or pool.interrupted else 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Incremental Gmail sync through the Gmail API history endpoint.
+
+Lists what was added, deleted or relabeled since the saved historyId and updates the store for just those
+messages: raw messages are only downloaded for folders they are not in yet. Labels map to the folders IMAP
+would show them in. Raises HistoryExpired when the history window no longer reaches the saved historyId,
+in which case a full IMAP sync is needed.
+"""
+
+import base64
+
+from apiclient.errors import HttpError
+
+from .helpers import execute_batch, execute_with_retry, timeit
+
+API = "gmail"
+ALL_MAIL = "[Gmail]/All Mail"
+SYSTEM_LABEL_FOLDERS = {
+    "INBOX": "INBOX",
+    "SENT": "[Gmail]/Sent Mail",
+    "DRAFT": "[Gmail]/Drafts",
+    "STARRED": "[Gmail]/Starred",
+    "IMPORTANT": "[Gmail]/Important",
+    "SPAM": "[Gmail]/Spam",
+    "TRASH": "[Gmail]/Trash",
+}
+# Raw messages can be up to 25MB each, so they are fetched and written a few at a time.
+RAW_BATCH_SIZE = 10
+
+
+class HistoryExpired(Exception):
+    pass
+
+
+def api_id_to_msgid(api_id):
+    """ Gmail API message ids are X-GM-MSGID in hex. """
+    return str(int(api_id, 16))
+
+
+def label_flags(label_ids):
+    flags = []
+    if "UNREAD" not in label_ids:
+        flags.append("\\Seen")
+    if "STARRED" in label_ids:
+        flags.append("\\Flagged")
+    if "DRAFT" in label_ids:
+        flags.append("\\Draft")
+    return flags
+
+
+class HistorySync:
+    def __init__(self, service, store, logger, progress=None):
+        self.service = service
+        self.store = store
+        self.logger = logger
+        self.progress = progress
+        self.total_messages = 0
+        self.total_processed = 0
+        self.total_removed = 0
+        self.total_deduplicated = 0
+
+    @timeit
+    def list_history(self, start_history_id):
+        """ Returns (changed api ids, deleted api ids, current historyId). """
+        changed = set()
+        deleted = set()
+        page_token = None
+        while True:
+            try:
+                page = execute_with_retry(
+                    self.service.users().history().list(
+                        userId="me", startHistoryId=start_history_id, pageToken=page_token
+                    ), API, "history", logger=self.logger
+                )
+            except HttpError as err:
+                if err.resp.status == 404:
+                    raise HistoryExpired(start_history_id) from err
+                raise
+            for record in page.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    changed.add(added["message"]["id"])
+                for key in ("labelsAdded", "labelsRemoved"):
+                    for change in record.get(key, []):
+                        changed.add(change["message"]["id"])
+                for removed in record.get("messagesDeleted", []):
+                    deleted.add(removed["message"]["id"])
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return (changed - deleted, deleted, page["historyId"])
+
+    def label_folders(self):
+        """ Returns {label id: folder}. System folders use the names IMAP already reported, e.g. "[Google Mail]/...". """
+        known = self.store.folders()
+        folders = {}
+        for label_id, folder in SYSTEM_LABEL_FOLDERS.items():
+            localized = folder.replace("[Gmail]/", "[Google Mail]/")
+            folders[label_id] = localized if folder not in known and localized in known else folder
+        labels = execute_with_retry(self.service.users().labels().list(userId="me"), API, "labels", logger=self.logger)
+        for label in labels.get("labels", []):
+            if label.get("type") == "user":
+                folders[label["id"]] = label["name"]
+        return folders
+
+    def all_mail_folder(self):
+        localized = ALL_MAIL.replace("[Gmail]/", "[Google Mail]/")
+        if ALL_MAIL not in self.store.folders() and localized in self.store.folders():
+            return localized
+        return ALL_MAIL
+
+    def wanted_folders(self, label_ids, label_folders):
+        folders = {label_folders[label_id] for label_id in label_ids if label_id in label_folders}
+        if "SPAM" not in label_ids and "TRASH" not in label_ids:
+            folders.add(self.all_mail_folder())
+        return folders
+
+    def remove_message(self, msgid):
+        for folder in self.store.folders_of(msgid):
+            self.store.remove_msgid(folder, msgid)
+            self.total_removed += 1
+
+    def run(self, start_history_id):
+        """ Applies changes since start_history_id. Returns the new historyId. """
+        changed, deleted, history_id = self.list_history(start_history_id)
+        self.logger.info("History since %s: %s changed, %s deleted", start_history_id, len(changed), len(deleted))
+        for api_id in deleted:
+            self.remove_message(api_id_to_msgid(api_id))
+        if not changed:
+            self.store.commit()
+            return history_id
+
+        label_folders = self.label_folders()
+        metadata, errors = execute_batch(
+            {
+                api_id: self.service.users().messages().get(userId="me", id=api_id, format="minimal")
+                for api_id in changed
+            }, API, "message labels", logger=self.logger
+        )
+        for api_id, err in errors.items():
+            if isinstance(err, HttpError) and err.resp.status == 404:
+                # Deleted after the history was read.
+                self.remove_message(api_id_to_msgid(api_id))
+            else:
+                raise err
+
+        downloads = {}
+        for api_id, message in metadata.items():
+            msgid = api_id_to_msgid(api_id)
+            label_ids = message.get("labelIds", [])
+            wanted = self.wanted_folders(label_ids, label_folders)
+            present = self.store.folders_of(msgid)
+            flags = label_flags(label_ids)
+            # Label changes are copied from a folder that already has the message, before it is removed there.
+            missing = set()
+            for folder in wanted - present:
+                if folder not in self.store.folders():
+                    self.store.add_folder(folder)
+                if self.store.add_existing(folder, None, msgid, flags):
+                    self.total_deduplicated += 1
+                else:
+                    missing.add(folder)
+            for folder in present - wanted:
+                self.store.remove_msgid(folder, msgid)
+                self.total_removed += 1
+            if missing:
+                downloads[api_id] = (missing, flags)
+
+        self.total_messages = len(downloads)
+        if self.progress and downloads:
+            self.progress("history", "add_total", len(downloads))
+        pending = list(downloads)
+        for start in range(0, len(pending), RAW_BATCH_SIZE):
+            raw_messages, errors = execute_batch(
+                {
+                    api_id: self.service.users().messages().get(userId="me", id=api_id, format="raw")
+                    for api_id in pending[start:start + RAW_BATCH_SIZE]
+                }, API, "raw messages", logger=self.logger
+            )
+            if errors:
+                raise next(iter(errors.values()))
+            for api_id, message in raw_messages.items():
+                folders, flags = downloads[api_id]
+                raw = base64.urlsafe_b64decode(message["raw"].encode("ascii"))
+                for folder in folders:
+                    self.store.add(folder, None, api_id_to_msgid(api_id), flags, raw)
+                self.total_processed += 1
+                if self.progress:
+                    self.progress("history", "processed", 1, len(raw))
+        self.store.commit()
+        return history_id
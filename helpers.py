@@ -1,18 +1,29 @@
+import datetime
+import http.client
+import json
 import logging
 import logging.handlers
 import os
 import pwd
-import subprocess
+import random
+import sqlite3
+import threading
 import time
-from functools import wraps
+import urllib.error
 
 import httplib2
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document
+from apiclient.errors import HttpError
+from apiclient.http import BatchHttpRequest
 from oauth2client.client import SignedJwtAssertionCredentials
 
+from .asynchttp import get_http
+from .metrics import API_ATTEMPTS, API_REQUEST_SECONDS, API_RETRIES, METRICS, THROTTLE_WAIT_SECONDS, timeit
+from .progress import NULL_REPORTER
 from .settings import *
+from .storage import STORAGE, StorageError
 
-TIMING = {}
+DISCOVERY_URI = GOOGLE_DISCOVERY_URI
 
 
 def get_logger(system):
@@ -25,19 +36,457 @@ def get_logger(system):
     return logger
 
 
-def timeit(func):
-    @wraps(func)
-    def timer(*args, **kwargs):
+class CredentialCache:
+    """ Process-wide cache for service account credentials and API discovery documents.
+
+        The PKCS12 key is read once, access tokens are kept per (user, scope) until TOKEN_REFRESH_MARGIN
+        seconds before they expire, and each discovery document is fetched once per (service, version). """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key = None
+        self.credentials = {}
+        self.credential_locks = {}
+        self.discovery_documents = {}
+
+    def get_key(self):
+        with self.lock:
+            if self.key is None:
+                with open(SERVICE_ACCOUNT_PKCS12_FILE_PATH, 'rb') as keyfile:
+                    self.key = keyfile.read()
+            return self.key
+
+    @staticmethod
+    def is_fresh(credentials):
+        if not credentials.access_token or not credentials.token_expiry:
+            return False
+        remaining = credentials.token_expiry - datetime.datetime.utcnow()
+        return remaining > datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN)
+
+    def get_credentials(self, user_email, scope):
+        """ Returns valid credentials for user_email, refreshing the access token only if it is about to expire. """
+        cache_key = (user_email, scope)
+        key = self.get_key()
+        with self.lock:
+            if cache_key not in self.credentials:
+                self.credentials[cache_key] = SignedJwtAssertionCredentials(
+                    SERVICE_ACCOUNT_EMAIL, key, scope=scope, sub=user_email
+                )
+                self.credential_locks[cache_key] = threading.Lock()
+            credentials = self.credentials[cache_key]
+            credential_lock = self.credential_locks[cache_key]
+        with credential_lock:
+            if not self.is_fresh(credentials):
+                credentials.refresh(httplib2.Http())
+        return credentials
+
+    def get_discovery_document(self, service_name, service_version):
+        cache_key = (service_name, service_version)
+        with self.lock:
+            document = self.discovery_documents.get(cache_key)
+        if document is None:
+            resp, document = httplib2.Http(".cache").request(DISCOVERY_URI % (service_name, service_version))
+            if resp.status >= 400:
+                raise IOError("Fetching discovery document for %s %s failed with status %s" % (
+                    service_name, service_version, resp.status))
+            with self.lock:
+                self.discovery_documents[cache_key] = document
+        return document
+
+    def build(self, service_name, service_version, http):
+        """ Builds an API client from the cached discovery document without any network round trips. """
+        document = self.get_discovery_document(service_name, service_version)
+        return build_from_document(document, base=DISCOVERY_URI % (service_name, service_version), http=http)
+
+
+CREDENTIALS = CredentialCache()
+
+
+class QuotaExhausted(Exception):
+    pass
+
+
+class RateLimiter:
+    """ Token bucket for a single API, shared by all workers in the process.
+
+        Quota errors halve the request rate for everyone and pause all requests for Retry-After seconds;
+        each successful request brings the rate back up a little. """
+
+    MIN_MULTIPLIER = 0.05
+    RECOVERY_STEP = 0.01
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.multiplier = 1.0
+        self.paused_until = 0
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """ Blocks until tokens requests may be sent. Returns number of seconds waited. """
+        tokens = min(tokens, self.burst)
+        waited = 0.0
+        while True:
+            with self.lock:
+                if self.exhausted:
+                    raise QuotaExhausted("Daily quota for %s is exhausted" % self.name)
+                now = time.monotonic()
+                rate = self.rate * self.multiplier
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = max(self.paused_until - now, (tokens - self.tokens) / rate)
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self):
+        with self.lock:
+            self.multiplier = min(1.0, self.multiplier + self.RECOVERY_STEP)
+
+    def on_quota_error(self, retry_after=None):
+        with self.lock:
+            self.multiplier = max(self.MIN_MULTIPLIER, self.multiplier / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            return self.multiplier
+
+    def on_quota_exhausted(self):
+        with self.lock:
+            self.exhausted = True
+
+
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+QUOTA_EXHAUSTED_REASONS = ("dailyLimitExceeded", "downloadQuotaExceeded")
+RETRYABLE_STATUSES = (500, 502, 503, 504)
+
+
+def get_rate_limiter(api):
+    with RATE_LIMITERS_LOCK:
+        if api not in RATE_LIMITERS:
+            rate, burst = API_RATE_LIMITS.get(api, API_RATE_LIMITS["default"])
+            RATE_LIMITERS[api] = RateLimiter(api, rate, burst)
+        return RATE_LIMITERS[api]
+
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def error_reasons(content):
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", "replace")
+    try:
+        errors = json.loads(content).get("error", {}).get("errors", [])
+    except (ValueError, AttributeError):
+        return []
+    return [error.get("reason") for error in errors]
+
+
+def classify_error(err):
+    """ Returns (kind, retry_after) where kind is one of "retry", "quota", "exhausted" or None for permanent errors. """
+    if isinstance(err, HttpError):
+        status, retry_after, content = err.resp.status, err.resp.get("retry-after"), err.content
+    elif isinstance(err, urllib.error.HTTPError):
+        status, retry_after = err.code, err.headers.get("Retry-After")
+        try:
+            content = err.read()
+        except (OSError, http.client.HTTPException):
+            content = b""
+    elif isinstance(err, (OSError, http.client.HTTPException, httplib2.HttpLib2Error)):
+        return ("retry", None)
+    else:
+        return (None, None)
+    retry_after = parse_retry_after(retry_after)
+    reasons = error_reasons(content)
+    if status == 403 and any(reason in QUOTA_EXHAUSTED_REASONS for reason in reasons):
+        return ("exhausted", retry_after)
+    if status == 429 or (status == 403 and any(reason in RATE_LIMIT_REASONS for reason in reasons)):
+        return ("quota", retry_after)
+    if status in RETRYABLE_STATUSES:
+        return ("retry", retry_after)
+    return (None, None)
+
+
+def backoff_delay(attempt):
+    """ Exponential backoff with full jitter. """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def call_with_retry(func, api, description, logger=None, retry_on=(), tokens=1):
+    """ Calls func() through the rate limiter of api, retrying transient failures and quota errors.
+
+        Exceptions in retry_on are retried as well. The last exception is raised when all attempts fail.
+        tokens is the number of API calls func() makes, for batch requests. """
+    logger = logger or logging.getLogger("retry")
+    limiter = get_rate_limiter(api)
+    attempt = 0
+    while True:
+        THROTTLE_WAIT_SECONDS.observe(limiter.acquire(tokens), api=api)
         start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        name = func.__name__
-        if name not in TIMING:
-            TIMING[name] = []
-        TIMING[name].append(end - start)
+        try:
+            result = func()
+        except Exception as err:  # pylint: disable=broad-except
+            kind, retry_after = classify_error(err)
+            if kind is None and isinstance(err, retry_on):
+                kind = "retry"
+            API_REQUEST_SECONDS.observe(time.time() - start, api=api, outcome=kind or "error")
+            if kind == "exhausted":
+                limiter.on_quota_exhausted()
+                logger.error("Quota for %s is exhausted while fetching %s", api, description)
+                API_ATTEMPTS.observe(attempt + 1, api=api)
+                raise QuotaExhausted("Quota for %s is exhausted" % api) from err
+            if kind is None or attempt == RETRY_MAX_ATTEMPTS - 1:
+                API_ATTEMPTS.observe(attempt + 1, api=api)
+                raise
+            API_RETRIES.inc(api=api, reason=kind)
+            if kind == "quota":
+                multiplier = limiter.on_quota_error(retry_after)
+                logger.warning("Rate limited while fetching %s. Throttling %s to %d%%", description, api, multiplier * 100)
+            else:
+                logger.warning("Fetching %s failed with %r, retrying", description, err)
+            time.sleep(retry_after or backoff_delay(attempt))
+            attempt += 1
+            continue
+        API_REQUEST_SECONDS.observe(time.time() - start, api=api, outcome="ok")
+        API_ATTEMPTS.observe(attempt + 1, api=api)
+        limiter.on_success()
         return result
 
-    return timer
+
+def execute_with_retry(request, api, description, logger=None):
+    return call_with_retry(request.execute, api, description, logger=logger)
+
+
+def execute_batch(requests, api, description, logger=None, batch_size=None):
+    """ Executes {key: request} through the batch HTTP endpoint, batch_size requests per round trip.
+
+        Requests that fail inside a batch are retried individually with execute_with_retry.
+        Returns (responses, errors): {key: response} and {key: exception} for requests that failed for good. """
+    batch_size = batch_size or API_BATCH_SIZE
+    keys = list(requests)
+    responses = {}
+    errors = {}
+    for start in range(0, len(keys), batch_size):
+        chunk = keys[start:start + batch_size]
+        batch_errors = {}
+
+        def callback(request_id, response, exception, chunk=chunk, batch_errors=batch_errors):
+            key = chunk[int(request_id)]
+            if exception is None:
+                responses[key] = response
+            else:
+                batch_errors[key] = exception
+
+        def send(chunk=chunk, callback=callback):
+            batch = BatchHttpRequest(callback=callback, batch_uri=GOOGLE_BATCH_URI)
+            for index, key in enumerate(chunk):
+                batch.add(requests[key], request_id=str(index))
+            batch.execute()
+
+        call_with_retry(send, api, "%s (batch of %s)" % (description, len(chunk)), logger=logger, tokens=len(chunk))
+        for key in batch_errors:
+            try:
+                responses[key] = execute_with_retry(requests[key], api, description, logger=logger)
+            except QuotaExhausted:
+                raise
+            except Exception as err:  # pylint: disable=broad-except
+                errors[key] = err
+    return (responses, errors)
+
+
+class StateStore:
+    """ Run state of every service and user: cursors (change ids, sync tokens, page tokens of an unfinished listing)
+        and per-item state (for example, which Drive files are stored).
+
+        Kept in a single sqlite database in WAL mode, so that worker processes can read while another one writes.
+        Changes are kept in memory per service and user until commit(service, user), or until STATE_COMMIT_INTERVAL
+        of them are pending, and are then written in one short transaction. Reads see pending changes. Callers
+        commit at the points an interrupted run can resume from; a job never commits another job's changes, and
+        no write transaction stays open while a job waits for the network. The connection is opened lazily in each
+        process. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = None
+        self.pid = None
+        # {(service, user): {"cursors": {name: value}, "items": {kind: {item id: value}}, "cleared": set of kinds,
+        # "writes": count}}; None values are deletions.
+        self.pending = {}
+
+    def connection(self):
+        if self.db is None or self.pid != os.getpid():
+            # Autocommit: reads take no locks, writes are wrapped in BEGIN IMMEDIATE ... COMMIT by flush().
+            self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            self.pid = os.getpid()
+            self.pending = {}
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS cursors (
+                    service TEXT, user TEXT, name TEXT, value TEXT, updated REAL, PRIMARY KEY (service, user, name)
+                );
+                CREATE TABLE IF NOT EXISTS items (
+                    service TEXT, user TEXT, kind TEXT, item_id TEXT, value TEXT,
+                    PRIMARY KEY (service, user, kind, item_id)
+                );
+                """
+            )
+        return self.db
+
+    def changes(self, service, user):
+        """ Pending changes of a job. Called with self.lock held. """
+        self.connection()
+        key = (service, user)
+        if key not in self.pending:
+            self.pending[key] = {"cursors": {}, "items": {}, "cleared": set(), "writes": 0}
+        return self.pending[key]
+
+    def written(self, service, user, count):
+        """ Called with self.lock held. """
+        changes = self.changes(service, user)
+        changes["writes"] += count
+        if changes["writes"] >= STATE_COMMIT_INTERVAL:
+            self.commit(service, user)
+
+    def commit(self, service, user):
+        """ Writes the pending changes of a single job. """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            changes = self.pending.pop((service, user), None)
+            if changes is None:
+                return
+            db = self.connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(
+                    "DELETE FROM items WHERE service = ? AND user = ? AND kind = ?",
+                    [(service, user, kind) for kind in changes["cleared"]]
+                )
+                for kind, items in changes["items"].items():
+                    db.executemany(
+                        "DELETE FROM items WHERE service = ? AND user = ? AND kind = ? AND item_id = ?",
+                        [(service, user, kind, item_id) for item_id, value in items.items() if value is None]
+                    )
+                    db.executemany(
+                        "INSERT OR REPLACE INTO items (service, user, kind, item_id, value) VALUES (?, ?, ?, ?, ?)",
+                        [(service, user, kind, item_id, json.dumps(value))
+                         for item_id, value in items.items() if value is not None]
+                    )
+                db.executemany(
+                    "DELETE FROM cursors WHERE service = ? AND user = ? AND name = ?",
+                    [(service, user, name) for name, value in changes["cursors"].items() if value is None]
+                )
+                db.executemany(
+                    "INSERT OR REPLACE INTO cursors (service, user, name, value, updated) VALUES (?, ?, ?, ?, ?)",
+                    [(service, user, name, json.dumps(value), time.time())
+                     for name, value in changes["cursors"].items() if value is not None]
+                )
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def get_cursor(self, service, user, name, default=None):
+        with self.lock:
+            cursors = self.changes(service, user)["cursors"]
+            if name in cursors:
+                return default if cursors[name] is None else cursors[name]
+            row = self.connection().execute(
+                "SELECT value FROM cursors WHERE service = ? AND user = ? AND name = ?", (service, user, name)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_cursors(self, service, user):
+        with self.lock:
+            rows = self.connection().execute(
+                "SELECT name, value FROM cursors WHERE service = ? AND user = ?", (service, user)
+            ).fetchall()
+            pending = dict(self.changes(service, user)["cursors"])
+        cursors = {name: json.loads(value) for name, value in rows}
+        cursors.update(pending)
+        return {name: value for name, value in cursors.items() if value is not None}
+
+    def set_cursor(self, service, user, name, value):
+        """ Sets a cursor; None removes it. """
+        with self.lock:
+            self.changes(service, user)["cursors"][name] = value
+            self.written(service, user, 1)
+
+    def get_items(self, service, user, kind):
+        with self.lock:
+            changes = self.changes(service, user)
+            rows = []
+            if kind not in changes["cleared"]:
+                rows = self.connection().execute(
+                    "SELECT item_id, value FROM items WHERE service = ? AND user = ? AND kind = ?", (service, user, kind)
+                ).fetchall()
+            pending = dict(changes["items"].get(kind, {}))
+        items = {item_id: json.loads(value) for item_id, value in rows}
+        items.update(pending)
+        return {item_id: value for item_id, value in items.items() if value is not None}
+
+    def set_items(self, service, user, kind, items):
+        """ Stores {item id: value}; a value of None removes the item. """
+        if not items:
+            return
+        with self.lock:
+            self.changes(service, user)["items"].setdefault(kind, {}).update(items)
+            self.written(service, user, len(items))
+
+    def clear_items(self, service, user, kind):
+        with self.lock:
+            changes = self.changes(service, user)
+            changes["cleared"].add(kind)
+            changes["items"][kind] = {}
+            self.written(service, user, 1)
+
+
+STATE = StateStore(STATE_DATABASE)
+
+
+class RunState:
+    """ StateStore view for a single service and user. """
+
+    def __init__(self, store, service, user):
+        self.store = store
+        self.service = service
+        self.user = user
+
+    def get(self, name, default=None):
+        return self.store.get_cursor(self.service, self.user, name, default)
+
+    def cursors(self):
+        return self.store.get_cursors(self.service, self.user)
+
+    def set(self, name, value):
+        self.store.set_cursor(self.service, self.user, name, value)
+
+    def items(self, kind):
+        return self.store.get_items(self.service, self.user, kind)
+
+    def set_items(self, kind, items):
+        self.store.set_items(self.service, self.user, kind, items)
+
+    def clear_items(self, kind):
+        self.store.clear_items(self.service, self.user, kind)
+
+    def commit(self):
+        self.store.commit(self.service, self.user)
 
 
 class BackupBase:
@@ -46,43 +495,51 @@ class BackupBase:
         self.user_email = user_email
         self.zfsrootpath = "%s/%s/%s" % (ZPOOL_ROOT_PATH, system, user_email.replace("@", "__"))
         self.rootpath = "/%s" % self.zfsrootpath
-        self.queue = None
+        self.progress = NULL_REPORTER
+        self.run_state = RunState(STATE, system, user_email)
         self.logger = logging.getLogger("%s.%s" % (system, user_email))
         self.timing = {}
+        self.credentials = None
+        self.scope = None
 
     def print_timing(self):
-        print(TIMING)
+        print(METRICS.render())
 
     @timeit
     def _impersonate_user(self, scope):
         assert scope
 
         self.logger.debug("Impersonating user %s", self.user_email)
-        with open(SERVICE_ACCOUNT_PKCS12_FILE_PATH, 'rb') as f:
-            key = f.read()
-
-        credentials = SignedJwtAssertionCredentials(SERVICE_ACCOUNT_EMAIL, key, scope=scope, sub=self.user_email)
-        http = httplib2.Http(".cache")
-        http = credentials.authorize(http)
-        credentials.refresh(http)
+        credentials = CREDENTIALS.get_credentials(self.user_email, scope)
+        http = credentials.authorize(get_http(self.system))
         return (http, credentials)
 
     @timeit
     def impersonate_user(self, scope, service_name, service_version=None):
-        (http, _) = self._impersonate_user(scope)
-        service = build(serviceName=service_name, version=service_version, http=http)
+        (http, self.credentials) = self._impersonate_user(scope)
+        self.scope = scope
+        service = CREDENTIALS.build(service_name, service_version, http)
         return service
 
+    def authorization_headers(self):
+        """ Returns headers for requests made outside of the API client, refreshing the access token if needed. """
+        assert self.credentials
+        self.credentials = CREDENTIALS.get_credentials(self.user_email, self.scope)
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
     @timeit
     def initialize(self):
         assert self.system
 
+        # Datasets are normally created in bulk by storage.provision() before the run.
         if not os.path.exists(self.rootpath):
             self.logger.info("Creating %s for %s", self.rootpath, self.user_email)
-            zfs_p = subprocess.Popen(["/usr/bin/sudo", "/sbin/zfs", "create", self.zfsrootpath])
-            retcode = zfs_p.wait()
-            if retcode != 0:
-                self.logger.error("Unable to create %s for %s", self.rootpath, self.user_email)
+            try:
+                STORAGE.create([self.zfsrootpath])
+            except StorageError as err:
+                self.logger.error("Unable to create %s for %s: %s", self.rootpath, self.user_email, err)
                 return False
 
         if not os.path.exists(self.rootpath):
@@ -90,10 +547,10 @@ class BackupBase:
             return False
 
         if pwd.getpwuid(os.stat(self.rootpath).st_uid).pw_name != BACKUP_OWNER:
-            chown_p = subprocess.Popen(["/usr/bin/sudo", "/bin/chown", BACKUP_OWNER, self.rootpath])
-            retcode = chown_p.wait()
-            if retcode != 0:
-                self.logger.error("Unable to change ownership of %s to %s", self.rootpath, BACKUP_OWNER)
+            try:
+                STORAGE.chown([self.zfsrootpath])
+            except StorageError as err:
+                self.logger.error("Unable to change ownership of %s to %s: %s", self.rootpath, BACKUP_OWNER, err)
                 return False
 
         try:
@@ -103,5 +560,18 @@ class BackupBase:
 
         return True
 
+    def precheck(self):
+        """ Returns False if a cheap check shows there is nothing new to back up since the last successful run.
+            Runs before initialize(), so it must not depend on the backup directory. """
+        return True
+
+    def has_changes(self):
+        """ precheck(), with errors counted as changes so that the full run reports them. """
+        try:
+            return self.precheck()
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.warning("Precheck failed: %r", err)
+            return True
+
     def run(self, *args, **kwargs):
         raise NotImplementedError("run() is not implemented")
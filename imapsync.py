@@ -0,0 +1,320 @@
+"""
+In-process Gmail IMAP engine.
+
+Authenticates with XOAUTH2 and keeps up to GMAIL_IMAP_CONNECTIONS connections per user. Folders are examined
+read-only; UIDs missing from the local store are fetched in UID FETCH batches of GMAIL_FETCH_BATCH_SIZE, with up to
+GMAIL_PIPELINE_DEPTH commands in flight per connection. Messages removed from the server are removed locally.
+A message with several labels is downloaded once (by X-GM-MSGID) and added to its other folders from the store.
+
+GMAIL_IMAP_HOST/PORT/SSL can point to a local IMAP stub for testing.
+"""
+
+import collections
+import imaplib
+import queue
+import re
+import threading
+
+from .metrics import timeit
+from .settings import (
+    GMAIL_FETCH_BATCH_SIZE, GMAIL_IMAP_CONNECTIONS, GMAIL_IMAP_HOST, GMAIL_IMAP_PORT, GMAIL_IMAP_SSL,
+    GMAIL_PIPELINE_DEPTH
+)
+
+FETCH_ITEMS = "(UID X-GM-MSGID FLAGS BODY.PEEK[])"
+LIST_RE = re.compile(r'^\((?P<flags>[^)]*)\) (?P<delimiter>"(?:[^"\\]|\\.)*"|NIL) (?P<name>.+)$')
+UID_RE = re.compile(r"\bUID (\d+)")
+MSGID_RE = re.compile(r"\bX-GM-MSGID (\d+)")
+FLAGS_RE = re.compile(r"\bFLAGS \(([^)]*)\)")
+BATCHES_PER_JOB = 20
+MSGID_BATCH_SIZE = 1000
+MAX_JOB_ATTEMPTS = 3
+
+
+class ImapError(Exception):
+    pass
+
+
+def quote_folder(folder):
+    return '"%s"' % folder.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def unquote_folder(name):
+    if name.startswith('"') and name.endswith('"'):
+        return re.sub(r"\\(.)", r"\1", name[1:-1])
+    return name
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def compress_uids(uids):
+    """ Formats sorted uids as an IMAP sequence set: 1,2,3,7 -> 1:3,7 """
+    ranges = []
+    for uid in uids:
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(first) if first == last else "%s:%s" % (first, last) for first, last in ranges)
+
+
+def parse_fetch(data):
+    """ Parses UID FETCH response data into (uid, msgid, flags, raw) tuples. """
+    messages = []
+    current = None
+    for item in data:
+        if isinstance(item, tuple):
+            if current:
+                messages.append(current)
+            current = [item[0].decode("utf-8", "replace"), item[1]]
+        elif current and item:
+            current[0] += item.decode("utf-8", "replace")
+    if current:
+        messages.append(current)
+    result = []
+    for header, raw in messages:
+        uid = UID_RE.search(header)
+        if not uid:
+            continue
+        msgid = MSGID_RE.search(header)
+        flags = FLAGS_RE.search(header)
+        result.append((
+            int(uid.group(1)), msgid.group(1) if msgid else None, flags.group(1).split() if flags else [], raw
+        ))
+    return result
+
+
+class ImapConnection:
+    def __init__(self, user_email, access_token):
+        if GMAIL_IMAP_SSL:
+            self.conn = imaplib.IMAP4_SSL(GMAIL_IMAP_HOST, GMAIL_IMAP_PORT)
+        else:
+            self.conn = imaplib.IMAP4(GMAIL_IMAP_HOST, GMAIL_IMAP_PORT)
+        auth_string = "user=%s\1auth=Bearer %s\1\1" % (user_email, access_token)
+        self.conn.authenticate("XOAUTH2", lambda _: auth_string.encode("utf-8"))
+        self.selected = None
+
+    def list_folders(self):
+        typ, data = self.conn.list()
+        if typ != "OK":
+            raise ImapError("LIST failed: %r" % data)
+        folders = []
+        for line in data:
+            if not line:
+                continue
+            matches = LIST_RE.match(line.decode("utf-8", "replace"))
+            if not matches or "\\noselect" in matches.group("flags").lower():
+                continue
+            folders.append(unquote_folder(matches.group("name")))
+        return folders
+
+    def examine(self, folder):
+        """ Selects folder read-only and returns its UIDVALIDITY. """
+        typ, data = self.conn.select(quote_folder(folder), readonly=True)
+        if typ != "OK":
+            raise ImapError("EXAMINE %s failed: %r" % (folder, data))
+        self.selected = folder
+        _, uidvalidity = self.conn.response("UIDVALIDITY")
+        return int(uidvalidity[0])
+
+    def search_uids(self):
+        typ, data = self.conn.uid("SEARCH", None, "ALL")
+        if typ != "OK":
+            raise ImapError("UID SEARCH failed: %r" % data)
+        return {int(uid) for uid in data[0].split()}
+
+    def fetch_metadata(self, uids):
+        """ Returns {uid: (X-GM-MSGID, flags)} without downloading the messages. """
+        metadata = {}
+        for batch in chunks(uids, MSGID_BATCH_SIZE):
+            typ, data = self.conn.uid("FETCH", compress_uids(batch), "(UID X-GM-MSGID FLAGS)")
+            if typ != "OK":
+                raise ImapError("UID FETCH failed: %r" % data)
+            for item in data:
+                if isinstance(item, tuple):
+                    item = item[0]
+                if not item:
+                    continue
+                item = item.decode("utf-8", "replace")
+                uid = UID_RE.search(item)
+                msgid = MSGID_RE.search(item)
+                flags = FLAGS_RE.search(item)
+                if uid and msgid:
+                    metadata[int(uid.group(1))] = (msgid.group(1), flags.group(1).split() if flags else [])
+        return metadata
+
+    def fetch_msgids(self, uids):
+        return {uid: msgid for uid, (msgid, _) in self.fetch_metadata(uids).items()}
+
+    def fetch(self, uid_batches, depth=GMAIL_PIPELINE_DEPTH):
+        """ Yields (uid, msgid, flags, raw) for all batches, keeping up to depth UID FETCH commands in flight.
+
+            imaplib has no public API for pipelining, so commands are sent with _command() and their responses
+            collected with _command_complete() in order. Responses to a later command arrive after the tagged
+            completion of an earlier one, so untagged FETCH data can be attributed to each command in turn. """
+        # pylint: disable=protected-access
+        in_flight = collections.deque()
+        batches = iter(uid_batches)
+        while True:
+            while len(in_flight) < depth:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                in_flight.append(self.conn._command("UID", "FETCH", compress_uids(batch), FETCH_ITEMS))
+            if not in_flight:
+                return
+            typ, data = self.conn._command_complete("FETCH", in_flight.popleft())
+            if typ != "OK":
+                raise ImapError("UID FETCH failed: %r" % data)
+            typ, data = self.conn._untagged_response(typ, data, "FETCH")
+            yield from parse_fetch(data)
+
+    def logout(self):
+        try:
+            self.conn.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+
+class ImapSync:
+    """ Synchronizes all folders of a single user into a store. """
+
+    def __init__(self, user_email, get_access_token, store, logger, progress=None):
+        self.user_email = user_email
+        self.get_access_token = get_access_token
+        self.store = store
+        self.logger = logger
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.total_messages = 0
+        self.total_processed = 0
+        self.total_removed = 0
+        self.total_deduplicated = 0
+        self.failed_jobs = 0
+        self.scheduled = set()
+        self.copies = []
+
+    def connect(self):
+        return ImapConnection(self.user_email, self.get_access_token())
+
+    @timeit
+    def plan(self, conn):
+        """ Compares every folder against the store. Removes deleted messages and returns fetch jobs. """
+        jobs = []
+        for folder in conn.list_folders():
+            uidvalidity = conn.examine(folder)
+            if not self.store.set_uidvalidity(folder, uidvalidity):
+                self.logger.warning("UIDVALIDITY of %s changed, downloading it again", folder)
+            remote = conn.search_uids()
+            missing_msgids = self.store.uids_without_msgid(folder)
+            if missing_msgids:
+                # Messages downloaded by offlineimap; the Gmail API history sync needs their X-GM-MSGID.
+                self.store.set_msgids(folder, conn.fetch_msgids(missing_msgids))
+            local = self.store.uids(folder)
+            for uid in local - remote:
+                self.store.remove(folder, uid)
+                self.total_removed += 1
+            new = sorted(remote - local)
+            if new:
+                new = self.skip_stored(conn, folder, new)
+            if not new:
+                continue
+            self.total_messages += len(new)
+            if self.progress:
+                self.progress(folder, "add_total", len(new))
+            batches = list(chunks(new, GMAIL_FETCH_BATCH_SIZE))
+            for job_batches in chunks(batches, BATCHES_PER_JOB):
+                jobs.append((folder, job_batches))
+        self.store.commit()
+        return jobs
+
+    def skip_stored(self, conn, folder, uids):
+        """ Messages that are already stored, either in another folder (labels) or through the Gmail API without
+            a UID, are recorded without downloading them again. Messages that are already scheduled for download in
+            another folder are copied after the download. Returns the uids that still need to be fetched. """
+        metadata = conn.fetch_metadata(uids)
+        missing = []
+        for uid in uids:
+            if uid not in metadata:
+                missing.append(uid)
+                continue
+            msgid, flags = metadata[uid]
+            if self.store.adopt(folder, uid, msgid) or self.store.add_existing(folder, uid, msgid, flags):
+                self.total_deduplicated += 1
+            elif msgid in self.scheduled:
+                self.copies.append((folder, uid, msgid, flags))
+            else:
+                self.scheduled.add(msgid)
+                missing.append(uid)
+        return missing
+
+    @timeit
+    def copy_scheduled(self):
+        """ Adds messages downloaded for another folder in this run. Returns the number of copies that failed
+            because the download failed; they are fetched on the next run. """
+        failed = 0
+        for folder, uid, msgid, flags in self.copies:
+            if self.store.add_existing(folder, uid, msgid, flags):
+                self.total_deduplicated += 1
+            else:
+                failed += 1
+        self.store.commit()
+        return failed
+
+    def worker(self, jobs, conn):
+        try:
+            while True:
+                try:
+                    folder, batches, attempt = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    if conn is None:
+                        conn = self.connect()
+                    if conn.selected != folder:
+                        conn.examine(folder)
+                    for uid, msgid, flags, raw in conn.fetch(batches):
+                        self.store.add(folder, uid, msgid, flags, raw)
+                        with self.lock:
+                            self.total_processed += 1
+                        if self.progress:
+                            self.progress(folder, "processed", 1, len(raw))
+                    self.store.commit()
+                except (imaplib.IMAP4.error, ImapError, OSError) as err:
+                    self.logger.warning("Fetching from %s failed: %r", folder, err)
+                    if conn is not None:
+                        conn.logout()
+                    conn = None
+                    if attempt + 1 < MAX_JOB_ATTEMPTS:
+                        jobs.put((folder, batches, attempt + 1))
+                    else:
+                        with self.lock:
+                            self.failed_jobs += 1
+        finally:
+            if conn is not None:
+                conn.logout()
+
+    def run(self):
+        """ Returns True if every message was downloaded. """
+        conn = self.connect()
+        plan = self.plan(conn)
+        jobs = queue.Queue()
+        for folder, batches in plan:
+            jobs.put((folder, batches, 0))
+        threads = []
+        for index in range(min(GMAIL_IMAP_CONNECTIONS, len(plan))):
+            thread = threading.Thread(
+                target=self.worker, args=(jobs, conn if index == 0 else None), name="imap-%s" % self.user_email
+            )
+            thread.start()
+            threads.append(thread)
+        if not threads:
+            conn.logout()
+        for thread in threads:
+            thread.join()
+        self.store.commit()
+        failed_copies = self.copy_scheduled()
+        return self.failed_jobs == 0 and failed_copies == 0
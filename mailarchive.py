@@ -0,0 +1,379 @@
+"""
+Compressed, deduplicated archive for Gmail messages.
+
+An alternative to MaildirStore (GMAIL_STORAGE = "archive"). Each message is stored once, keyed by its X-GM-MSGID,
+however many labels (folders) it has. Messages are compressed (zstd if the zstandard module is installed, zlib
+otherwise) and appended to segment files <root>/segments/<n>.seg of up to GMAIL_ARCHIVE_SEGMENT_SIZE bytes.
+Each record is a 1-byte codec, a 4-byte big-endian length and the compressed message.
+
+<root>/index.sqlite holds folder UIDVALIDITY, the label index (folder, uid) -> (X-GM-MSGID, flags) and
+X-GM-MSGID -> (segment, offset, length). Messages that are no longer in any folder are dropped on close(), and
+segments that are mostly unreferenced are rewritten.
+
+Usage:
+  mailarchive.py export-maildir <archive> <target>
+  mailarchive.py export-mbox <archive> <target> [<folder>...]
+  mailarchive.py import-maildir <maildir> <archive>
+  mailarchive.py -h | --help
+"""
+
+import glob
+import hashlib
+import mailbox
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import zlib
+
+from docopt import docopt
+
+from .mailstore import FLAG_MAP, MaildirStore, maildir_flags
+from .settings import GMAIL_ARCHIVE_COMPACTION_RATIO, GMAIL_ARCHIVE_SEGMENT_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HEADER = struct.Struct(">BI")
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+ZSTD_LEVEL = 9
+FLAG_NAMES = {letter: flag for flag, letter in FLAG_MAP.items()}
+
+
+def compress(raw):
+    if zstandard is not None:
+        return CODEC_ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return CODEC_ZLIB, zlib.compress(raw, 6)
+
+
+def decompress(codec, data):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Message is compressed with zstd, but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def message_key(msgid, raw):
+    """ Messages without X-GM-MSGID are keyed by their contents. """
+    if msgid:
+        return msgid
+    return "sha1:%s" % hashlib.sha1(raw).hexdigest()
+
+
+class ArchiveStore:
+    """ Same interface as MaildirStore. """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs("%s/segments" % root, exist_ok=True)
+        self.db = sqlite3.connect("%s/index.sqlite" % root, check_same_thread=False)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, uidvalidity INTEGER);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY, folder TEXT, uid INTEGER, msgid TEXT, flags TEXT, UNIQUE (folder, uid)
+            );
+            CREATE INDEX IF NOT EXISTS messages_msgid ON messages (msgid);
+            CREATE TABLE IF NOT EXISTS blobs (
+                msgid TEXT PRIMARY KEY, segment INTEGER, offset INTEGER, length INTEGER, codec INTEGER, size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS blobs_segment ON blobs (segment);
+            """
+        )
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+        self.segment_file = None
+
+    def segment_path(self, segment):
+        return "%s/segments/%d.seg" % (self.root, segment)
+
+    def segments(self):
+        return sorted(int(os.path.basename(path)[:-4]) for path in glob.glob("%s/segments/*.seg" % self.root))
+
+    def set_uidvalidity(self, folder, uidvalidity):
+        """ Records the folder's UIDVALIDITY. Returns False if it changed, in which case the folder
+            is emptied and has to be downloaded again. Message data is kept, so nothing is downloaded twice
+            if the messages are still in other folders. """
+        with self.lock:
+            row = self.db.execute("SELECT uidvalidity FROM folders WHERE folder = ?", (folder, )).fetchone()
+        if row is not None and row[0] is not None and row[0] != uidvalidity:
+            self.clear_folder(folder)
+            self.store_uidvalidity(folder, uidvalidity)
+            return False
+        self.store_uidvalidity(folder, uidvalidity)
+        return True
+
+    def add_folder(self, folder):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO folders (folder, uidvalidity) VALUES (?, NULL)", (folder, ))
+            self.db.commit()
+
+    def store_uidvalidity(self, folder, uidvalidity):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO folders (folder, uidvalidity) VALUES (?, ?)", (folder, uidvalidity))
+            self.db.commit()
+
+    def clear_folder(self, folder):
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE folder = ?", (folder, ))
+            self.db.commit()
+
+    def folders(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT folder FROM folders")}
+
+    def uids(self, folder):
+        with self.lock:
+            return {
+                row[0]
+                for row in self.db.execute("SELECT uid FROM messages WHERE folder = ? AND uid IS NOT NULL", (folder, ))
+            }
+
+    def uids_without_msgid(self, folder):
+        """ Messages imported without X-GM-MSGID are keyed by their contents until IMAP reports it. """
+        with self.lock:
+            return sorted(
+                row[0] for row in self.db.execute(
+                    "SELECT uid FROM messages WHERE folder = ? AND uid IS NOT NULL AND msgid LIKE 'sha1:%'", (folder, )
+                )
+            )
+
+    def set_msgids(self, folder, msgids):
+        with self.lock:
+            for uid, msgid in msgids.items():
+                row = self.db.execute("SELECT msgid FROM messages WHERE folder = ? AND uid = ?", (folder, uid)).fetchone()
+                if row is None or row[0] == msgid:
+                    continue
+                self.db.execute("UPDATE messages SET msgid = ? WHERE msgid = ?", (msgid, row[0]))
+                if self.db.execute("SELECT 1 FROM blobs WHERE msgid = ?", (msgid, )).fetchone():
+                    self.db.execute("DELETE FROM blobs WHERE msgid = ?", (row[0], ))
+                else:
+                    self.db.execute("UPDATE blobs SET msgid = ? WHERE msgid = ?", (msgid, row[0]))
+            self.db.commit()
+
+    def has_unassigned(self, folder):
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM messages WHERE folder = ? AND uid IS NULL LIMIT 1", (folder, )
+            ).fetchone() is not None
+
+    def folders_of(self, msgid):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT folder FROM messages WHERE msgid = ?", (msgid, ))}
+
+    def add_existing(self, folder, uid, msgid, flags):
+        """ Adds a message that is already stored for another folder. Returns False if it isn't. """
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM blobs WHERE msgid = ?", (msgid, )).fetchone() is None:
+                return False
+            self.db.execute(
+                "INSERT OR IGNORE INTO messages (folder, uid, msgid, flags) VALUES (?, ?, ?, ?)",
+                (folder, uid, msgid, maildir_flags(flags))
+            )
+        return True
+
+    def write_record(self, key, codec, data, size):
+        """ Appends a compressed message to the current segment. Called with self.lock held. """
+        if self.segment_file is None:
+            self.segment_file = open(self.segment_path(self.segment), "ab")
+        if self.segment_file.tell() >= GMAIL_ARCHIVE_SEGMENT_SIZE:
+            self.segment_file.close()
+            self.segment += 1
+            self.segment_file = open(self.segment_path(self.segment), "ab")
+        offset = self.segment_file.tell()
+        self.segment_file.write(HEADER.pack(codec, len(data)) + data)
+        self.db.execute(
+            "INSERT OR REPLACE INTO blobs (msgid, segment, offset, length, codec, size) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, self.segment, offset, len(data), codec, size)
+        )
+
+    def add(self, folder, uid, msgid, flags, raw):
+        """ Stores a message. Message data is only written if no other folder has the message yet. """
+        key = message_key(msgid, raw)
+        with self.lock:
+            if uid is not None:
+                existing = self.db.execute("SELECT 1 FROM messages WHERE folder = ? AND uid = ?", (folder, uid))
+            else:
+                existing = self.db.execute("SELECT 1 FROM messages WHERE folder = ? AND msgid = ?", (folder, key))
+            if existing.fetchone():
+                return
+            stored = self.db.execute("SELECT 1 FROM blobs WHERE msgid = ?", (key, )).fetchone() is not None
+        if not stored:
+            codec, data = compress(raw)
+        with self.lock:
+            if not stored and self.db.execute("SELECT 1 FROM blobs WHERE msgid = ?", (key, )).fetchone() is None:
+                self.write_record(key, codec, data, len(raw))
+            self.db.execute(
+                "INSERT INTO messages (folder, uid, msgid, flags) VALUES (?, ?, ?, ?)",
+                (folder, uid, key, maildir_flags(flags))
+            )
+
+    def adopt(self, folder, uid, msgid):
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE messages SET uid = ? WHERE folder = ? AND msgid = ? AND uid IS NULL", (uid, folder, msgid)
+            )
+            return cursor.rowcount > 0
+
+    def remove(self, folder, uid):
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE folder = ? AND uid = ?", (folder, uid))
+
+    def remove_msgid(self, folder, msgid):
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE folder = ? AND msgid = ?", (folder, msgid))
+
+    def messages(self, folder):
+        """ Yields (uid, msgid, flags) for every message in folder. """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT uid, msgid, flags FROM messages WHERE folder = ? ORDER BY uid", (folder, )
+            ).fetchall()
+        for uid, msgid, flags in rows:
+            yield uid, msgid, [FLAG_NAMES[letter] for letter in flags]
+
+    def read(self, msgid):
+        with self.lock:
+            if self.segment_file is not None:
+                self.segment_file.flush()
+            row = self.db.execute("SELECT segment, offset FROM blobs WHERE msgid = ?", (msgid, )).fetchone()
+        if row is None:
+            raise KeyError(msgid)
+        segment, offset = row
+        with open(self.segment_path(segment), "rb") as segment_file:
+            segment_file.seek(offset)
+            codec, length = HEADER.unpack(segment_file.read(HEADER.size))
+            return decompress(codec, segment_file.read(length))
+
+    def collect_garbage(self):
+        """ Drops messages that are not in any folder and rewrites segments where they took more than
+            GMAIL_ARCHIVE_COMPACTION_RATIO of the space. Called with self.lock held. """
+        self.db.execute("DELETE FROM blobs WHERE msgid NOT IN (SELECT msgid FROM messages)")
+        live = dict(
+            self.db.execute("SELECT segment, SUM(? + length) FROM blobs GROUP BY segment", (HEADER.size, )).fetchall()
+        )
+        for segment in self.segments():
+            if segment == self.segment:
+                continue
+            segment_size = os.stat(self.segment_path(segment)).st_size
+            if segment_size and live.get(segment, 0) < (1 - GMAIL_ARCHIVE_COMPACTION_RATIO) * segment_size:
+                self.compact_segment(segment)
+
+    def compact_segment(self, segment):
+        """ Copies live records of segment to the current segment and deletes it. Called with self.lock held. """
+        rows = self.db.execute(
+            "SELECT msgid, offset, length, codec, size FROM blobs WHERE segment = ? ORDER BY offset", (segment, )
+        ).fetchall()
+        with open(self.segment_path(segment), "rb") as segment_file:
+            for key, offset, length, codec, size in rows:
+                segment_file.seek(offset + HEADER.size)
+                self.write_record(key, codec, segment_file.read(length), size)
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+        self.db.commit()
+        os.unlink(self.segment_path(segment))
+
+    def commit(self):
+        with self.lock:
+            if self.segment_file is not None:
+                self.segment_file.flush()
+                os.fsync(self.segment_file.fileno())
+            self.db.commit()
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            self.collect_garbage()
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+            self.db.commit()
+            self.db.close()
+
+
+def export_maildir(archive, target):
+    """ Writes every folder to an offlineimap-style Maildir, UIDs included. """
+    os.makedirs(target, exist_ok=True)
+    store = MaildirStore(target)
+    with archive.lock:
+        uidvalidities = dict(archive.db.execute("SELECT folder, uidvalidity FROM folders").fetchall())
+    for folder, uidvalidity in sorted(uidvalidities.items()):
+        store.set_uidvalidity(folder, uidvalidity)
+        for uid, msgid, flags in archive.messages(folder):
+            store.add(folder, uid, msgid, flags, archive.read(msgid))
+        store.commit()
+    store.close()
+
+
+def export_mbox(archive, target, folders=None):
+    """ Writes one <folder>.mbox file per folder. """
+    os.makedirs(target, exist_ok=True)
+    for folder in sorted(folders or archive.folders()):
+        mbox = mailbox.mbox("%s/%s.mbox" % (target, folder.replace("/", ".")))
+        mbox.lock()
+        try:
+            for _, msgid, flags in archive.messages(folder):
+                message = mailbox.MaildirMessage(archive.read(msgid))
+                message.set_flags(maildir_flags(flags))
+                mbox.add(message)
+        finally:
+            mbox.flush()
+            mbox.unlock()
+            mbox.close()
+
+
+def import_maildir(store, archive):
+    """ Copies messages from a MaildirStore, for example an existing backup, into an archive. Folders that are not
+        in the store's index yet, as in a Maildir written by offlineimap, are indexed from disk first.
+
+        Raises ValueError if the Maildir has no folders. """
+    for folder in sorted(store.folders_on_disk() - store.folders()):
+        store.add_folder(folder)
+        store.seed_folder(folder)
+    with store.lock:
+        uidvalidities = dict(store.db.execute("SELECT folder, uidvalidity FROM folders").fetchall())
+    if not uidvalidities:
+        raise ValueError("No Maildir folders found in %s" % store.root)
+    for folder, uidvalidity in sorted(uidvalidities.items()):
+        archive.store_uidvalidity(folder, uidvalidity)
+        with store.lock:
+            rows = store.db.execute("SELECT uid, msgid, filename FROM messages WHERE folder = ?", (folder, )).fetchall()
+        for uid, msgid, filename in rows:
+            with open("%s/%s" % (store.folder_path(folder), filename), "rb") as message_file:
+                raw = message_file.read()
+            flags = [FLAG_NAMES[letter] for letter in filename.rpartition(":2,")[2] if letter in FLAG_NAMES]
+            archive.add(folder, uid, msgid, flags, raw)
+        archive.commit()
+
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments["import-maildir"]:
+        store = MaildirStore(arguments["<maildir>"])
+        archive = ArchiveStore(arguments["<archive>"])
+        try:
+            import_maildir(store, archive)
+        except ValueError as err:
+            print(err)
+            return 1
+        finally:
+            store.close()
+            archive.close()
+        return 0
+    archive = ArchiveStore(arguments["<archive>"])
+    if arguments["export-maildir"]:
+        export_maildir(archive, arguments["<target>"])
+    else:
+        export_mbox(archive, arguments["<target>"], arguments["<folder>"])
+    archive.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
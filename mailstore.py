@@ -0,0 +1,248 @@
+"""
+Maildir storage for Gmail messages.
+
+Uses the same layout offlineimap used: <root>/<folder, "/" replaced by ".">/{cur,new,tmp}, with file names
+carrying the IMAP UID (",U=<uid>,FMD5=<md5 of folder name>:2,<flags>"). An sqlite index in <root>/.index.sqlite keeps
+folder UIDVALIDITY and uid -> (X-GM-MSGID, file name) for incremental syncs.
+
+Messages fetched through the Gmail API have no UID yet. They are stored without ",U=" in the file name and get their
+UID when the next IMAP sync sees them (adopt()).
+"""
+
+import hashlib
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+FLAG_MAP = {
+    "\\Seen": "S",
+    "\\Answered": "R",
+    "\\Flagged": "F",
+    "\\Deleted": "T",
+    "\\Draft": "D",
+}
+
+FILENAME_UID_RE = re.compile(r",U=(?P<uid>\d+)")
+
+
+def maildir_flags(flags):
+    return "".join(sorted(FLAG_MAP[flag] for flag in flags if flag in FLAG_MAP))
+
+
+class MaildirStore:
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.hostname = socket.gethostname()
+        self.db = sqlite3.connect("%s/.index.sqlite" % root, check_same_thread=False)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, uidvalidity INTEGER);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY, folder TEXT, uid INTEGER, msgid TEXT, filename TEXT, UNIQUE (folder, uid)
+            );
+            CREATE INDEX IF NOT EXISTS messages_msgid ON messages (msgid);
+            """
+        )
+
+    def folder_path(self, folder):
+        return "%s/%s" % (self.root, folder.replace("/", "."))
+
+    def ensure_folder(self, folder):
+        for subdir in ("cur", "new", "tmp"):
+            os.makedirs("%s/%s" % (self.folder_path(folder), subdir), exist_ok=True)
+
+    def set_uidvalidity(self, folder, uidvalidity):
+        """ Records the folder's UIDVALIDITY. Returns False if it changed, in which case the folder
+            is emptied and has to be downloaded again. """
+        with self.lock:
+            row = self.db.execute("SELECT uidvalidity FROM folders WHERE folder = ?", (folder, )).fetchone()
+        if row is None:
+            self.ensure_folder(folder)
+            self.seed_folder(folder)
+        elif row[0] is not None and row[0] != uidvalidity:
+            self.clear_folder(folder)
+            self.ensure_folder(folder)
+            self.store_uidvalidity(folder, uidvalidity)
+            return False
+        self.store_uidvalidity(folder, uidvalidity)
+        return True
+
+    def add_folder(self, folder):
+        """ Creates a folder that IMAP has not seen yet, for a label that only exists in the Gmail API. """
+        self.ensure_folder(folder)
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO folders (folder, uidvalidity) VALUES (?, NULL)", (folder, ))
+            self.db.commit()
+
+    def store_uidvalidity(self, folder, uidvalidity):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO folders (folder, uidvalidity) VALUES (?, ?)", (folder, uidvalidity))
+            self.db.commit()
+
+    def seed_folder(self, folder):
+        """ Indexes messages already on disk, for example ones downloaded by offlineimap. """
+        rows = []
+        for subdir in ("cur", "new"):
+            for filename in os.listdir("%s/%s" % (self.folder_path(folder), subdir)):
+                matches = FILENAME_UID_RE.search(filename)
+                if matches:
+                    rows.append((folder, int(matches.group("uid")), None, "%s/%s" % (subdir, filename)))
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO messages (folder, uid, msgid, filename) VALUES (?, ?, ?, ?)", rows)
+            self.db.commit()
+
+    def clear_folder(self, folder):
+        with self.lock:
+            rows = self.db.execute("SELECT filename FROM messages WHERE folder = ?", (folder, )).fetchall()
+            self.db.execute("DELETE FROM messages WHERE folder = ?", (folder, ))
+            self.db.commit()
+        self.unlink(folder, rows)
+
+    def folders(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT folder FROM folders")}
+
+    def folders_on_disk(self):
+        """ Folders that have a Maildir under root, indexed or not. Names are guessed from the directory names, with
+            "." read as "/". """
+        return {
+            name.replace(".", "/")
+            for name in os.listdir(self.root)
+            if all(os.path.isdir("%s/%s/%s" % (self.root, name, subdir)) for subdir in ("cur", "new"))
+        }
+
+    def uids(self, folder):
+        with self.lock:
+            return {
+                row[0]
+                for row in self.db.execute("SELECT uid FROM messages WHERE folder = ? AND uid IS NOT NULL", (folder, ))
+            }
+
+    def uids_without_msgid(self, folder):
+        with self.lock:
+            return sorted(
+                row[0] for row in self.db.
+                execute("SELECT uid FROM messages WHERE folder = ? AND uid IS NOT NULL AND msgid IS NULL", (folder, ))
+            )
+
+    def set_msgids(self, folder, msgids):
+        with self.lock:
+            self.db.executemany(
+                "UPDATE messages SET msgid = ? WHERE folder = ? AND uid = ?",
+                [(msgid, folder, uid) for uid, msgid in msgids.items()]
+            )
+            self.db.commit()
+
+    def has_unassigned(self, folder):
+        """ True if the folder has messages stored through the Gmail API that don't have a UID yet. """
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM messages WHERE folder = ? AND uid IS NULL LIMIT 1", (folder, )
+            ).fetchone() is not None
+
+    def folders_of(self, msgid):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT folder FROM messages WHERE msgid = ?", (msgid, ))}
+
+    def filename(self, folder, uid, flags):
+        with self.lock:
+            self.counter += 1
+            counter = self.counter
+        uid_part = ",U=%d" % uid if uid is not None else ""
+        return "%d_%d.%d.%s%s,FMD5=%s:2,%s" % (
+            time.time(), counter, os.getpid(), self.hostname, uid_part,
+            hashlib.md5(folder.encode("utf-8")).hexdigest(), maildir_flags(flags)
+        )
+
+    def add(self, folder, uid, msgid, flags, raw):
+        """ Stores a message. uid is None for messages fetched through the Gmail API. """
+        with self.lock:
+            if uid is not None:
+                existing = self.db.execute("SELECT 1 FROM messages WHERE folder = ? AND uid = ?", (folder, uid))
+            else:
+                existing = self.db.execute("SELECT 1 FROM messages WHERE folder = ? AND msgid = ?", (folder, msgid))
+            if existing.fetchone():
+                # Already stored by an earlier attempt of the same batch.
+                return
+        filename = self.filename(folder, uid, flags)
+        temp_path = "%s/tmp/%s" % (self.folder_path(folder), filename)
+        with open(temp_path, "wb") as message_file:
+            message_file.write(raw)
+        os.replace(temp_path, "%s/cur/%s" % (self.folder_path(folder), filename))
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO messages (folder, uid, msgid, filename) VALUES (?, ?, ?, ?)",
+                (folder, uid, msgid, "cur/%s" % filename)
+            )
+
+    def add_existing(self, folder, uid, msgid, flags):
+        """ Hard links a message that is already stored in another folder. Returns False if there is none. """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT folder, filename FROM messages WHERE msgid = ? AND folder != ? LIMIT 1", (msgid, folder)
+            ).fetchone()
+        if not row:
+            return False
+        source = "%s/%s" % (self.folder_path(row[0]), row[1])
+        filename = "cur/%s" % self.filename(folder, uid, flags)
+        try:
+            os.link(source, "%s/%s" % (self.folder_path(folder), filename))
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO messages (folder, uid, msgid, filename) VALUES (?, ?, ?, ?)", (folder, uid, msgid, filename)
+            )
+        return True
+
+    def adopt(self, folder, uid, msgid):
+        """ Assigns uid to a message stored without one. Returns False if there is no such message. """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, filename FROM messages WHERE folder = ? AND msgid = ? AND uid IS NULL", (folder, msgid)
+            ).fetchone()
+        if not row:
+            return False
+        message_id, old_filename = row
+        flags = old_filename.rpartition(":2,")[2]
+        new_filename = "cur/%s" % self.filename(folder, uid, [])
+        new_filename = new_filename.rpartition(":2,")[0] + ":2," + flags
+        os.replace("%s/%s" % (self.folder_path(folder), old_filename), "%s/%s" % (self.folder_path(folder), new_filename))
+        with self.lock:
+            self.db.execute("UPDATE messages SET uid = ?, filename = ? WHERE id = ?", (uid, new_filename, message_id))
+        return True
+
+    def remove(self, folder, uid):
+        with self.lock:
+            rows = self.db.execute("SELECT filename FROM messages WHERE folder = ? AND uid = ?", (folder, uid)).fetchall()
+            self.db.execute("DELETE FROM messages WHERE folder = ? AND uid = ?", (folder, uid))
+        self.unlink(folder, rows)
+
+    def remove_msgid(self, folder, msgid):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT filename FROM messages WHERE folder = ? AND msgid = ?", (folder, msgid)
+            ).fetchall()
+            self.db.execute("DELETE FROM messages WHERE folder = ? AND msgid = ?", (folder, msgid))
+        self.unlink(folder, rows)
+
+    def unlink(self, folder, rows):
+        for (filename, ) in rows:
+            try:
+                os.unlink("%s/%s" % (self.folder_path(folder), filename))
+            except FileNotFoundError:
+                pass
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,286 @@
+"""
+Run metrics: counters and histograms with labels, kept in fixed buckets so that memory use does not grow with the
+length of a run.
+
+Metrics are exposed in the Prometheus text format, written to METRICS_TEXTFILE after a run (for the node_exporter
+textfile collector) and served on METRICS_HTTP_PORT while a run is in progress. After each run, a JSON report with
+the metrics and every job's duration, status and amount of data is written to METRICS_REPORT_DIRECTORY.
+
+Each process has its own registry. Gmail worker processes return what they recorded with their result
+(METRICS.collect(reset=True)), and the main process merges it (METRICS.merge()).
+"""
+
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+from functools import wraps
+
+from .settings import METRICS_HTTP_PORT, METRICS_REPORT_DIRECTORY, METRICS_TEXTFILE
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600)
+SIZE_BUCKETS = (1024, 16 * 1024, 256 * 1024, 1024**2, 16 * 1024**2, 128 * 1024**2, 1024**3)
+ATTEMPT_BUCKETS = (1, 2, 3, 5, 8)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """ A counter, gauge or histogram. Values are kept per tuple of label values. """
+
+    def __init__(self, kind, name, description, labels=(), buckets=None):
+        self.kind = kind
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets or ())
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Bucket counts, sum, count
+                counts = self.values[key] = [0] * len(self.buckets) + [0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def collect(self, reset=False):
+        with self.lock:
+            values = [
+                [list(key), list(value) if self.kind == "histogram" else value] for key, value in self.values.items()
+            ]
+            if reset:
+                self.values = {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for key, value in values:
+                key = tuple(key)
+                if self.kind == "gauge":
+                    self.values[key] = value
+                elif self.kind == "counter":
+                    self.values[key] = self.values.get(key, 0) + value
+                else:
+                    counts = self.values.setdefault(key, [0] * len(value))
+                    self.values[key] = [old + new for old, new in zip(counts, value)]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.kind)]
+        for key, value in sorted(self.collect()):
+            if self.kind != "histogram":
+                lines.append("%s%s %s" % (self.name, format_labels(self.labels, key), format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets, value[:-2]):
+                cumulative += count
+                lines.append(
+                    "%s_bucket%s %s" %
+                    (self.name, format_labels(self.labels, key, ("le", format_value(bound))), cumulative)
+                )
+            lines.append("%s_bucket%s %s" % (self.name, format_labels(self.labels, key, ("le", "+Inf")), value[-1]))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(self.labels, key), format_value(value[-2])))
+            lines.append("%s_count%s %s" % (self.name, format_labels(self.labels, key), value[-1]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, kind, name, description, labels=(), buckets=None):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Metric(kind, name, description, labels, buckets)
+            return self.metrics[name]
+
+    def counter(self, name, description, labels=()):
+        return self.register("counter", name, description, labels)
+
+    def gauge(self, name, description, labels=()):
+        return self.register("gauge", name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        return self.register("histogram", name, description, labels, buckets)
+
+    def collect(self, reset=False):
+        """ Returns {name: [[label values, value], ...]}, suitable for pickling and JSON. """
+        return {name: metric.collect(reset) for name, metric in self.metrics.items()}
+
+    def reset(self):
+        self.collect(reset=True)
+
+    def merge(self, snapshot):
+        for name, values in snapshot.items():
+            if name in self.metrics:
+                self.metrics[name].merge(values)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+
+API_REQUEST_SECONDS = METRICS.histogram(
+    "google_backup_api_request_seconds", "Duration of Google API requests.", ("api", "outcome")
+)
+API_ATTEMPTS = METRICS.histogram(
+    "google_backup_api_attempts", "Number of attempts per Google API call.", ("api", ), ATTEMPT_BUCKETS
+)
+API_RETRIES = METRICS.counter("google_backup_api_retries_total", "Retried Google API requests.", ("api", "reason"))
+THROTTLE_WAIT_SECONDS = METRICS.histogram(
+    "google_backup_throttle_wait_seconds", "Time spent waiting for the rate limiter.", ("api", )
+)
+DOWNLOAD_BYTES = METRICS.histogram(
+    "google_backup_download_bytes", "Size of downloaded files and messages.", ("service", ), SIZE_BUCKETS
+)
+JOB_SECONDS = METRICS.histogram(
+    "google_backup_job_seconds", "Duration of (service, user) backup jobs.", ("service", "status")
+)
+FUNCTION_SECONDS = METRICS.histogram(
+    "google_backup_function_seconds", "Duration of backup phases, recorded by helpers.timeit.", ("function", )
+)
+RUN_JOBS = METRICS.gauge("google_backup_run_jobs", "Jobs in the last run by status.", ("service", "status"))
+RUN_SECONDS = METRICS.gauge("google_backup_run_seconds", "Duration of the last run.", ("run", ))
+RUN_FINISHED = METRICS.gauge(
+    "google_backup_run_finished_timestamp_seconds", "Time the last run finished.", ("run", )
+)
+
+
+def timeit(func):
+    @wraps(func)
+    def timer(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            FUNCTION_SECONDS.observe(time.time() - start, function=func.__qualname__)
+
+    return timer
+
+
+def write_atomic(path, data):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), dir=directory)
+    try:
+        with os.fdopen(fd, "w") as target:
+            target.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def write_textfile(path=METRICS_TEXTFILE):
+    """ Writes all metrics in the Prometheus text format. The file is replaced atomically, so that the textfile
+        collector never reads a partial file. """
+    if path:
+        write_atomic(path, METRICS.render())
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = METRICS.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def start_http_server(port=METRICS_HTTP_PORT, address=""):
+    """ Serves /metrics from a daemon thread. Returns the server, or None if no port is configured. """
+    if not port:
+        return None
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def build_report(name, started, jobs):
+    """ jobs is a list of dicts with at least service, user, status and elapsed. Slowest jobs come first. """
+    finished = time.time()
+    statuses = {}
+    for job in jobs:
+        service = statuses.setdefault(job["service"], {})
+        service[job["status"]] = service.get(job["status"], 0) + 1
+    return {
+        "run": name,
+        "started": started,
+        "finished": finished,
+        "elapsed": finished - started,
+        "jobs": sorted(jobs, key=lambda job: job["elapsed"], reverse=True),
+        "statuses": statuses,
+    }
+
+
+def finish_run(name, started, jobs, logger):
+    """ Records the totals of a run, writes the JSON report and the textfile. Errors are logged, not raised. """
+    report = build_report(name, started, jobs)
+    for service, statuses in report["statuses"].items():
+        for status, count in statuses.items():
+            RUN_JOBS.set(count, service=service, status=status)
+    RUN_SECONDS.set(report["elapsed"], run=name)
+    RUN_FINISHED.set(report["finished"], run=name)
+    report["metrics"] = METRICS.collect()
+    try:
+        if METRICS_REPORT_DIRECTORY:
+            path = "%s/%s-%s.json" % (
+                METRICS_REPORT_DIRECTORY, name, time.strftime("%Y%m%d-%H%M%S", time.localtime(started))
+            )
+            write_atomic(path, json.dumps(report, indent=2, sort_keys=True))
+            logger.info("Wrote run report to %s", path)
+        write_textfile()
+    except OSError as err:
+        logger.error("Unable to write metrics: %s", err)
+    return report
@@ -0,0 +1,218 @@
+"""
+Progress and throughput reporting for backup jobs.
+
+Jobs count items (messages, files, events) and bytes in a ProgressReporter. The reporter sends accumulated
+deltas to the ProgressTracker at most every PROGRESS_FLUSH_INTERVAL seconds: directly when the job runs in the
+same process, or as one queue message per flush when it runs in a worker process (QueueSink).
+
+The tracker reports global and per-user items/s, bytes/s and ETA: a status line on a terminal, and a log line
+every PROGRESS_LOG_INTERVAL seconds.
+"""
+
+import collections
+import queue
+import sys
+import threading
+import time
+
+from .settings import PROGRESS_FLUSH_INTERVAL, PROGRESS_LOG_INTERVAL
+
+FIELDS = ("total", "processed", "bytes", "missed")
+# Global rates are calculated over this many seconds, so that the ETA follows the current speed.
+RATE_WINDOW = 60
+
+
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return "%.1f%s" % (size, unit)
+        size /= 1024.0
+    return "%.1fTiB" % size
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressReporter:
+    """ Accumulates progress of a single (service, user) job. Safe to use from several threads. """
+
+    def __init__(self, key, sink=None):
+        self.key = key
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.pending = dict.fromkeys(FIELDS, 0)
+        self.last_flush = time.time()
+
+    def add(self, field, value):
+        if self.sink is None:
+            return
+        with self.lock:
+            self.pending[field] += value
+            if time.time() - self.last_flush >= PROGRESS_FLUSH_INTERVAL:
+                self.flush_locked(False)
+
+    def add_total(self, count):
+        self.add("total", count)
+
+    def processed(self, count=1, size=0):
+        self.add("processed", count)
+        if size:
+            self.add("bytes", size)
+
+    def missed(self, count):
+        self.add("missed", count)
+
+    def flush_locked(self, finished):
+        deltas = {field: value for field, value in self.pending.items() if value}
+        if deltas or finished:
+            self.sink(self.key, deltas, finished)
+        self.pending = dict.fromkeys(FIELDS, 0)
+        self.last_flush = time.time()
+
+    def finish(self):
+        if self.sink is None:
+            return
+        with self.lock:
+            self.flush_locked(True)
+
+
+# Reporter for jobs run without a tracker.
+NULL_REPORTER = ProgressReporter(None)
+
+
+class QueueSink:
+    """ Sends deltas from a worker process to the tracker through a multiprocessing queue. """
+
+    def __init__(self, progress_queue):
+        self.queue = progress_queue
+
+    def __call__(self, key, deltas, finished):
+        self.queue.put((key, deltas, finished))
+
+
+class ProgressTracker:
+    def __init__(self, logger, progress_queue=None, stream=None):
+        self.logger = logger
+        self.queue = progress_queue
+        self.stream = stream if stream is not None else sys.stdout
+        self.is_a_tty = self.stream.isatty()
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.totals = dict.fromkeys(FIELDS, 0)
+        self.samples = collections.deque()
+        self.start_time = time.time()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def reporter(self, service, user):
+        return ProgressReporter((service, user), self.update)
+
+    def update(self, key, deltas, finished):
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                job = self.jobs[key] = dict.fromkeys(FIELDS, 0)
+                job["start"] = time.time()
+                job["end"] = None
+            for field, value in deltas.items():
+                job[field] += value
+                self.totals[field] += value
+            if finished:
+                job["end"] = time.time()
+
+    def job_totals(self):
+        """ Returns {(service, user): {field: value}} for every job that reported progress. """
+        with self.lock:
+            return {key: {field: job[field] for field in FIELDS} for key, job in self.jobs.items()}
+
+    def rates(self):
+        """ Returns (items/s, bytes/s) over the last RATE_WINDOW seconds. """
+        now = time.time()
+        with self.lock:
+            self.samples.append((now, self.totals["processed"], self.totals["bytes"]))
+            while len(self.samples) > 1 and self.samples[0][0] < now - RATE_WINDOW:
+                self.samples.popleft()
+            first = self.samples[0]
+        elapsed = now - first[0]
+        if elapsed <= 0:
+            return (0.0, 0.0)
+        return ((self.totals["processed"] - first[1]) / elapsed, (self.totals["bytes"] - first[2]) / elapsed)
+
+    def status(self):
+        items_per_second, bytes_per_second = self.rates()
+        with self.lock:
+            totals = dict(self.totals)
+            running = sum(1 for job in self.jobs.values() if job["end"] is None)
+        remaining = totals["total"] - totals["processed"] - totals["missed"]
+        eta = remaining / items_per_second if items_per_second > 0 and remaining > 0 else None
+        return "%s/%s items, %s, %.1f items/s, %s/s, ETA %s, %s jobs running" % (
+            totals["processed"], totals["total"], format_bytes(totals["bytes"]), items_per_second,
+            format_bytes(bytes_per_second), format_eta(eta), running
+        )
+
+    def job_status(self, key, job):
+        elapsed = (job["end"] or time.time()) - job["start"]
+        rate = job["processed"] / elapsed if elapsed > 0 else 0.0
+        byte_rate = job["bytes"] / elapsed if elapsed > 0 else 0.0
+        remaining = job["total"] - job["processed"] - job["missed"]
+        eta = remaining / rate if rate > 0 and remaining > 0 and job["end"] is None else None
+        return "%s %s: %s/%s items, %s, %.1f items/s, %s/s, ETA %s" % (
+            key[0], key[1], job["processed"], job["total"], format_bytes(job["bytes"]), rate, format_bytes(byte_rate),
+            format_eta(eta)
+        )
+
+    def log_status(self):
+        self.logger.info("Progress: %s", self.status())
+        with self.lock:
+            running = [(key, dict(job)) for key, job in self.jobs.items() if job["end"] is None]
+        for key, job in running:
+            self.logger.info("  %s", self.job_status(key, job))
+
+    def drain(self, timeout):
+        """ Applies queued deltas from worker processes, waiting up to timeout seconds for the first one. """
+        if self.queue is None:
+            self.stopping.wait(timeout)
+            return
+        try:
+            item = self.queue.get(timeout=timeout)
+            while True:
+                self.update(*item)
+                item = self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def loop(self):
+        last_log = time.time()
+        while not self.stopping.is_set():
+            self.drain(PROGRESS_FLUSH_INTERVAL)
+            if self.is_a_tty:
+                self.stream.write("\r%s\033[K" % self.status())
+                self.stream.flush()
+            if time.time() - last_log >= PROGRESS_LOG_INTERVAL:
+                last_log = time.time()
+                self.log_status()
+        # Deltas flushed by workers just before they finished.
+        self.drain(PROGRESS_FLUSH_INTERVAL)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, name="progress", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.is_a_tty:
+            self.stream.write("\n")
+        elapsed = time.time() - self.start_time
+        with self.lock:
+            totals = dict(self.totals)
+        self.logger.info(
+            "Finished in %.2f seconds. %s/%s items (%s missed), %s. %.2f items/s, %s/s", elapsed, totals["processed"],
+            totals["total"], totals["missed"], format_bytes(totals["bytes"]), totals["processed"] / max(elapsed, 1e-6),
+            format_bytes(totals["bytes"] / max(elapsed, 1e-6))
+        )
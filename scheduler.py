@@ -0,0 +1,240 @@
+"""
+Runs (service, user) backup jobs on a bounded worker pool.
+
+Every job is still a GmailBackup/DriveBackup/CalendarBackup instance. The scheduler only decides
+which job runs next: the largest pending job whose service has a free slot. Job size is the size of the
+previous backup, or for users without one, their storage usage from the user directory.
+
+With a coordinator.Coordinator, jobs are claimed from the shared run instead of the local queue, so that several
+processes and hosts can work on the same run.
+"""
+
+import collections
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .calendarbackup import CalendarBackup
+from .drivebackup import DriveBackup
+from .get_users import is_dormant
+from .gmailbackup import GmailBackup
+from .helpers import get_logger
+from .metrics import JOB_SECONDS, finish_run, start_http_server
+from .progress import ProgressTracker
+from .storage import StorageError, provision, take_snapshot
+from .settings import (
+    CALENDAR_IGNORE_USERS, COORDINATOR_POLL_INTERVAL, SCHEDULER_SERVICE_LIMITS, SCHEDULER_SKIP_DORMANT_DAYS,
+    SCHEDULER_WORKERS
+)
+
+BACKUP_CLASSES = {
+    "gmail": GmailBackup,
+    "drive": DriveBackup,
+    "calendar": CalendarBackup,
+}
+
+logger = get_logger("scheduler")
+
+Job = collections.namedtuple("Job", ["service", "user", "size"])
+JobResult = collections.namedtuple("JobResult", ["service", "user", "status", "result", "elapsed", "error"])
+
+
+def provision_datasets(datasets):
+    """ Creates missing datasets. Returns {dataset: used bytes} for everything under ZPOOL_ROOT_PATH, from the same
+        single listing.
+
+        Previous backup size is the best cheap estimate of how long a job will take. """
+    try:
+        return provision(datasets, logger)
+    except (OSError, StorageError) as err:
+        # Jobs create their own dataset in initialize().
+        logger.warning("Unable to provision datasets: %s", err)
+        return {}
+
+
+def run_job(job, progress=None, force=False):
+    start = time.time()
+    backup = BACKUP_CLASSES[job.service](job.user)
+    if progress is not None:
+        backup.progress = progress
+    try:
+        if not force and not backup.has_changes():
+            return JobResult(job.service, job.user, "unchanged", None, time.time() - start, None)
+        if not backup.initialize():
+            return JobResult(job.service, job.user, "failed", None, time.time() - start, "initialize failed")
+        result = backup.run()
+    except Exception as err:  # pylint: disable=broad-except
+        logger.exception("%s backup for %s failed", job.service, job.user)
+        return JobResult(job.service, job.user, "failed", None, time.time() - start, repr(err))
+    finally:
+        backup.progress.finish()
+    status = "ok"
+    if job.service == "gmail" and result:
+        # GmailBackup returns the exit code of the sync.
+        status = "failed"
+    return JobResult(job.service, job.user, status, result, time.time() - start, None)
+
+
+class BackupScheduler:
+    def __init__(
+        self, services, users, workers=None, service_limits=None, sizes=None, directory=None, force=False,
+        coordinator=None
+    ):
+        """ directory is {email: user} from get_users.get_user_directory, if available. Without sizes, datasets
+            are provisioned and ordered by their current size. With force, jobs run even if their precheck finds
+            no changes. """
+        self.force = force
+        self.coordinator = coordinator
+        self.workers = workers or SCHEDULER_WORKERS
+        self.service_limits = dict(SCHEDULER_SERVICE_LIMITS)
+        self.service_limits.update(service_limits or {})
+        self.directory = directory or {}
+        self.pending = {}
+        self.datasets = {
+            (service, user): BACKUP_CLASSES[service](user).zfsrootpath for service in services for user in users
+        }
+        if sizes is None:
+            # Skipped jobs don't get a dataset.
+            sizes = provision_datasets([
+                dataset for (service, user), dataset in self.datasets.items()
+                if self.skip_reason(Job(service, user, 0)) is None
+            ])
+        for service in services:
+            jobs = []
+            for user in users:
+                size = sizes.get(self.datasets[service, user])
+                jobs.append(Job(service, user, size or self.directory.get(user, {}).get("usage", {}).get(service, 0)))
+            jobs.sort(key=lambda job: job.size, reverse=True)
+            self.pending[service] = collections.deque(jobs)
+        if coordinator is not None:
+            coordinator.add_jobs(job for jobs in self.pending.values() for job in jobs)
+        self.running = collections.Counter()
+        self.results = []
+        self.report = None
+
+    def next_job(self):
+        """ Returns the largest pending job among services that are below their concurrency limit. """
+        candidates = [
+            service for service, jobs in self.pending.items()
+            if (jobs or self.coordinator) and self.running[service] < self.service_limits.get(service, self.workers)
+        ]
+        if not candidates:
+            return None
+        if self.coordinator:
+            job = self.coordinator.claim(candidates)
+            return Job(*job) if job else None
+        service = max(candidates, key=lambda service: self.pending[service][0].size)
+        return self.pending[service].popleft()
+
+    def skip_reason(self, job):
+        """ Returns why job is not run, or None if it is. """
+        if job.service == "calendar" and job.user in CALENDAR_IGNORE_USERS:
+            return "ignore list"
+        user = self.directory.get(job.user)
+        if SCHEDULER_SKIP_DORMANT_DAYS and user and is_dormant(user, SCHEDULER_SKIP_DORMANT_DAYS):
+            return "no logins in %s days" % SCHEDULER_SKIP_DORMANT_DAYS
+        return None
+
+    def skip_job(self, job):
+        reason = self.skip_reason(job)
+        if reason is not None:
+            logger.info("Skipping %s %s: %s", job.service, job.user, reason)
+        return reason is not None
+
+    def run(self):
+        total_jobs = sum(len(jobs) for jobs in self.pending.values())
+        logger.info(
+            "Running %s jobs with %s workers, service limits %s", total_jobs, self.workers, self.service_limits
+        )
+        start = time.time()
+        start_http_server()
+        futures = {}
+        tracker = ProgressTracker(logger)
+        tracker.start()
+        # With a coordinator, leases of other workers may expire while this one waits.
+        poll_interval = COORDINATOR_POLL_INTERVAL if self.coordinator else None
+        if self.coordinator:
+            self.coordinator.start()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                while len(futures) < self.workers:
+                    job = self.next_job()
+                    if job is None:
+                        break
+                    if self.skip_job(job):
+                        self.record(JobResult(job.service, job.user, "skipped", None, 0, None))
+                        continue
+                    self.running[job.service] += 1
+                    futures[executor.submit(run_job, job, tracker.reporter(job.service, job.user), self.force)] = job
+                if not futures:
+                    if self.coordinator and self.coordinator.leased_elsewhere():
+                        time.sleep(poll_interval)
+                        continue
+                    break
+                done, _ = wait(futures, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = futures.pop(future)
+                    self.running[job.service] -= 1
+                    result = future.result()
+                    self.record(result)
+                    JOB_SECONDS.observe(result.elapsed, service=result.service, status=result.status)
+                    logger.info(
+                        "%s/%s: %s %s %s in %.2f seconds", len(self.results), total_jobs, result.service, result.user,
+                        result.status, result.elapsed
+                    )
+        tracker.stop()
+        if self.coordinator:
+            self.coordinator.stop()
+            logger.info("Run %s, shard %s: %s", self.coordinator.run, self.coordinator.shard, self.coordinator.statuses())
+        take_snapshot(logger)
+        self.report = finish_run("backup", start, self.report_jobs(tracker.job_totals()), logger)
+        return self.summary(time.time() - start)
+
+    def record(self, result):
+        self.results.append(result)
+        if self.coordinator:
+            self.coordinator.finish(result.service, result.user, result.status, result.error)
+
+    def report_jobs(self, totals):
+        jobs = []
+        for result in self.results:
+            job = {
+                "service": result.service,
+                "user": result.user,
+                "status": result.status,
+                "elapsed": result.elapsed,
+                "error": result.error,
+            }
+            job.update(totals.get((result.service, result.user), {}))
+            jobs.append(job)
+        return jobs
+
+    def summary(self, elapsed):
+        summary = {"elapsed": elapsed, "services": {}}
+        for result in self.results:
+            service = summary["services"].setdefault(
+                result.service, {
+                    "ok": 0,
+                    "failed": 0,
+                    "skipped": 0,
+                    "unchanged": 0,
+                    "elapsed": 0.0,
+                    "failed_users": []
+                }
+            )
+            service[result.status] += 1
+            service["elapsed"] += result.elapsed
+            if result.status == "failed":
+                service["failed_users"].append(result.user)
+        return summary
+
+
+def format_summary(summary):
+    lines = ["Finished in %.2f seconds" % summary["elapsed"]]
+    for name, service in sorted(summary["services"].items()):
+        lines.append(
+            "%s: %s ok, %s unchanged, %s failed, %s skipped, %.2f job-seconds" %
+            (name, service["ok"], service["unchanged"], service["failed"], service["skipped"], service["elapsed"])
+        )
+        if service["failed_users"]:
+            lines.append("  failed: %s" % ", ".join(sorted(service["failed_users"])))
+    return "\n".join(lines)
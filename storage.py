@@ -0,0 +1,199 @@
+"""
+Storage backends for backup datasets.
+
+Every (service, user) pair has its own dataset, <ZPOOL_ROOT_PATH>/<service>/<user>, mounted at /<dataset>.
+ZfsStorage lists all datasets and their sizes with a single zfs call. Missing datasets (new users) are created with
+one `zfs create` each, and mountpoints are handed to BACKUP_OWNER with one `chown` per CHOWN_BATCH_SIZE paths. sudo
+runs zfs and chown directly, so sudoers can restrict their arguments. After a run, a recursive snapshot of
+ZPOOL_ROOT_PATH captures every dataset atomically, and old snapshots are pruned by
+STORAGE_SNAPSHOT_KEEP_LAST/DAILY/WEEKLY.
+
+DirectoryStorage (STORAGE_BACKEND = "directory") uses plain directories and snapshots that are full copies, for tests
+and hosts without ZFS. Copies are not atomic: files that change while a snapshot is taken may be copied in any state.
+"""
+
+import datetime
+import os
+import pwd
+import shutil
+import subprocess
+import time
+
+from .settings import (
+    BACKUP_OWNER, STORAGE_BACKEND, STORAGE_SNAPSHOT_KEEP_DAILY, STORAGE_SNAPSHOT_KEEP_LAST, STORAGE_SNAPSHOT_KEEP_WEEKLY,
+    STORAGE_SNAPSHOTS, ZPOOL_ROOT_PATH
+)
+
+SNAPSHOT_PREFIX = "backup-"
+SNAPSHOT_FORMAT = SNAPSHOT_PREFIX + "%Y%m%d-%H%M%S"
+# Paths per chown call, well below the argument list limit.
+CHOWN_BATCH_SIZE = 1000
+
+
+class StorageError(Exception):
+    pass
+
+
+def snapshot_time(name):
+    return datetime.datetime.strptime(name, SNAPSHOT_FORMAT)
+
+
+def expired_snapshots(names, keep_last, keep_daily, keep_weekly):
+    """ Returns snapshots that are not among the keep_last newest, the newest of each of the last keep_daily days,
+        or the newest of each of the last keep_weekly ISO weeks. """
+    names = sorted((name for name in names if name.startswith(SNAPSHOT_PREFIX)), key=snapshot_time, reverse=True)
+    keep = set(names[:keep_last])
+    days = []
+    weeks = []
+    for name in names:
+        taken = snapshot_time(name)
+        day = taken.date()
+        week = taken.isocalendar()[:2]
+        if day not in days and len(days) < keep_daily:
+            days.append(day)
+            keep.add(name)
+        if week not in weeks and len(weeks) < keep_weekly:
+            weeks.append(week)
+            keep.add(name)
+    return [name for name in names if name not in keep]
+
+
+class ZfsStorage:
+    def __init__(self, root):
+        self.root = root
+
+    def run(self, args, sudo=False):
+        if sudo:
+            args = ["/usr/bin/sudo"] + args
+        process = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise StorageError("%s failed: %s" % (" ".join(args), process.stderr.decode("utf-8", "replace").strip()))
+        return process.stdout.decode("utf-8")
+
+    def sizes(self):
+        """ Returns {dataset: used bytes} for every dataset under the root. """
+        output = self.run(["/sbin/zfs", "list", "-H", "-p", "-r", "-o", "name,used", self.root])
+        sizes = {}
+        for line in output.splitlines():
+            name, _, used = line.partition("\t")
+            try:
+                sizes[name] = int(used)
+            except ValueError:
+                continue
+        return sizes
+
+    def create(self, datasets):
+        """ Creates datasets (and missing parents) and hands their mountpoints to BACKUP_OWNER. zfs create takes a
+            single dataset. """
+        for dataset in datasets:
+            self.run(["/sbin/zfs", "create", "-p", dataset], sudo=True)
+        self.chown(datasets)
+
+    def chown(self, datasets):
+        datasets = list(datasets)
+        for start in range(0, len(datasets), CHOWN_BATCH_SIZE):
+            paths = ["/%s" % dataset for dataset in datasets[start:start + CHOWN_BATCH_SIZE]]
+            self.run(["/bin/chown", BACKUP_OWNER] + paths, sudo=True)
+
+    def snapshots(self):
+        output = self.run(["/sbin/zfs", "list", "-H", "-t", "snapshot", "-d", "1", "-o", "name", self.root])
+        return [line.partition("@")[2] for line in output.splitlines() if "@" in line]
+
+    def snapshot(self, name):
+        """ Snapshots every dataset under the root atomically. """
+        self.run(["/sbin/zfs", "snapshot", "-r", "%s@%s" % (self.root, name)], sudo=True)
+
+    def destroy_snapshots(self, names):
+        if names:
+            self.run(["/sbin/zfs", "destroy", "-r", "%s@%s" % (self.root, ",".join(names))], sudo=True)
+
+
+class DirectoryStorage:
+    def __init__(self, root):
+        self.root = root
+
+    def snapshot_path(self, name=""):
+        return "/%s/.snapshots/%s" % (self.root, name)
+
+    def sizes(self):
+        sizes = {}
+        if not os.path.isdir("/" + self.root):
+            return sizes
+        for service in os.listdir("/" + self.root):
+            if service.startswith(".") or not os.path.isdir("/%s/%s" % (self.root, service)):
+                continue
+            for user in os.listdir("/%s/%s" % (self.root, service)):
+                dataset = "%s/%s/%s" % (self.root, service, user)
+                size = 0
+                for dirpath, _, filenames in os.walk("/" + dataset):
+                    size += sum(os.lstat(os.path.join(dirpath, filename)).st_size for filename in filenames)
+                sizes[dataset] = size
+        return sizes
+
+    def create(self, datasets):
+        for dataset in datasets:
+            os.makedirs("/" + dataset, exist_ok=True)
+
+    def chown(self, datasets):
+        pass
+
+    def snapshots(self):
+        if not os.path.isdir(self.snapshot_path()):
+            return []
+        return os.listdir(self.snapshot_path())
+
+    def snapshot(self, name):
+        os.makedirs(self.snapshot_path(), exist_ok=True)
+        # Copies, not hard links, so that files rewritten in place later don't change the snapshot.
+        shutil.copytree(
+            "/" + self.root, self.snapshot_path(name), symlinks=True,
+            ignore=lambda directory, _: [".snapshots"] if directory == "/" + self.root else []
+        )
+
+    def destroy_snapshots(self, names):
+        for name in names:
+            shutil.rmtree(self.snapshot_path(name))
+
+
+def get_storage():
+    if STORAGE_BACKEND == "directory":
+        return DirectoryStorage(ZPOOL_ROOT_PATH)
+    return ZfsStorage(ZPOOL_ROOT_PATH)
+
+
+STORAGE = get_storage()
+
+
+def provision(datasets, logger):
+    """ Creates missing datasets and fixes ownership of existing ones with one bulk call each.
+        Returns {dataset: used bytes} for all datasets. """
+    sizes = STORAGE.sizes()
+    missing = sorted(set(datasets) - set(sizes))
+    if missing:
+        logger.info("Creating %s datasets", len(missing))
+        STORAGE.create(missing)
+    wrong_owner = [
+        dataset for dataset in set(datasets) - set(missing)
+        if os.path.exists("/" + dataset) and pwd.getpwuid(os.stat("/" + dataset).st_uid).pw_name != BACKUP_OWNER
+    ]
+    if wrong_owner:
+        STORAGE.chown(wrong_owner)
+    return sizes
+
+
+def take_snapshot(logger):
+    """ Takes a recursive snapshot after a run and prunes old ones. Errors are logged, not raised. """
+    if not STORAGE_SNAPSHOTS:
+        return None
+    name = time.strftime(SNAPSHOT_FORMAT, time.gmtime())
+    try:
+        STORAGE.snapshot(name)
+        expired = expired_snapshots(
+            STORAGE.snapshots(), STORAGE_SNAPSHOT_KEEP_LAST, STORAGE_SNAPSHOT_KEEP_DAILY, STORAGE_SNAPSHOT_KEEP_WEEKLY
+        )
+        STORAGE.destroy_snapshots(expired)
+    except (OSError, StorageError) as err:
+        logger.error("Snapshot failed: %s", err)
+        return None
+    logger.info("Took snapshot %s, removed %s old snapshots", name, len(expired))
+    return name
@@ -0,0 +1,85 @@
+"""
+The repository is a package of flat modules with relative imports. Tests import it as google_backup, whatever the
+checkout is called, with settings.py.sample as the settings unless a settings.py exists.
+
+Settings are pointed to a temporary directory before any backup module is imported, as modules copy settings
+on import: storage is plain directories, with no snapshots, no metrics files and no state under /storage. API
+clients use a fakegoogle server that runs for the whole session.
+"""
+
+import importlib.util
+import os
+import pwd
+import sys
+import tempfile
+import threading
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "google_backup"
+TEST_ROOT = tempfile.mkdtemp(prefix="google-backup-tests-")
+
+
+def load_package():
+    spec = importlib.util.spec_from_file_location(
+        PACKAGE, os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE] = package
+    spec.loader.exec_module(package)
+    settings_path = os.path.join(ROOT, "settings.py")
+    if not os.path.exists(settings_path):
+        settings_path = os.path.join(ROOT, "settings.py.sample")
+    settings = types.ModuleType(PACKAGE + ".settings")
+    settings.__file__ = settings_path
+    with open(settings_path) as source:
+        exec(compile(source.read(), settings_path, "exec"), settings.__dict__)  # pylint: disable=exec-used
+    settings.ZPOOL_ROOT_PATH = TEST_ROOT.lstrip("/")
+    settings.STATE_DATABASE = os.path.join(TEST_ROOT, "state.sqlite")
+    settings.STORAGE_BACKEND = "directory"
+    settings.STORAGE_SNAPSHOTS = False
+    settings.BACKUP_OWNER = pwd.getpwuid(os.getuid()).pw_name
+    settings.METRICS_TEXTFILE = None
+    settings.METRICS_HTTP_PORT = None
+    settings.METRICS_REPORT_DIRECTORY = None
+    settings.DRIVE_BLOBSTORE_PATH = None
+    settings.COORDINATOR_DATABASE = None
+    sys.modules[settings.__name__] = settings
+    package.settings = settings
+
+
+load_package()
+# pylint: disable=wrong-import-position
+from google_backup import settings as SETTINGS
+from google_backup.fakegoogle import FakeApi, FakeDomain, FakeGoogleServer
+
+# Every API client of the tests talks to this server.
+SERVER = FakeGoogleServer(FakeDomain())
+threading.Thread(target=SERVER.serve_forever, name="fakegoogle", daemon=True).start()
+SETTINGS.GOOGLE_DISCOVERY_URI = SERVER.base_url + "/discovery/v1/apis/%s/%s/rest"
+SETTINGS.GOOGLE_BATCH_URI = SERVER.base_url + "/batch"
+SETTINGS.DOMAIN = "example.com"
+
+
+@pytest.fixture
+def fake_google():
+    """ The fakegoogle server, with a new domain of 2 users with 4 files of 300KiB and a document each. """
+    SERVER.fake = FakeDomain(users=2, files=4, file_size=300 * 1024, documents=1)
+    SERVER.api = FakeApi(SERVER.fake, SERVER.base_url)
+    return SERVER
+
+
+@pytest.fixture
+def backup_root(monkeypatch, tmp_path):
+    """ Backups made in the test go to tmp_path, with their own state database and with access tokens the fake
+        server accepts. """
+    from google_backup import helpers
+    from google_backup.benchmark import FakeCredentials
+    monkeypatch.setattr(helpers, "ZPOOL_ROOT_PATH", str(tmp_path).lstrip("/"))
+    monkeypatch.setattr(helpers, "STATE", helpers.StateStore(str(tmp_path / "state.sqlite")))
+    monkeypatch.setattr(helpers.CREDENTIALS, "get_credentials", lambda user_email, scope: FakeCredentials(user_email))
+    # httplib2 keeps its cache in the working directory.
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
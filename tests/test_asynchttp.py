@@ -0,0 +1,60 @@
+import urllib.error
+
+import pytest
+
+from google_backup import asynchttp
+from google_backup.asynchttp import AsyncEngine, AsyncHttp, StreamingResponse
+
+pytest.importorskip("httpx")
+
+
+@pytest.fixture
+def engine():
+    return AsyncEngine(concurrency=2, max_connections=2, timeout=10)
+
+
+def auth(server, user=0):
+    return {"Authorization": "Bearer fake:%s" % server.fake.email(user)}
+
+
+def test_api_requests_look_like_httplib2_responses(fake_google, engine):
+    http = AsyncHttp(engine)
+    response, content = http.request("%s/drive/v2/about" % fake_google.base_url, headers=auth(fake_google))
+    assert response.status == 200
+    assert response["content-type"] == "application/json"
+    assert b"largestChangeId" in content
+    response, _ = http.request("%s/drive/v2/about" % fake_google.base_url)
+    assert response.status == 401
+
+
+def test_downloads_are_streamed_and_release_their_slot(fake_google, engine):
+    fake = fake_google.fake
+    url = "%s/download/%s" % (fake_google.base_url, fake.file_id(0, 0))
+    with StreamingResponse(engine, engine.run(engine.open(url, auth(fake_google), 10)), url) as response:
+        assert response.status == 200
+        data = b""
+        while True:
+            chunk = response.read(100000)
+            if not chunk:
+                break
+            data += chunk
+    assert len(data) == fake.file_size
+    assert engine.semaphore._value == 2  # pylint: disable=protected-access
+    with pytest.raises(urllib.error.HTTPError) as err:
+        engine.run(engine.open(url, {}, 10))
+    assert err.value.code == 401
+    assert engine.semaphore._value == 2  # pylint: disable=protected-access
+
+
+def test_connection_errors_are_os_errors(engine):
+    http = AsyncHttp(engine)
+    with pytest.raises(ConnectionError):
+        http.request("http://127.0.0.1:1/")
+
+
+def test_services_can_keep_the_blocking_transports(monkeypatch, tmp_path):
+    # httplib2 keeps its cache in the working directory.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(asynchttp, "ASYNC_HTTP_SERVICES", ("drive", ))
+    assert isinstance(asynchttp.get_http("drive"), AsyncHttp)
+    assert not isinstance(asynchttp.get_http("gmail"), AsyncHttp)
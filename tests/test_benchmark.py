@@ -0,0 +1,82 @@
+import hashlib
+import http.client
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from google_backup.benchmark import compare, server_request
+from google_backup.fakegoogle import FakeDomain
+
+
+def result(**fields):
+    values = {
+        "scenario": "smoke",
+        "pass": "initial",
+        "items_per_second": 100.0,
+        "bytes_per_second": 1000.0,
+        "peak_rss": 1000,
+        "api_calls_total": 50,
+        "served_bytes": 10000,
+    }
+    values.update(fields)
+    return values
+
+
+def test_regressions_beyond_the_tolerance_are_reported():
+    baseline = [result(), result(scenario="flaky")]
+    assert compare([result(items_per_second=85.0, api_calls_total=59)], baseline, 0.2) == []
+    assert compare([result(items_per_second=70.0, peak_rss=1300)], baseline, 0.2) == [
+        "smoke initial: items_per_second dropped from 100.0 to 70.0",
+        "smoke initial: peak_rss grew from 1000 to 1300",
+    ]
+    assert compare([result(scenario="new", api_calls_total=1000)], baseline, 0.2) == []
+
+
+def download(server, user, index, headers=None):
+    headers = dict(headers or {})
+    headers["Authorization"] = "Bearer fake:%s" % server.fake.email(user)
+    request = urllib.request.Request("%s/download/%s" % (server.base_url, server.fake.file_id(user, index)), None, headers)
+    with urllib.request.urlopen(request) as response:
+        return (response.status, response.read())
+
+
+def test_fake_files_match_their_checksums_and_ranges(fake_google):
+    fake = fake_google.fake
+    status, data = download(fake_google, 1, 2)
+    assert status == 200 and len(data) == fake.file_size
+    assert hashlib.md5(data).hexdigest() == fake.content_md5(fake.file_size, fake.file_key(1, 2))
+    status, tail = download(fake_google, 1, 2, {"Range": "bytes=1000-"})
+    assert status == 206 and tail == data[1000:]
+    fake.advance()
+    assert download(fake_google, 1, 2)[1] != data
+
+
+def test_interrupted_downloads_stop_halfway(fake_google):
+    fake = fake_google.fake
+    fake.interruptions = 1.0
+    with pytest.raises(http.client.IncompleteRead):
+        download(fake_google, 0, 0)
+    assert server_request(fake_google.base_url, "/_bench/stats")["interrupted"] == 1
+
+
+def test_throttled_requests_and_statistics(fake_google):
+    fake = fake_google.fake
+    fake.throttle = 1.0
+    request = urllib.request.Request(
+        "%s/drive/v2/about" % fake_google.base_url, headers={"Authorization": "Bearer fake:%s" % fake.email(0)}
+    )
+    with pytest.raises(urllib.error.HTTPError) as err:
+        urllib.request.urlopen(request)
+    assert err.value.code == 403
+    assert json.loads(err.value.read())["error"]["errors"][0]["reason"] == "userRateLimitExceeded"
+    assert server_request(fake_google.base_url, "/_bench/advance", "POST") == {"generation": 1}
+    stats = server_request(fake_google.base_url, "/_bench/stats")
+    assert stats["throttled"] == 1 and stats["drive.about.get"] == 1
+
+
+def test_domains_are_deterministic():
+    first, second = FakeDomain(users=3, messages=5), FakeDomain(users=3, messages=5)
+    assert first.raw_message(2, 4) == second.raw_message(2, 4)
+    assert first.raw_message(2, 4) != first.raw_message(1, 4)
@@ -0,0 +1,35 @@
+import os
+
+from google_backup.blobstore import BlobStore
+
+
+def test_key_needs_checksum_and_size():
+    assert BlobStore.key_for({"md5Checksum": "ABCDEF", "fileSize": "12"}) == ("abcdef", 12)
+    assert BlobStore.key_for({"md5Checksum": "abcdef"}) is None
+    assert BlobStore.key_for({"fileSize": "12", "mimeType": "application/vnd.google-apps.document"}) is None
+
+
+def test_users_share_one_blob(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    key = ("abcdef", 4)
+    assert not store.exists(key)
+    with open(store.prepare(key), "wb") as blob:
+        blob.write(b"data")
+    assert store.path(key) == str(tmp_path / "blobs" / "ab" / "abcdef-4")
+    for user in ("a", "b"):
+        os.mkdir(str(tmp_path / user))
+        store.link(key, str(tmp_path / user / "f.data"))
+        assert (tmp_path / user / "f.data").read_bytes() == b"data"
+    assert store.exists(key)
+
+
+def test_link_replaces_previous_file(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    with open(store.prepare(("abcdef", 3)), "wb") as blob:
+        blob.write(b"new")
+    target = tmp_path / "f.data"
+    target.write_bytes(b"old data")
+    store.link(("abcdef", 3), str(target))
+    assert os.path.islink(str(target))
+    assert target.read_bytes() == b"new"
+    assert sorted(os.listdir(str(tmp_path))) == ["blobs", "f.data"]
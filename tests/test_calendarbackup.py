@@ -0,0 +1,91 @@
+import json
+import os
+import urllib.parse
+
+from google_backup.calendarbackup import CalendarBackup
+from google_backup.fakegoogle import FakeError
+
+
+def run_backup(email):
+    calendar = CalendarBackup(email)
+    assert calendar.initialize()
+    calendar.run()
+    return calendar
+
+
+def stats(server):
+    with server.fake.lock:
+        return dict(server.fake.stats)
+
+
+def test_first_pages_of_all_calendars_are_fetched_in_one_batch(fake_google, backup_root):
+    fake = fake_google.fake
+    fake.calendars = 3
+    fake.events = 300
+    calendar = run_backup(fake.email(0))
+    assert stats(fake_google)["batch"] == 1
+    # One batched first page and one more page per calendar
+    assert stats(fake_google)["calendar.events.list"] == 6
+    for calendar_id in fake.calendar_ids(0):
+        assert len(calendar.event_log(calendar_id).live_ids()) == 300
+    assert calendar.total_entries == 900
+
+
+def test_incremental_run_fetches_only_changed_events(fake_google, backup_root):
+    fake = fake_google.fake
+    fake.changes = 5
+    run_backup(fake.email(0))
+    fake.advance()
+    calendar = run_backup(fake.email(0))
+    assert calendar.total_entries == 5
+    assert calendar.event_log(fake.email(0)).get("e000001")["sequence"] == 1
+    assert calendar.run_state.get("sync_token:%s" % fake.email(0)) == "s1"
+
+
+def test_expired_sync_token_falls_back_to_full_sync(fake_google, backup_root):
+    fake = fake_google.fake
+    calendar = run_backup(fake.email(0))
+    calendar.save_sync_token(fake.email(0), "s99")
+    calendar = run_backup(fake.email(0))
+    assert calendar.total_entries == fake.events
+    assert calendar.run_state.get("sync_token:%s" % fake.email(0)) == "s0"
+
+
+def test_failing_calendar_does_not_stop_the_others(fake_google, backup_root, monkeypatch):
+    fake = fake_google.fake
+    fake.calendars = 3
+    fake.events = 300
+    broken = fake.calendar_ids(0)[1]
+    events_list = fake_google.api.calendar_events_list
+
+    def failing_events_list(user, arguments, query):
+        if query.get("pageToken") and urllib.parse.unquote(arguments["calendarId"]) == broken:
+            raise FakeError(403, "forbidden", "Forbidden")
+        return events_list(user, arguments, query)
+
+    monkeypatch.setattr(fake_google.api, "calendar_events_list", failing_events_list)
+    calendar = run_backup(fake.email(0))
+    for calendar_id in fake.calendar_ids(0):
+        token = calendar.run_state.get("sync_token:%s" % calendar_id)
+        assert (token is None) == (calendar_id == broken)
+    assert calendar.total_entries == 900 - 50
+
+
+def test_legacy_page_files_are_imported(fake_google, backup_root):
+    fake = fake_google.fake
+    calendar = CalendarBackup(fake.email(0))
+    os.makedirs(calendar.rootpath)
+    calendar_id = fake.email(0)
+    pages = {
+        "%s-2014-01-01T00:00:00Z-0" % calendar_id: [{"id": "a", "sequence": 0}, {"id": "b", "sequence": 0}],
+        "%s-2014-01-02T00:00:00Z-0" % calendar_id: [{"id": "a", "sequence": 1}],
+        "%s-2014-01-02T00:00:00Z-1-deleted" % calendar_id: ["b"],
+    }
+    for name, items in pages.items():
+        with open("%s/%s" % (calendar.rootpath, name), "w") as page_file:
+            json.dump(items, page_file)
+    assert calendar.initialize()
+    event_log = calendar.event_log(calendar_id)
+    assert event_log.live_ids() == {"a"}
+    assert event_log.get("a")["sequence"] == 1
+    assert sorted(os.listdir(calendar.rootpath + "/legacy")) == sorted(pages)
@@ -0,0 +1,62 @@
+import pytest
+
+from google_backup import coordinator
+from google_backup.coordinator import Coordinator, parse_shard, shard_of
+
+
+def test_shards_are_stable_and_cover_every_user():
+    users = ["user%s@example.com" % index for index in range(100)]
+    shards = [shard_of(user, 4) for user in users]
+    assert set(shards) == {0, 1, 2, 3}
+    assert shards == [shard_of(user.upper(), 4) for user in users]
+    assert parse_shard("1/4") == (1, 4)
+    for value in ("4/4", "-1/4", "a/4", "1"):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_largest_jobs_are_claimed_once(tmp_path):
+    path = str(tmp_path / "leases.db")
+    first = Coordinator(path, "run", worker="first")
+    second = Coordinator(path, "run", worker="second")
+    first.add_jobs([("drive", "a@x", 10), ("drive", "b@x", 30), ("gmail", "a@x", 20)])
+    second.add_jobs([("drive", "a@x", 99)])
+    assert first.claim(["drive"]) == ("drive", "b@x", 30)
+    assert second.claim(["drive"]) == ("drive", "a@x", 10)
+    assert first.claim(["drive"]) is None
+    assert second.leased_elsewhere() == 1
+    first.finish("drive", "b@x", "done")
+    second.finish("drive", "a@x", "failed", "error")
+    assert first.statuses() == {"done": 1, "failed": 1, "pending": 1}
+    # A later process of the same run only gets what is left
+    assert Coordinator(path, "run", worker="third").claim(["drive", "gmail"]) == ("gmail", "a@x", 20)
+    assert Coordinator(path, "other run", worker="third").claim(["drive"]) is None
+
+
+def test_expired_leases_are_taken_over_then_given_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(coordinator, "COORDINATOR_LEASE_SECONDS", -1)
+    monkeypatch.setattr(coordinator, "COORDINATOR_MAX_ATTEMPTS", 2)
+    path = str(tmp_path / "leases.db")
+    first = Coordinator(path, "run", worker="first")
+    second = Coordinator(path, "run", worker="second")
+    first.add_jobs([("drive", "a@x", 10)])
+    assert first.claim(["drive"]) == ("drive", "a@x", 10)
+    assert second.claim(["drive"]) == ("drive", "a@x", 10)
+    # The first worker lost its lease, so its result is not recorded
+    first.finish("drive", "a@x", "done")
+    assert first.statuses() == {"running": 1}
+    assert first.claim(["drive"]) is None
+    assert first.statuses() == {"failed": 1}
+
+
+def test_heartbeats_keep_leases(tmp_path, monkeypatch):
+    path = str(tmp_path / "leases.db")
+    first = Coordinator(path, "run", worker="first")
+    first.add_jobs([("drive", "a@x", 10)])
+    monkeypatch.setattr(coordinator, "COORDINATOR_LEASE_SECONDS", -1)
+    assert first.claim(["drive"]) is not None
+    monkeypatch.setattr(coordinator, "COORDINATOR_LEASE_SECONDS", 60)
+    first.heartbeat()
+    assert Coordinator(path, "run", worker="second").claim(["drive"]) is None
+    first.finish("drive", "a@x", "done")
+    assert first.statuses() == {"done": 1}
@@ -0,0 +1,52 @@
+import datetime
+
+import httplib2
+
+from google_backup import helpers
+from google_backup.helpers import CredentialCache
+
+
+class Credentials:
+    def __init__(self, email, key, scope, sub):
+        self.sub = sub
+        self.access_token = None
+        self.token_expiry = None
+        self.refreshes = 0
+
+    def refresh(self, http):
+        self.refreshes += 1
+        self.access_token = "token %s" % self.refreshes
+        self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+def test_access_tokens_are_refreshed_only_before_they_expire(monkeypatch, tmp_path):
+    key = tmp_path / "key.p12"
+    key.write_bytes(b"key")
+    monkeypatch.setattr(helpers, "SERVICE_ACCOUNT_PKCS12_FILE_PATH", str(key))
+    monkeypatch.setattr(helpers, "SignedJwtAssertionCredentials", Credentials)
+    cache = CredentialCache()
+    credentials = cache.get_credentials("a@x", "scope")
+    assert cache.get_credentials("a@x", "scope") is credentials
+    assert credentials.refreshes == 1
+    assert cache.get_credentials("b@x", "scope").sub == "b@x"
+    credentials.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=helpers.TOKEN_REFRESH_MARGIN - 1)
+    assert cache.get_credentials("a@x", "scope").access_token == "token 2"
+    key.unlink()
+    assert cache.get_credentials("c@x", "scope").access_token == "token 1"
+
+
+def test_discovery_documents_are_fetched_once(fake_google, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    requests = []
+    request = httplib2.Http.request
+
+    def counted_request(self, uri, *args, **kwargs):
+        requests.append(uri)
+        return request(self, uri, *args, **kwargs)
+
+    monkeypatch.setattr(httplib2.Http, "request", counted_request)
+    cache = CredentialCache()
+    for _ in range(3):
+        service = cache.build("drive", "v2", httplib2.Http())
+    assert service.files() is not None
+    assert len(requests) == 1
@@ -0,0 +1,117 @@
+import hashlib
+import http.client
+import os
+import threading
+import time
+import urllib.error
+
+import pytest
+
+from google_backup.downloader import ByteBudget, ChecksumMismatch, stream_to_file
+
+
+def file_url(server, user, index):
+    return "%s/download/%s" % (server.base_url, server.fake.file_id(user, index))
+
+
+def file_md5(server, user, index):
+    fake = server.fake
+    return fake.content_md5(fake.file_size, fake.file_key(user, index))
+
+
+def auth(server, user):
+    return {"Authorization": "Bearer fake:%s" % server.fake.email(user)}
+
+
+def test_byte_budget_blocks_until_bytes_are_released():
+    budget = ByteBudget(100)
+    assert budget.acquire(500) == 100
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (budget.acquire(10), acquired.set()))
+    thread.start()
+    time.sleep(0.05)
+    assert not acquired.is_set()
+    budget.release(100)
+    thread.join(1)
+    assert acquired.is_set()
+    assert budget.used == 10
+
+
+def test_stream_to_file_writes_whole_file_in_chunks(fake_google, tmp_path):
+    budget = ByteBudget(64 * 1024)
+    path = str(tmp_path / "file.data")
+    size = stream_to_file(file_url(fake_google, 0, 1), path, auth(fake_google, 0), chunk_size=16 * 1024, budget=budget)
+    assert size == fake_google.fake.file_size == os.path.getsize(path)
+    assert budget.used == 0
+    assert os.listdir(str(tmp_path)) == ["file.data"]
+
+
+def test_http_errors_leave_no_file(fake_google, tmp_path):
+    path = str(tmp_path / "file.data")
+    with pytest.raises(urllib.error.HTTPError) as err:
+        stream_to_file("%s/download/u00000-f009999" % fake_google.base_url, path, {})
+    assert err.value.code == 401
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_checksum_mismatch_keeps_previous_version(fake_google, tmp_path):
+    path = tmp_path / "file.data"
+    path.write_bytes(b"previous")
+    with pytest.raises(ChecksumMismatch):
+        stream_to_file(file_url(fake_google, 0, 1), str(path), auth(fake_google, 0), md5=file_md5(fake_google, 0, 2))
+    assert path.read_bytes() == b"previous"
+
+
+def served_bytes(server):
+    with server.fake.lock:
+        return server.fake.stats.get("bytes", 0)
+
+
+def test_interrupted_download_resumes_from_partial_file(fake_google, tmp_path):
+    fake = fake_google.fake
+    path = str(tmp_path / "file.data")
+    fake.interruptions = 1.0
+    with pytest.raises(http.client.IncompleteRead):
+        stream_to_file(file_url(fake_google, 0, 1), path, auth(fake_google, 0), md5=file_md5(fake_google, 0, 1))
+    assert os.path.getsize(path + ".part") == fake.file_size // 2
+    assert not os.path.exists(path)
+    fake.interruptions = 0.0
+    served = served_bytes(fake_google)
+    size = stream_to_file(file_url(fake_google, 0, 1), path, auth(fake_google, 0), md5=file_md5(fake_google, 0, 1))
+    assert size == fake.file_size == os.path.getsize(path)
+    # Only the missing half is downloaded again
+    assert served_bytes(fake_google) - served == fake.file_size - fake.file_size // 2
+    assert os.listdir(str(tmp_path)) == ["file.data"]
+
+
+def test_complete_partial_file_is_renamed_without_downloading(fake_google, tmp_path):
+    path = str(tmp_path / "file.data")
+    stream_to_file(file_url(fake_google, 0, 1), path + ".part", auth(fake_google, 0))
+    served = served_bytes(fake_google)
+    size = stream_to_file(file_url(fake_google, 0, 1), path, auth(fake_google, 0), md5=file_md5(fake_google, 0, 1))
+    assert size == fake_google.fake.file_size
+    assert served_bytes(fake_google) == served
+    assert os.listdir(str(tmp_path)) == ["file.data"]
+
+
+def test_corrupted_partial_file_is_discarded(fake_google, tmp_path):
+    path = tmp_path / "file.data"
+    (tmp_path / "file.data.part").write_bytes(b"corrupted")
+    with pytest.raises(ChecksumMismatch):
+        stream_to_file(file_url(fake_google, 0, 1), str(path), auth(fake_google, 0), md5=file_md5(fake_google, 0, 1))
+    assert os.listdir(str(tmp_path)) == []
+    size = stream_to_file(file_url(fake_google, 0, 1), str(path), auth(fake_google, 0), md5=file_md5(fake_google, 0, 1))
+    assert size == fake_google.fake.file_size
+
+
+def test_partial_export_restarts_when_range_is_not_served(fake_google, tmp_path):
+    fake = fake_google.fake
+    url = "%s/export/%s?mimeType=application%%2Fpdf" % (fake_google.base_url, fake.file_id(0, fake.files))
+    whole = tmp_path / "whole.data"
+    stream_to_file(url, str(whole), auth(fake_google, 0))
+    data = whole.read_bytes()
+    path = tmp_path / "file.data"
+    (tmp_path / "file.data.part").write_bytes(data[:len(data) // 2])
+    md5 = hashlib.md5(data).hexdigest()
+    assert stream_to_file(url, str(path), auth(fake_google, 0), md5=md5) == len(data)
+    assert path.read_bytes() == data
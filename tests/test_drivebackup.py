@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import time
+
+import pytest
+from apiclient.errors import HttpError
+
+from google_backup import drivebackup
+from google_backup.drivebackup import DriveBackup
+from google_backup.fakegoogle import DOCUMENT_MIMETYPE, FakeError
+
+
+def run_backup(email):
+    drive = DriveBackup(email)
+    assert drive.has_changes()
+    assert drive.initialize()
+    drive.run()
+    return drive
+
+
+def stats(server):
+    with server.fake.lock:
+        return dict(server.fake.stats)
+
+
+def test_first_run_downloads_every_file(fake_google, backup_root):
+    fake = fake_google.fake
+    drive = run_backup(fake.email(0))
+    for index in range(fake.files):
+        path = "%s/content/%s.data" % (drive.rootpath, fake.file_id(0, index))
+        with open(path, "rb") as data:
+            assert hashlib.md5(data.read()).hexdigest() == fake.content_md5(fake.file_size, fake.file_key(0, index))
+        with open(path[:-len(".data")] + ".json") as metadata:
+            assert json.load(metadata)["id"] == fake.file_id(0, index)
+    assert os.path.exists("%s/content/%s.data" % (drive.rootpath, fake.file_id(0, fake.files)))
+    assert len(drive.run_state.items("file")) == fake.files + fake.documents
+    assert drive.run_state.get("largest_change_id") is not None
+    assert not DriveBackup(fake.email(0)).has_changes()
+
+
+def test_incremental_run_downloads_only_changed_files(fake_google, backup_root):
+    fake = fake_google.fake
+    fake.changes = 1
+    run_backup(fake.email(0))
+    downloads = stats(fake_google)["download"]
+    fake.advance()
+    drive = run_backup(fake.email(0))
+    assert stats(fake_google)["download"] == downloads + 1
+    path = "%s/content/%s.data" % (drive.rootpath, fake.file_id(0, 0))
+    with open(path, "rb") as data:
+        assert hashlib.md5(data.read()).hexdigest() == fake.content_md5(fake.file_size, fake.file_key(0, 0))
+
+
+def test_state_is_seeded_from_content_of_earlier_versions(fake_google, backup_root):
+    fake = fake_google.fake
+    drive = run_backup(fake.email(0))
+    for kind in ("file", "export"):
+        drive.run_state.clear_items(kind)
+    drive.run_state.set("largest_change_id", None)
+    drive.run_state.commit()
+    downloads = stats(fake_google)["download"]
+    run_backup(fake.email(0))
+    assert stats(fake_google)["download"] == downloads
+
+
+def test_removed_files_are_moved_to_deleted(fake_google, backup_root):
+    fake = fake_google.fake
+    drive = run_backup(fake.email(0))
+    file_id = fake.file_id(0, 1)
+    drive.state = drive.load_state()
+    drive.process_file(file_id, None, {"deleted": 0})
+    drive.save_state()
+    assert not os.path.exists("%s/content/%s.data" % (drive.rootpath, file_id))
+    assert os.path.exists("%s/content/deleted/%s.data" % (drive.rootpath, file_id))
+    assert os.path.exists("%s/content/deleted/%s.json" % (drive.rootpath, file_id))
+    assert file_id not in drive.run_state.items("file")
+
+
+def test_removal_listed_after_a_change_is_applied_after_its_download(fake_google, backup_root, monkeypatch):
+    fake = fake_google.fake
+    fake.changes = 1
+    drive = run_backup(fake.email(0))
+    file_id = fake.file_id(0, 0)
+    # Listed as a new file that is removed again later in the same listing
+    drive.state = drive.load_state()
+    drive.process_file(file_id, None, {"deleted": 0})
+    drive.save_state()
+    fake.advance()
+    changes_list = fake_google.api.drive_changes_list
+    removed = []
+
+    def changes_with_removals(user, arguments, query):
+        result = changes_list(user, arguments, query)
+        removed.extend(change["fileId"] for change in result["items"])
+        for changed_id in [change["fileId"] for change in result["items"]] + ["unknown"]:
+            result["items"].append({"kind": "drive#change", "id": "0", "fileId": changed_id, "deleted": True})
+        return result
+
+    monkeypatch.setattr(fake_google.api, "drive_changes_list", changes_with_removals)
+    drive = run_backup(fake.email(0))
+    assert not os.path.exists("%s/content/%s.data" % (drive.rootpath, file_id))
+    assert file_id not in drive.run_state.items("file")
+    assert len(drive.run_state.items("file")) == fake.files + fake.documents - len(removed)
+
+
+def test_documents_are_not_exported_again_when_only_their_version_changes(fake_google, backup_root):
+    fake = fake_google.fake
+    fake.changes = 0
+    run_backup(fake.email(0))
+    exports = stats(fake_google)["export"]
+    fake.advance()
+    drive = run_backup(fake.email(0))
+    assert stats(fake_google)["export"] == exports
+    with open("%s/content/%s.json" % (drive.rootpath, fake.file_id(0, fake.files))) as metadata:
+        assert json.load(metadata)["version"] == "2"
+
+
+def test_extra_export_formats_are_stored_and_moved_with_the_document(fake_google, backup_root, monkeypatch):
+    fake = fake_google.fake
+    fake.changes = 0
+    formats = [
+        ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "docx"), ("application/pdf", "pdf")
+    ]
+    monkeypatch.setattr(drivebackup, "DRIVE_EXPORT_FORMATS", {DOCUMENT_MIMETYPE: formats})
+    monkeypatch.setattr(drivebackup, "EXPORT_EXTENSIONS", ["pdf"])
+    drive = run_backup(fake.email(0))
+    file_id = fake.file_id(0, fake.files)
+    assert stats(fake_google)["export"] == 2
+    assert os.path.exists("%s/content/%s.data" % (drive.rootpath, file_id))
+    assert os.path.exists("%s/content/%s.pdf" % (drive.rootpath, file_id))
+    # A format added later is exported without exporting the others again
+    formats.append(("text/plain", "txt"))
+    monkeypatch.setattr(drivebackup, "EXPORT_EXTENSIONS", ["pdf", "txt"])
+    fake.advance()
+    drive = run_backup(fake.email(0))
+    assert stats(fake_google)["export"] == 3
+    drive.state = drive.load_state()
+    drive.process_file(file_id, None, {"deleted": 0})
+    drive.save_state()
+    for extension in ("data", "pdf", "txt"):
+        assert not os.path.exists("%s/content/%s.%s" % (drive.rootpath, file_id, extension))
+        assert os.path.exists("%s/content/deleted/%s.%s" % (drive.rootpath, file_id, extension))
+    assert not [key for key in drive.exports if key.startswith(file_id + "|")]
+
+
+def test_failed_listing_records_downloads_queued_before_a_removal(fake_google, backup_root, monkeypatch):
+    fake = fake_google.fake
+    fake.changes = 1
+    drive = run_backup(fake.email(0))
+    file_id = fake.file_id(0, 0)
+    drive.state = drive.load_state()
+    drive.process_file(file_id, None, {"deleted": 0})
+    drive.save_state()
+    fake.advance()
+    changes_list = fake_google.api.drive_changes_list
+
+    def failing_changes_list(user, arguments, query):
+        if query.get("pageToken"):
+            raise FakeError(404, "notFound", "Not Found")
+        result = changes_list(user, arguments, query)
+        result["items"] = result["items"][:1] + [
+            {"kind": "drive#change", "id": "0", "fileId": fake.file_id(0, 1), "deleted": True}
+        ]
+        result["nextPageToken"] = "next"
+        return result
+
+    download_item = DriveBackup.download_item
+
+    def slow_download_item(self, item, target):
+        # Still downloading when the listing fails
+        time.sleep(0.5)
+        return download_item(self, item, target)
+
+    monkeypatch.setattr(fake_google.api, "drive_changes_list", failing_changes_list)
+    monkeypatch.setattr(DriveBackup, "download_item", slow_download_item)
+    drive = DriveBackup(fake.email(0))
+    assert drive.initialize()
+    with pytest.raises(HttpError):
+        drive.run()
+    assert file_id in drive.run_state.items("file")
+    assert os.path.exists("%s/content/%s.data" % (drive.rootpath, file_id))
@@ -0,0 +1,68 @@
+import os
+
+from google_backup.eventlog import EventLog
+
+
+def event(event_id, sequence=0):
+    return {"id": event_id, "status": "confirmed", "sequence": sequence}
+
+
+def test_latest_versions_and_tombstones(tmp_path):
+    log = EventLog(str(tmp_path), "calendar")
+    log.append([event("a"), event("b")])
+    log.append([event("a", 1)])
+    log.delete(["b"])
+    log.save_index()
+    log = EventLog(str(tmp_path), "calendar")
+    assert log.get("a")["sequence"] == 1
+    assert log.get("b")["status"] == "cancelled"
+    assert log.get("c") is None
+    assert log.live_ids() == {"a"}
+
+
+def test_blocks_appended_after_the_index_are_recovered(tmp_path):
+    log = EventLog(str(tmp_path), "calendar")
+    log.append([event("a")])
+    log.save_index()
+    log.append([event("b")])
+    # Interrupted in the middle of writing a block
+    with open(log.log_path, "ab") as log_file:
+        log_file.write(b"\0\0\1\0partial")
+    log = EventLog(str(tmp_path), "calendar")
+    assert log.live_ids() == {"a", "b"}
+    assert os.path.getsize(log.log_path) == log.size
+    log.append([event("c")])
+    assert EventLog(str(tmp_path), "calendar").live_ids() == {"a", "b", "c"}
+
+
+def test_index_of_another_log_is_rebuilt(tmp_path):
+    log = EventLog(str(tmp_path), "calendar")
+    log.append([event("a"), event("b")])
+    log.save_index()
+    with open(log.index_path) as index_file:
+        index = index_file.read()
+    log.compact()
+    log.append([event("c")])
+    log.save_index()
+    with open(log.index_path, "w") as index_file:
+        index_file.write(index)
+    assert EventLog(str(tmp_path), "calendar").live_ids() == {"a", "b", "c"}
+
+
+def test_compaction_keeps_only_latest_live_events(tmp_path):
+    log = EventLog(str(tmp_path), "calendar")
+    for sequence in range(5):
+        log.append([event("e%s" % index, sequence) for index in range(10)])
+    log.delete(["e0", "e1"])
+    log.save_index()
+    assert log.needs_compaction(ratio=2, min_size=0)
+    assert not log.needs_compaction(ratio=2, min_size=log.size + 1)
+    size = log.size
+    log.compact()
+    assert log.size < size
+    assert log.records == 8
+    assert not log.needs_compaction(ratio=2, min_size=0)
+    log = EventLog(str(tmp_path), "calendar")
+    assert log.live_ids() == {"e%s" % index for index in range(2, 10)}
+    assert log.get("e5")["sequence"] == 4
+    assert log.get("e0") is None
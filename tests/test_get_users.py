@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from google_backup import get_users
+from google_backup.get_users import get_user_directory, is_dormant, rfc3339
+from google_backup.helpers import StateStore
+
+
+def days_ago(days):
+    return rfc3339(time.time() - days * 24 * 3600)
+
+
+def test_dormant_users():
+    assert is_dormant({"lastLoginTime": days_ago(30), "creationTime": days_ago(300)}, 14)
+    assert not is_dormant({"lastLoginTime": days_ago(3), "creationTime": days_ago(300)}, 14)
+    assert is_dormant({"lastLoginTime": "1970-01-01T00:00:00.000Z", "creationTime": days_ago(300)}, 14)
+    # Created recently, and never logged in yet
+    assert not is_dormant({"lastLoginTime": "1970-01-01T00:00:00.000Z", "creationTime": days_ago(3)}, 14)
+    # Created through the audit log since the last full listing
+    assert not is_dormant({"primaryEmail": "new@example.com", "suspended": False}, 14)
+
+
+@pytest.fixture
+def directory(fake_google, backup_root, monkeypatch):
+    monkeypatch.setattr(get_users, "USERS_ADMIN_EMAIL", "admin@example.com")
+    monkeypatch.setattr(get_users, "STATE", StateStore(str(backup_root / "state.sqlite")))
+    return fake_google
+
+
+def test_refresh_applies_admin_and_login_events(directory, monkeypatch):
+    fake = directory.fake
+    users = get_user_directory("example.com")
+    assert sorted(users) == [fake.email(0), fake.email(1)]
+    refreshed = time.time() - get_users.USERS_REFRESH_INTERVAL - 10
+    get_users.STATE.set_cursor(get_users.STATE_SERVICE, "example.com", "refreshed", refreshed)
+    get_users.STATE.commit(get_users.STATE_SERVICE, "example.com")
+
+    login_time = days_ago(0)
+    created = days_ago(1)
+    queries = []
+
+    def activities_list(user, arguments, query):
+        queries.append((arguments["applicationName"], query.get("startTime"), query.get("eventName")))
+        if arguments["applicationName"] == "login":
+            items = [{"id": {"time": login_time}, "actor": {"email": fake.email(0)}}]
+        else:
+            items = [{
+                "id": {"time": created},
+                "events": [{"name": "CREATE_USER", "parameters": [{"name": "USER_EMAIL", "value": "new@example.com"}]}],
+            }]
+        return {"items": items}
+
+    monkeypatch.setattr(directory.api, "admin_activities_list", activities_list)
+    users = get_user_directory("example.com")
+    start_time = rfc3339(refreshed - get_users.USERS_AUDIT_LOG_OVERLAP)
+    assert sorted(queries) == [("admin", start_time, None), ("login", start_time, "login_success")]
+    assert users["new@example.com"]["creationTime"] == created
+    assert users[fake.email(0)]["lastLoginTime"] == login_time
+    assert users[fake.email(1)]["lastLoginTime"] == "2015-01-01T00:00:00.000Z"
+    assert not is_dormant(users["new@example.com"], 7)
+    assert not is_dormant(users[fake.email(0)], 7)
+    assert is_dormant(users[fake.email(1)], 7)
+    # Events seen again in the overlap change nothing.
+    get_users.STATE.set_cursor(get_users.STATE_SERVICE, "example.com", "refreshed", refreshed)
+    assert get_user_directory("example.com") == users
+    assert len(queries) == 4
@@ -0,0 +1,44 @@
+import logging
+
+import pytest
+
+from google_backup.fakegoogle import HISTORY_BASE
+from google_backup.gmailbackup import SCOPE, GmailBackup
+from google_backup.gmailhistory import HistoryExpired, HistorySync, api_id_to_msgid, label_flags
+from google_backup.mailstore import MaildirStore
+
+
+def test_api_ids_and_labels_are_mapped():
+    assert api_id_to_msgid("ff") == "255"
+    assert label_flags(["INBOX", "UNREAD"]) == []
+    assert label_flags(["STARRED", "DRAFT"]) == ["\\Seen", "\\Flagged", "\\Draft"]
+
+
+@pytest.fixture
+def history_sync(fake_google, backup_root):
+    fake = fake_google.fake
+    service = GmailBackup(fake.email(0)).impersonate_user(SCOPE, "gmail", "v1")
+    store = MaildirStore(str(backup_root))
+    for folder in ("[Gmail]/All Mail", "INBOX"):
+        store.add_folder(folder)
+    return HistorySync(service, store, logging.getLogger("test"))
+
+
+def test_new_messages_are_downloaded_once_into_their_folders(fake_google, history_sync):
+    fake = fake_google.fake
+    fake.changes = 10
+    fake.advance()
+    assert history_sync.run(str(HISTORY_BASE)) == str(HISTORY_BASE + 1)
+    assert history_sync.total_processed == 10
+    added = range(fake.messages, fake.messages + 10)
+    store = history_sync.store
+    for index in added:
+        assert store.folders_of(str(fake.msgid(0, index))) == set(fake.message_folders(index))
+    assert "Work" in store.folders()
+    assert history_sync.run(str(HISTORY_BASE + 1)) == str(HISTORY_BASE + 1)
+    assert history_sync.total_processed == 10
+
+
+def test_expired_history_is_reported(fake_google, history_sync):
+    with pytest.raises(HistoryExpired):
+        history_sync.run(str(HISTORY_BASE - 1))
@@ -0,0 +1,76 @@
+import logging
+import threading
+
+import pytest
+
+from google_backup import imapsync
+from google_backup.fakegoogle import IMAP_FOLDERS, FakeDomain, FakeImapServer
+from google_backup.imapsync import ImapSync, compress_uids, parse_fetch, quote_folder, unquote_folder
+from google_backup.mailstore import MaildirStore
+
+
+def test_uids_are_compressed_to_ranges():
+    assert compress_uids([1, 2, 3, 7]) == "1:3,7"
+    assert compress_uids([5]) == "5"
+    assert compress_uids([1, 3, 4, 5, 9, 10]) == "1,3:5,9:10"
+
+
+def test_folder_names_are_quoted():
+    for folder in ("INBOX", "[Gmail]/All Mail", 'say "hi"', "back\\slash"):
+        assert unquote_folder(quote_folder(folder)) == folder
+    assert unquote_folder("INBOX") == "INBOX"
+
+
+def test_fetch_responses_are_parsed():
+    data = [
+        (b"1 (UID 7 X-GM-MSGID 123 FLAGS (\\Seen) BODY[] {5}", b"hello"),
+        b")",
+        (b"2 (UID 9 FLAGS () BODY[] {3}", b"bye"),
+        b")",
+        b"3 (FLAGS (\\Seen))",
+    ]
+    assert parse_fetch(data) == [(7, "123", ["\\Seen"], b"hello"), (9, None, [], b"bye")]
+
+
+@pytest.fixture
+def imap_server(monkeypatch):
+    server = FakeImapServer(FakeDomain(users=1, messages=30))
+    threading.Thread(target=server.serve_forever, name="fake-imap", daemon=True).start()
+    monkeypatch.setattr(imapsync, "GMAIL_IMAP_HOST", "127.0.0.1")
+    monkeypatch.setattr(imapsync, "GMAIL_IMAP_PORT", server.server_address[1])
+    monkeypatch.setattr(imapsync, "GMAIL_IMAP_SSL", False)
+    monkeypatch.setattr(imapsync, "GMAIL_FETCH_BATCH_SIZE", 4)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def sync(server, root):
+    store = MaildirStore(str(root))
+    imap = ImapSync(server.fake.email(0), lambda: "fake:%s" % server.fake.email(0), store, logging.getLogger("test"))
+    assert imap.run()
+    return (imap, store)
+
+
+def test_messages_with_several_labels_are_downloaded_once(imap_server, tmp_path):
+    fake = imap_server.fake
+    imap, store = sync(imap_server, tmp_path)
+    assert imap.total_processed == fake.messages
+    assert imap.total_deduplicated == sum(len(fake.message_folders(index)) - 1 for index in range(fake.messages))
+    for folder in IMAP_FOLDERS:
+        expected = {index + 1 for index in range(fake.messages) if folder in fake.message_folders(index)}
+        assert store.uids(folder) == expected
+    assert store.folders_of(str(fake.msgid(0, 0))) == set(fake.message_folders(0))
+
+
+def test_incremental_sync_fetches_new_and_removes_deleted(imap_server, tmp_path):
+    fake = imap_server.fake
+    sync(imap_server, tmp_path)
+    fake.messages = 20
+    imap, store = sync(imap_server, tmp_path)
+    assert imap.total_processed == 0
+    assert store.uids("[Gmail]/All Mail") == set(range(1, 21))
+    fake.messages = 25
+    imap, store = sync(imap_server, tmp_path)
+    assert imap.total_processed == 5
+    assert store.uids("[Gmail]/All Mail") == set(range(1, 26))
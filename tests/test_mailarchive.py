@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from google_backup import mailarchive
+from google_backup.mailarchive import ArchiveStore, export_maildir, import_maildir
+from google_backup.mailstore import MaildirStore
+
+
+def message(index, size=2000):
+    return b"Subject: Message %d\r\n\r\n" % index + os.urandom(size).hex().encode("ascii")
+
+
+def test_messages_with_several_labels_are_stored_once(tmp_path):
+    archive = ArchiveStore(str(tmp_path))
+    archive.add("[Gmail]/All Mail", 1, "100", ["\\Seen"], message(1))
+    archive.add("INBOX", 7, "100", [], message(1))
+    assert archive.add_existing("Work", 3, "100", ["\\Flagged"])
+    assert not archive.add_existing("Work", 4, "101", [])
+    archive.commit()
+    assert archive.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 1
+    assert archive.folders_of("100") == {"[Gmail]/All Mail", "INBOX", "Work"}
+    assert list(archive.messages("Work")) == [(3, "100", ["\\Flagged"])]
+    raw = archive.read("100")
+    archive.close()
+    assert ArchiveStore(str(tmp_path)).read("100") == raw
+
+
+def test_messages_without_msgid_are_keyed_by_contents(tmp_path):
+    archive = ArchiveStore(str(tmp_path))
+    archive.add("INBOX", 1, None, [], message(1))
+    archive.add("INBOX", 2, None, [], message(1, size=0))
+    archive.add("Sent", 5, None, [], message(1, size=0))
+    assert archive.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 2
+
+
+def test_unreferenced_messages_are_dropped_and_segments_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(mailarchive, "GMAIL_ARCHIVE_SEGMENT_SIZE", 10000)
+    archive = ArchiveStore(str(tmp_path))
+    messages = {str(index): message(index) for index in range(20)}
+    for uid, (msgid, raw) in enumerate(sorted(messages.items()), 1):
+        archive.add("INBOX", uid, msgid, [], raw)
+    archive.commit()
+    first_segments = archive.segments()[:-1]
+    assert first_segments
+    for uid in range(1, 16):
+        archive.remove("INBOX", uid)
+    archive.close()
+    archive = ArchiveStore(str(tmp_path))
+    assert not set(first_segments) & set(archive.segments())
+    live = sorted(messages)[15:]
+    assert sorted(row[0] for row in archive.db.execute("SELECT msgid FROM blobs")) == live
+    for msgid in live:
+        assert archive.read(msgid) == messages[msgid]
+
+
+def test_maildir_round_trip(tmp_path):
+    os.makedirs(tmp_path / "maildir")
+    maildir = MaildirStore(str(tmp_path / "maildir"))
+    maildir.set_uidvalidity("INBOX", 5)
+    maildir.add("INBOX", 1, "100", ["\\Seen"], message(1))
+    maildir.add("INBOX", 2, "101", [], message(2))
+    maildir.commit()
+    archive = ArchiveStore(str(tmp_path / "archive"))
+    import_maildir(maildir, archive)
+    export_maildir(archive, str(tmp_path / "export"))
+    exported = MaildirStore(str(tmp_path / "export"))
+    assert exported.uids("INBOX") == {1, 2}
+    filenames = dict(exported.db.execute("SELECT uid, filename FROM messages WHERE folder = 'INBOX'"))
+    assert filenames[1].endswith(":2,S") and filenames[2].endswith(":2,")
+    with open("%s/%s" % (exported.folder_path("INBOX"), filenames[2]), "rb") as message_file:
+        assert message_file.read() == archive.read("101")
+    assert exported.set_uidvalidity("INBOX", 5)
+
+
+def test_maildir_without_index_is_imported(tmp_path):
+    maildir = tmp_path / "maildir"
+    for subdir in ("cur", "new", "tmp"):
+        os.makedirs(maildir / "INBOX" / subdir)
+        os.makedirs(maildir / "[Gmail].All Mail" / subdir)
+    labelled = message(1)
+    # As offlineimap names them
+    (maildir / "INBOX" / "cur" / "1_1.1.host,U=1,FMD5=x:2,S").write_bytes(labelled)
+    (maildir / "INBOX" / "new" / "1_2.1.host,U=2,FMD5=x:2,").write_bytes(message(2))
+    (maildir / "[Gmail].All Mail" / "cur" / "1_3.1.host,U=7,FMD5=y:2,S").write_bytes(labelled)
+    archive = ArchiveStore(str(tmp_path / "archive"))
+    import_maildir(MaildirStore(str(maildir)), archive)
+    assert archive.folders() == {"INBOX", "[Gmail]/All Mail"}
+    assert archive.uids("INBOX") == {1, 2}
+    assert archive.uids("[Gmail]/All Mail") == {7}
+    assert archive.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 2
+
+
+def test_importing_an_empty_maildir_fails(tmp_path):
+    os.makedirs(tmp_path / "maildir")
+    with pytest.raises(ValueError):
+        import_maildir(MaildirStore(str(tmp_path / "maildir")), ArchiveStore(str(tmp_path / "archive")))
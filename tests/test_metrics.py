@@ -0,0 +1,74 @@
+import json
+import logging
+import socket
+import urllib.request
+
+from google_backup import metrics
+from google_backup.metrics import Registry, finish_run, start_http_server
+
+
+def test_histograms_are_rendered_cumulatively():
+    registry = Registry()
+    histogram = registry.histogram("seconds", "Duration.", ("api", ), buckets=(1, 10))
+    for value in (0.5, 2, 20):
+        histogram.observe(value, api="drive")
+    registry.counter("retries_total", "Retries.", ("api", "reason")).inc(api='a"b', reason="quota")
+    assert registry.render().splitlines() == [
+        "# HELP retries_total Retries.",
+        "# TYPE retries_total counter",
+        'retries_total{api="a\\"b",reason="quota"} 1',
+        "# HELP seconds Duration.",
+        "# TYPE seconds histogram",
+        'seconds_bucket{api="drive",le="1"} 1',
+        'seconds_bucket{api="drive",le="10"} 2',
+        'seconds_bucket{api="drive",le="+Inf"} 3',
+        'seconds_sum{api="drive"} 22.5',
+        'seconds_count{api="drive"} 3',
+    ]
+
+
+def test_worker_metrics_are_merged():
+    main, worker = Registry(), Registry()
+    for registry in (main, worker):
+        registry.counter("requests_total", "Requests.", ("api", ))
+        registry.histogram("seconds", "Duration.", buckets=(1, ))
+        registry.gauge("running", "Running jobs.")
+    main.metrics["requests_total"].inc(2, api="gmail")
+    worker.metrics["requests_total"].inc(3, api="gmail")
+    worker.metrics["seconds"].observe(0.5)
+    worker.metrics["running"].set(4)
+    main.merge(json.loads(json.dumps(worker.collect(reset=True))))
+    assert main.metrics["requests_total"].collect() == [[["gmail"], 5]]
+    assert main.metrics["seconds"].collect() == [[[], [1, 0.5, 1]]]
+    assert main.metrics["running"].collect() == [[[], 4]]
+    assert worker.metrics["requests_total"].collect() == []
+
+
+def test_run_report_and_textfile_are_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_REPORT_DIRECTORY", str(tmp_path / "reports"))
+    textfile = tmp_path / "backup.prom"
+    monkeypatch.setattr(metrics, "write_textfile", lambda: metrics.write_atomic(str(textfile), metrics.METRICS.render()))
+    jobs = [
+        {"service": "drive", "user": "a@x", "status": "ok", "elapsed": 1.0},
+        {"service": "drive", "user": "b@x", "status": "failed", "elapsed": 5.0},
+    ]
+    report = finish_run("test", 0, jobs, logging.getLogger("test"))
+    assert report["statuses"] == {"drive": {"ok": 1, "failed": 1}}
+    assert [job["user"] for job in report["jobs"]] == ["b@x", "a@x"]
+    (path, ) = (tmp_path / "reports").iterdir()
+    assert json.loads(path.read_text())["statuses"] == report["statuses"]
+    assert 'google_backup_run_jobs{service="drive",status="failed"} 1' in textfile.read_text()
+
+
+def test_metrics_are_served_over_http():
+    assert start_http_server(port=None) is None
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = start_http_server(port, "127.0.0.1")
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:%s/metrics" % port) as response:
+            assert "# TYPE google_backup_job_seconds histogram" in response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
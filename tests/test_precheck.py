@@ -0,0 +1,44 @@
+from google_backup.calendarbackup import CalendarBackup
+from google_backup.fakegoogle import HISTORY_BASE
+from google_backup.gmailbackup import GmailBackup
+from google_backup.scheduler import Job, run_job
+
+
+def status(service, user, force=False):
+    return run_job(Job(service, user, 0), force=force).status
+
+
+def test_unchanged_drive_and_calendar_users_are_skipped(fake_google, backup_root):
+    fake = fake_google.fake
+    fake.changes = 1
+    for service in ("drive", "calendar"):
+        assert status(service, fake.email(0)) == "ok"
+        assert status(service, fake.email(0)) == "unchanged"
+        assert status(service, fake.email(0), force=True) == "ok"
+    fake.advance()
+    for service in ("drive", "calendar"):
+        assert status(service, fake.email(0)) == "ok"
+        assert status(service, fake.email(0)) == "unchanged"
+
+
+def test_gmail_compares_the_history_id(fake_google, backup_root):
+    fake = fake_google.fake
+    gmail = GmailBackup(fake.email(0))
+    assert gmail.has_changes()
+    gmail.save_history_id(HISTORY_BASE)
+    assert not gmail.has_changes()
+    fake.advance()
+    assert gmail.has_changes()
+
+
+def test_calendar_list_changes_are_changes(fake_google, backup_root):
+    fake = fake_google.fake
+    assert status("calendar", fake.email(0)) == "ok"
+    fake.calendars = 2
+    assert CalendarBackup(fake.email(0)).has_changes()
+
+
+def test_failed_prechecks_count_as_changes(fake_google, backup_root):
+    gmail = GmailBackup("unknown@example.com")
+    gmail.save_history_id(HISTORY_BASE)
+    assert gmail.has_changes()
@@ -0,0 +1,67 @@
+import io
+import logging
+import queue
+import threading
+
+from google_backup import imapsync, progress
+from google_backup.fakegoogle import FakeImapServer
+from google_backup.progress import ProgressReporter, ProgressTracker, QueueSink, format_bytes, format_eta
+from google_backup.scheduler import Job, run_job
+
+
+def test_formatting():
+    assert format_bytes(512) == "512.0B"
+    assert format_bytes(3 * 1024 * 1024) == "3.0MiB"
+    assert format_eta(None) == "--:--:--"
+    assert format_eta(3725) == "01:02:05"
+
+
+def test_reporter_batches_deltas_until_flush(monkeypatch):
+    monkeypatch.setattr(progress, "PROGRESS_FLUSH_INTERVAL", 3600)
+    sent = []
+    reporter = ProgressReporter(("gmail", "a@x"), lambda *item: sent.append(item))
+    reporter.add_total(10)
+    for _ in range(4):
+        reporter.processed(1, 100)
+    reporter.missed(1)
+    assert sent == []
+    reporter.finish()
+    assert sent == [(("gmail", "a@x"), {"total": 10, "processed": 4, "bytes": 400, "missed": 1}, True)]
+
+
+def test_tracker_aggregates_jobs_from_worker_processes(monkeypatch):
+    monkeypatch.setattr(progress, "PROGRESS_FLUSH_INTERVAL", 0)
+    progress_queue = queue.Queue()
+    tracker = ProgressTracker(logging.getLogger("test"), progress_queue, stream=io.StringIO())
+    first = ProgressReporter(("gmail", "a@x"), QueueSink(progress_queue))
+    second = ProgressReporter(("drive", "b@x"), QueueSink(progress_queue))
+    first.add_total(10)
+    first.processed(4, 1000)
+    second.add_total(5)
+    second.processed(5, 24)
+    second.finish()
+    tracker.drain(1)
+    assert tracker.job_totals() == {
+        ("gmail", "a@x"): {"total": 10, "processed": 4, "bytes": 1000, "missed": 0},
+        ("drive", "b@x"): {"total": 5, "processed": 5, "bytes": 24, "missed": 0},
+    }
+    assert tracker.status().startswith("9/15 items, 1.0KiB, ")
+    assert tracker.status().endswith(", 1 jobs running")
+
+
+def test_jobs_finish_their_progress_once(fake_google, backup_root, monkeypatch):
+    fake = fake_google.fake
+    server = FakeImapServer(fake)
+    threading.Thread(target=server.serve_forever, name="fake-imap", daemon=True).start()
+    monkeypatch.setattr(imapsync, "GMAIL_IMAP_HOST", "127.0.0.1")
+    monkeypatch.setattr(imapsync, "GMAIL_IMAP_PORT", server.server_address[1])
+    monkeypatch.setattr(imapsync, "GMAIL_IMAP_SSL", False)
+    try:
+        for service in ("gmail", "drive", "calendar"):
+            sent = []
+            reporter = ProgressReporter((service, fake.email(0)), lambda *item: sent.append(item))
+            assert run_job(Job(service, fake.email(0), 0), reporter).status == "ok"
+            assert [finished for _, _, finished in sent].count(True) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
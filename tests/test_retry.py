@@ -0,0 +1,108 @@
+import json
+import time
+import urllib.error
+
+import httplib2
+import pytest
+from apiclient.errors import HttpError
+
+from google_backup import helpers
+from google_backup.helpers import QuotaExhausted, RateLimiter, backoff_delay, call_with_retry, classify_error
+
+
+def http_error(status, reason=None, retry_after=None):
+    headers = {"status": status}
+    if retry_after is not None:
+        headers["retry-after"] = str(retry_after)
+    content = json.dumps({"error": {"errors": [{"reason": reason}] if reason else []}}).encode("utf-8")
+    return HttpError(httplib2.Response(headers), content)
+
+
+def test_rate_limiter_allows_bursts_then_waits_for_tokens():
+    limiter = RateLimiter("test", rate=100, burst=5)
+    assert sum(limiter.acquire() for _ in range(5)) == 0
+    assert limiter.acquire() > 0
+
+
+def test_quota_errors_slow_everyone_down_and_recover():
+    limiter = RateLimiter("test", rate=100, burst=5)
+    assert limiter.on_quota_error() == 0.5
+    assert limiter.on_quota_error(retry_after=0.1) == 0.25
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.09
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.multiplier == 1.0
+    for _ in range(20):
+        limiter.on_quota_error()
+    assert limiter.multiplier == RateLimiter.MIN_MULTIPLIER
+    limiter.on_quota_exhausted()
+    with pytest.raises(QuotaExhausted):
+        limiter.acquire()
+
+
+def test_errors_are_classified():
+    assert classify_error(http_error(403, "userRateLimitExceeded", 7)) == ("quota", 7.0)
+    assert classify_error(http_error(429)) == ("quota", None)
+    assert classify_error(http_error(403, "dailyLimitExceeded")) == ("exhausted", None)
+    assert classify_error(http_error(503)) == ("retry", None)
+    assert classify_error(http_error(404, "notFound")) == (None, None)
+    assert classify_error(http_error(403, "forbidden")) == (None, None)
+    assert classify_error(ConnectionResetError()) == ("retry", None)
+    assert classify_error(urllib.error.HTTPError("url", 502, "Bad Gateway", {}, None)) == ("retry", None)
+    assert classify_error(ValueError()) == (None, None)
+
+
+def test_backoff_delay_is_capped(monkeypatch):
+    monkeypatch.setattr(helpers, "RETRY_BASE_DELAY", 1)
+    monkeypatch.setattr(helpers, "RETRY_MAX_DELAY", 8)
+    assert all(0 <= backoff_delay(attempt) <= min(8, 2 ** attempt) for attempt in range(10) for _ in range(20))
+
+
+@pytest.fixture
+def no_delays(monkeypatch):
+    monkeypatch.setattr(helpers, "backoff_delay", lambda attempt: 0)
+    monkeypatch.setattr(helpers, "RATE_LIMITERS", {})
+
+
+def failing(*errors):
+    errors = list(errors)
+    calls = []
+
+    def func():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    return (func, calls)
+
+
+def test_transient_errors_are_retried(no_delays):
+    func, calls = failing(http_error(500), ConnectionResetError(), http_error(403, "rateLimitExceeded"))
+    assert call_with_retry(func, "test", "something") == "ok"
+    assert len(calls) == 4
+
+
+def test_permanent_errors_are_raised_at_once(no_delays):
+    func, calls = failing(http_error(404))
+    with pytest.raises(HttpError):
+        call_with_retry(func, "test", "something")
+    assert len(calls) == 1
+
+
+def test_retry_on_and_attempt_limit(no_delays, monkeypatch):
+    monkeypatch.setattr(helpers, "RETRY_MAX_ATTEMPTS", 3)
+    func, calls = failing(*[KeyError()] * 5)
+    with pytest.raises(KeyError):
+        call_with_retry(func, "test", "something", retry_on=(KeyError, ))
+    assert len(calls) == 3
+
+
+def test_exhausted_quota_stops_every_caller(no_delays):
+    func, _ = failing(http_error(403, "dailyLimitExceeded"))
+    with pytest.raises(QuotaExhausted):
+        call_with_retry(func, "test", "something")
+    with pytest.raises(QuotaExhausted):
+        call_with_retry(lambda: "ok", "test", "something else")
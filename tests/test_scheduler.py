@@ -0,0 +1,70 @@
+import time
+
+from google_backup import scheduler
+from google_backup.scheduler import BackupScheduler, Job, JobResult, format_summary
+
+
+def ok_job(job, progress=None, force=False):
+    return JobResult(job.service, job.user, "ok", None, 0.01, None)
+
+
+def test_jobs_are_ordered_by_previous_size_then_directory_usage():
+    sizes = {BackupScheduler(["drive"], ["a@x"], sizes={}).datasets["drive", "a@x"]: 500}
+    directory = {"b@x": {"usage": {"drive": 900}}, "c@x": {"usage": {"drive": 10}}}
+    backup = BackupScheduler(["drive"], ["a@x", "b@x", "c@x"], sizes=sizes, directory=directory)
+    assert [job.user for job in backup.pending["drive"]] == ["b@x", "a@x", "c@x"]
+
+
+def test_next_job_takes_largest_job_of_services_below_their_limit():
+    backup = BackupScheduler(["gmail", "drive"], ["a@x"], workers=4, service_limits={"gmail": 1}, sizes={})
+    backup.pending["gmail"][0] = Job("gmail", "a@x", 100)
+    backup.pending["drive"][0] = Job("drive", "a@x", 10)
+    backup.running["gmail"] = 1
+    assert backup.next_job() == Job("drive", "a@x", 10)
+    assert backup.next_job() is None
+    backup.running["gmail"] = 0
+    assert backup.next_job() == Job("gmail", "a@x", 100)
+
+
+def test_ignored_calendar_users_are_skipped(monkeypatch):
+    monkeypatch.setattr(scheduler, "CALENDAR_IGNORE_USERS", ["a@x"])
+    backup = BackupScheduler(["calendar", "drive"], ["a@x"], sizes={})
+    assert backup.skip_job(Job("calendar", "a@x", 0))
+    assert not backup.skip_job(Job("drive", "a@x", 0))
+
+
+def test_datasets_are_provisioned_only_for_jobs_that_run(monkeypatch):
+    provisioned = []
+    monkeypatch.setattr(scheduler, "CALENDAR_IGNORE_USERS", ["a@x"])
+    monkeypatch.setattr(scheduler, "SCHEDULER_SKIP_DORMANT_DAYS", 30)
+    monkeypatch.setattr(scheduler, "provision_datasets", lambda datasets: provisioned.extend(datasets) or {})
+    directory = {"b@x": {"lastLoginTime": "2000-01-01T00:00:00.000Z", "creationTime": "2000-01-01T00:00:00.000Z"}}
+    backup = BackupScheduler(["calendar", "drive"], ["a@x", "b@x"], directory=directory)
+    assert provisioned == [backup.datasets["drive", "a@x"]]
+
+
+def test_run_limits_concurrency_and_summarizes(monkeypatch):
+    running = []
+    peak = []
+
+    def slow_job(job, progress=None, force=False):
+        running.append(job)
+        peak.append(len(running))
+        time.sleep(0.02)
+        running.remove(job)
+        if job.user == "bad@x":
+            return JobResult(job.service, job.user, "failed", None, 0.02, "boom")
+        return ok_job(job)
+
+    monkeypatch.setattr(scheduler, "run_job", slow_job)
+    users = ["u%s@x" % index for index in range(6)] + ["bad@x"]
+    backup = BackupScheduler(["drive", "calendar"], users, workers=3, service_limits={"drive": 1}, sizes={})
+    summary = backup.run()
+    assert max(peak) <= 3
+    assert len(backup.results) == 14
+    assert summary["services"]["drive"]["ok"] == 6
+    assert summary["services"]["drive"]["failed_users"] == ["bad@x"]
+    assert summary["services"]["calendar"]["failed"] == 1
+    text = format_summary(summary)
+    assert "drive: 6 ok, 0 unchanged, 1 failed, 0 skipped" in text
+    assert "failed: bad@x" in text
@@ -0,0 +1,68 @@
+import sqlite3
+
+from google_backup import helpers
+from google_backup.helpers import RunState, StateStore
+
+
+def committed(path, sql):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute(sql).fetchall()
+    finally:
+        db.close()
+
+
+def test_pending_changes_are_read_back_before_commit(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    state = RunState(StateStore(path), "drive", "a@x")
+    state.set_items("file", {"1": {"md5": "a"}, "2": {"md5": "b"}})
+    state.set("cursor", 5)
+    state.commit()
+    state.set_items("file", {"1": None, "3": {"md5": "c"}})
+    state.set("cursor", None)
+    state.set("page", "token")
+    assert state.items("file") == {"2": {"md5": "b"}, "3": {"md5": "c"}}
+    assert state.get("cursor") is None
+    assert state.cursors() == {"page": "token"}
+    assert len(committed(path, "SELECT * FROM items")) == 2
+    state.clear_items("file")
+    state.set_items("file", {"4": True})
+    assert state.items("file") == {"4": True}
+    state.commit()
+    assert committed(path, "SELECT item_id FROM items") == [("4", )]
+    assert RunState(StateStore(path), "drive", "a@x").cursors() == {"page": "token"}
+
+
+def test_jobs_commit_only_their_own_changes(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    store = StateStore(path)
+    first = RunState(store, "drive", "a@x")
+    second = RunState(store, "drive", "b@x")
+    first.set("cursor", 1)
+    second.set("cursor", 2)
+    first.commit()
+    assert committed(path, "SELECT user, value FROM cursors") == [("a@x", "1")]
+    assert second.get("cursor") == 2
+
+
+def test_no_write_transaction_is_left_open(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    state = RunState(StateStore(path), "drive", "a@x")
+    state.set_items("seen", {str(index): True for index in range(10)})
+    state.commit()
+    state.set_items("seen", {"new": True})
+    # Another process can write while the job waits for the network.
+    other = sqlite3.connect(path, timeout=0)
+    other.execute("INSERT INTO cursors (service, user, name, value) VALUES ('gmail', 'b@x', 'history_id', '1')")
+    other.commit()
+    other.close()
+
+
+def test_changes_are_committed_every_commit_interval(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers, "STATE_COMMIT_INTERVAL", 10)
+    path = str(tmp_path / "state.sqlite")
+    state = RunState(StateStore(path), "drive", "a@x")
+    state.set_items("seen", {str(index): True for index in range(9)})
+    assert committed(path, "SELECT COUNT(*) FROM items") == [(0, )]
+    state.set_items("seen", {"9": True})
+    assert committed(path, "SELECT COUNT(*) FROM items") == [(10, )]
@@ -0,0 +1,92 @@
+import datetime
+import logging
+import os
+import subprocess
+
+from google_backup import helpers, scheduler, storage
+from google_backup.scheduler import BackupScheduler, JobResult
+from google_backup.storage import SNAPSHOT_FORMAT, DirectoryStorage, ZfsStorage, expired_snapshots
+
+
+def snapshot_names(start, hours, count):
+    return [(start - datetime.timedelta(hours=hours * index)).strftime(SNAPSHOT_FORMAT) for index in range(count)]
+
+
+def test_snapshots_are_kept_by_count_day_and_week():
+    # Every 6 hours for 8 weeks, newest first
+    names = snapshot_names(datetime.datetime(2015, 3, 1, 18), 6, 4 * 7 * 8)
+    expired = expired_snapshots(names + ["manual"], keep_last=3, keep_daily=7, keep_weekly=4)
+    kept = [name for name in names if name not in expired]
+    assert "manual" not in expired
+    assert kept[:3] == names[:3]
+    # 3 newest, then the newest of 6 more days, then the newest of 3 more weeks
+    assert len(kept) == 3 + 6 + 3
+    assert len({storage.snapshot_time(name).date() for name in kept}) == 7 + 3
+    assert expired_snapshots(names[:2], keep_last=0, keep_daily=0, keep_weekly=0) == names[:2]
+
+
+def test_zfs_runs_zfs_and_chown_directly(monkeypatch):
+    commands = []
+
+    def run(args, **kwargs):
+        assert "input" not in kwargs
+        commands.append(args)
+        return subprocess.CompletedProcess(args, 0, b"", b"")
+
+    monkeypatch.setattr(storage.subprocess, "run", run)
+    monkeypatch.setattr(storage, "BACKUP_OWNER", "backup")
+    monkeypatch.setattr(storage, "CHOWN_BATCH_SIZE", 2)
+    ZfsStorage("tank/backup").create(["tank/backup/gmail/a", "tank/backup/gmail/b", "tank/backup/drive/a"])
+    assert commands == [
+        ["/usr/bin/sudo", "/sbin/zfs", "create", "-p", "tank/backup/gmail/a"],
+        ["/usr/bin/sudo", "/sbin/zfs", "create", "-p", "tank/backup/gmail/b"],
+        ["/usr/bin/sudo", "/sbin/zfs", "create", "-p", "tank/backup/drive/a"],
+        ["/usr/bin/sudo", "/bin/chown", "backup", "/tank/backup/gmail/a", "/tank/backup/gmail/b"],
+        ["/usr/bin/sudo", "/bin/chown", "backup", "/tank/backup/drive/a"],
+    ]
+
+
+def test_directory_snapshots_do_not_change_with_live_data(tmp_path):
+    backend = DirectoryStorage(str(tmp_path).lstrip("/"))
+    dataset = "%s/drive/a" % backend.root
+    backend.create([dataset])
+    with open("/%s/file" % dataset, "w") as data:
+        data.write("before")
+    backend.snapshot("backup-1")
+    with open("/%s/file" % dataset, "r+") as data:
+        data.write("after!")
+    with open(backend.snapshot_path("backup-1") + "/drive/a/file") as data:
+        assert data.read() == "before"
+    assert backend.snapshots() == ["backup-1"]
+    assert backend.sizes() == {dataset: 6}
+    backend.destroy_snapshots(["backup-1"])
+    assert backend.snapshots() == []
+
+
+class CountingStorage(DirectoryStorage):
+    def __init__(self, root):
+        super().__init__(root)
+        self.listings = 0
+
+    def sizes(self):
+        self.listings += 1
+        return super().sizes()
+
+
+def test_scheduler_lists_datasets_once(tmp_path, monkeypatch):
+    root = str(tmp_path).lstrip("/")
+    backend = CountingStorage(root)
+    monkeypatch.setattr(storage, "STORAGE", backend)
+    monkeypatch.setattr(helpers, "ZPOOL_ROOT_PATH", root)
+    monkeypatch.setattr(scheduler, "run_job", lambda job, progress=None, force=False: JobResult(
+        job.service, job.user, "ok", None, 0, None))
+    first, second = ("%s/drive/%s" % (root, user) for user in ("a__x", "b__x"))
+    backend.create([first])
+    with open("/%s/file" % first, "w") as data:
+        data.write("x" * 100)
+    backup = BackupScheduler(["drive"], ["b@x", "a@x"])
+    assert [(job.user, job.size) for job in backup.pending["drive"]] == [("a@x", 100), ("b@x", 0)]
+    assert os.path.isdir("/" + second)
+    backup.run()
+    assert backend.listings == 1
+    assert storage.provision([first], logging.getLogger("test")) == {first: 100, second: 0}
@@ -0,0 +1,70 @@
+import os
+import time
+
+from google_backup import workerpool
+from google_backup.workerpool import WorkerPool
+
+
+def run_item(item):
+    kind, _, value = item.partition(":")
+    if kind == "fail":
+        raise ValueError(value)
+    if kind == "crash":
+        os._exit(3)
+    if kind == "sleep":
+        time.sleep(float(value))
+    return (item, os.getpid())
+
+
+def flaky(item):
+    # Fails the first attempt of each item: the marker file is left by the previous attempt.
+    if not os.path.exists(item):
+        open(item, "w").close()
+        raise ValueError("first attempt")
+    return item
+
+
+def cleaned_up(path):
+    try:
+        time.sleep(30)
+    finally:
+        open(path, "w").close()
+
+
+def test_results_are_collected_per_item():
+    results = WorkerPool(run_item, 2).run(["a", "b", "fail:boom", "crash"])
+    assert results["a"].status == "ok" and results["a"].result[0] == "a"
+    assert results["fail:boom"].status == "failed" and "boom" in results["fail:boom"].error
+    assert results["crash"].status == "crashed" and results["crash"].error == "exit code 3"
+    assert all(result.attempts == 1 for result in results.values())
+
+
+def test_failed_items_are_retried(tmp_path):
+    items = [str(tmp_path / name) for name in ("a", "b")]
+    results = WorkerPool(flaky, 2, max_attempts=2).run(items)
+    assert {item: (result.status, result.attempts) for item, result in results.items()} == dict.fromkeys(
+        items, ("ok", 2))
+
+
+def test_workers_are_replaced_after_max_tasks():
+    results = WorkerPool(run_item, 1, max_tasks_per_child=2).run(["a", "b", "c", "d"])
+    pids = [results[item].result[1] for item in "abcd"]
+    assert pids[0] == pids[1] != pids[2] == pids[3]
+
+
+def test_timed_out_worker_does_not_disturb_the_others(monkeypatch):
+    monkeypatch.setattr(workerpool, "POLL_INTERVAL", 0.1)
+    pool = WorkerPool(run_item, 2, timeout=1, max_attempts=2)
+    results = pool.run(["sleep:30", "sleep:0.2", "a", "b"])
+    assert results["sleep:30"].status == "timeout"
+    assert results["sleep:30"].attempts == 1
+    assert results["sleep:30"].elapsed < 1 + workerpool.TERMINATE_GRACE
+    assert all(results[item].status == "ok" for item in ("sleep:0.2", "a", "b"))
+    assert pool.workers == []
+
+
+def test_terminated_jobs_are_unwound(tmp_path):
+    marker = str(tmp_path / "cleaned up")
+    results = WorkerPool(cleaned_up, 1, timeout=0.5).run([marker])
+    assert results[marker].status == "timeout"
+    assert os.path.exists(marker)
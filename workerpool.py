@@ -0,0 +1,200 @@
+"""
+Process pool for per-user backup jobs.
+
+Unlike multiprocessing.Pool, every worker gets its tasks one at a time through its own queue, so the parent always
+knows which user each process is working on. That makes it possible to
+
+- stop a single user after a timeout by terminating its process,
+- retry a user whose process crashed (killed by the OOM killer, segfault in a C extension, ...) or raised,
+- replace workers after max_tasks_per_child users, so that leaks stay contained.
+
+Each worker sends its results through its own pipe, tagged with the id of the task, so a process stopped in the
+middle of sending can only break its own pipe, and a late result is never credited to another attempt. SIGTERM
+unwinds the current job (finally blocks run and queued progress messages are flushed); workers that are still
+running TERMINATE_GRACE seconds later are killed.
+
+Workers ignore SIGINT; on Ctrl-C the parent terminates them and returns what has finished so far.
+"""
+
+import collections
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+
+WorkResult = collections.namedtuple("WorkResult", ["item", "status", "result", "error", "attempts", "elapsed"])
+POLL_INTERVAL = 1
+TERMINATE_GRACE = 10
+
+
+def stop_worker(signum, frame):
+    raise SystemExit("Terminated")
+
+
+def worker_main(func, tasks, results, initializer, initargs):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_worker)
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, item = task
+        try:
+            message = (task_id, "ok", func(item), None)
+        except Exception as err:  # pylint: disable=broad-except
+            message = (task_id, "failed", None, repr(err))
+        results.send(message)
+
+
+class Worker:
+    def __init__(self, func, initializer, initargs):
+        self.tasks = multiprocessing.Queue()
+        self.results, results = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=worker_main, args=(func, self.tasks, results, initializer, initargs), daemon=True
+        )
+        self.process.start()
+        # Only the worker writes to the pipe, so that reading it fails once the worker is gone.
+        results.close()
+        self.completed = 0
+        self.task_id = None
+        self.item = None
+        self.attempt = 0
+        self.started = None
+
+    def assign(self, task_id, item, attempt):
+        self.task_id, self.item, self.attempt, self.started = task_id, item, attempt, time.time()
+        self.tasks.put((task_id, item))
+
+    def stop(self):
+        self.tasks.put(None)
+
+    def terminate(self):
+        self.process.terminate()
+
+    def join(self, timeout=None):
+        """ Waits for the process to exit, killing it if it is still running after timeout seconds. """
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.results.close()
+
+
+class WorkerPool:
+    def __init__(
+        self, func, processes, max_tasks_per_child=None, timeout=None, max_attempts=1, initializer=None, initargs=(),
+        logger=None
+    ):
+        self.func = func
+        self.processes = processes
+        self.max_tasks_per_child = max_tasks_per_child
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.initializer = initializer
+        self.initargs = initargs
+        self.logger = logger
+        self.task_ids = itertools.count(1)
+        self.workers = []
+        self.pending = collections.deque()
+        self.finished = {}
+        self.interrupted = False
+
+    def log(self, level, msg, *args):
+        if self.logger:
+            self.logger.log(level, msg, *args)
+
+    def spawn(self):
+        worker = Worker(self.func, self.initializer, self.initargs)
+        self.workers.append(worker)
+        return worker
+
+    def finish(self, worker, status, result, error):
+        """ Records the result of the worker's current task, or queues the task again if it can be retried. """
+        item, attempt = worker.item, worker.attempt
+        elapsed = time.time() - worker.started
+        worker.task_id = worker.item = None
+        worker.completed += 1
+        if status in ("crashed", "failed") and attempt + 1 < self.max_attempts:
+            self.log(logging.WARNING, "%s: %s (%s), retrying", item, status, error)
+            self.pending.append((item, attempt + 1))
+            return
+        self.finished[item] = WorkResult(item, status, result, error, attempt + 1, elapsed)
+
+    def handle_results(self):
+        busy = {worker.results: worker for worker in self.workers if worker.item is not None}
+        for results in multiprocessing.connection.wait(list(busy), timeout=POLL_INTERVAL):
+            worker = busy[results]
+            try:
+                task_id, status, result, error = results.recv()
+            except (EOFError, OSError):
+                # The worker is gone; check_workers() reports it once the process has exited.
+                continue
+            if task_id != worker.task_id:
+                self.log(logging.WARNING, "Ignoring a late result of task %s", task_id)
+                continue
+            self.finish(worker, status, result, error)
+            if self.max_tasks_per_child and worker.completed >= self.max_tasks_per_child:
+                worker.stop()
+                worker.join()
+                self.workers.remove(worker)
+
+    def check_workers(self):
+        now = time.time()
+        for worker in list(self.workers):
+            if worker.item is None:
+                if not worker.process.is_alive():
+                    worker.join()
+                    self.workers.remove(worker)
+                continue
+            if not worker.process.is_alive():
+                self.finish(worker, "crashed", None, "exit code %s" % worker.process.exitcode)
+                worker.join()
+                self.workers.remove(worker)
+            elif self.timeout and now - worker.started > self.timeout:
+                self.log(logging.ERROR, "%s: timed out after %s seconds", worker.item, self.timeout)
+                worker.terminate()
+                worker.join(TERMINATE_GRACE)
+                self.finish(worker, "timeout", None, "timed out after %s seconds" % self.timeout)
+                self.workers.remove(worker)
+
+    def assign_tasks(self):
+        while self.pending:
+            idle = [worker for worker in self.workers if worker.item is None]
+            if not idle:
+                if len(self.workers) >= self.processes:
+                    return
+                idle = [self.spawn()]
+            item, attempt = self.pending.popleft()
+            idle[0].assign(next(self.task_ids), item, attempt)
+
+    def shutdown(self, terminate=False):
+        for worker in self.workers:
+            if terminate:
+                worker.terminate()
+            else:
+                worker.stop()
+        for worker in self.workers:
+            worker.join(TERMINATE_GRACE if terminate else None)
+        self.workers = []
+
+    def run(self, items):
+        """ Runs func(item) for every item. Returns {item: WorkResult}. On Ctrl-C, sets self.interrupted and
+            returns only the finished items. """
+        self.pending.extend((item, 0) for item in items)
+        try:
+            while self.pending or any(worker.item is not None for worker in self.workers):
+                self.assign_tasks()
+                self.handle_results()
+                self.check_workers()
+        except KeyboardInterrupt:
+            self.log(logging.WARNING, "Interrupted, stopping %s workers", len(self.workers))
+            self.interrupted = True
+            self.shutdown(terminate=True)
+            return self.finished
+        self.shutdown()
+        return self.finished